@@ -0,0 +1,9 @@
+"""
+gearpy 的性能测试，不是单元测试，用于测量吞吐量和发现性能退化
+
+    python -m benchmarks.end_to_end --broker memory --workers 1,10,50   # 端到端吞吐量
+    python -m benchmarks.micro                                         # 单个组件的微基准
+
+端到端测试在本地启动 benchmarks.server 提供的 HTTP 服务代替真实网站，可以设置响应延迟和失败率。
+使用 Redis 的测试需要本地有可以清空的 Redis 数据库
+"""
@@ -0,0 +1,198 @@
+"""
+这个文件是用来测量 Manager 端到端吞吐量的
+
+HTTP 服务在子进程中运行，所以 CPU 和内存只统计爬虫进程。每个 worker 个数单独运行一次：
+添加 tasks 个任务，启动任务类型，等到所有任务成功后记录用时。失败的任务马上放回「准备工作队列」重试，
+所以失败率越高，吞吐量越低
+
+    python -m benchmarks.end_to_end --broker memory --workers 1,10,50 --tasks 2000 --latency 0.05
+    python -m benchmarks.end_to_end --broker redis --redis localhost:6379/15 --failure-rate 0.05
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+
+from typing import Dict, List
+
+from aiohttp import web
+
+from benchmarks.server import create_app
+from benchmarks.utils import Usage, percentile, print_table
+from gearpy.broker import MemoryBroker, RedisBroker
+from gearpy.metrics import MetricsSink
+from gearpy.task import Task, ResponseType
+from gearpy.task_manager import Manager
+
+COLUMNS = ('broker', 'workers', 'tasks', 'seconds', 'tasks/s', 'fetch_p50', 'fetch_p99', 'wait_p99',
+           'failures', 'cpu_s', 'cpu%', 'rss_kb', 'max_rss_kb')
+
+
+class Recorder(MetricsSink):
+    """
+    记录 Manager 的指标，成功的任务个数达到 target 时设置 done
+    """
+
+    def __init__(self, target: int):
+        self.target = target
+        self.done = asyncio.Event()
+        self.observations: Dict[str, List[float]] = {}
+        self.counters: Dict[str, float] = {}
+
+    def inc(self, name: str, value: float=1, **labels):
+        key = '{}:{}'.format(name, labels.get('outcome'))
+        self.counters[key] = self.counters.get(key, 0) + value
+        if self.counters.get('gearpy_tasks_total:success', 0) >= self.target:
+            self.done.set()
+
+    def observe(self, name: str, value: float, **labels):
+        self.observations.setdefault(name, []).append(value)
+
+    def set(self, name: str, value: float, **labels):
+        pass
+
+
+def run_server(host: str, port: int, latency: float, failure_rate: float, items: int):
+    """
+    在子进程中运行 HTTP 服务
+    """
+    web.run_app(create_app(latency, failure_rate=failure_rate, items=items), host=host, port=port,
+                access_log=None, print=None)
+
+
+async def wait_for_port(host: str, port: int, timeout: float=10):
+    """
+    等待 HTTP 服务开始监听
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+
+def create_task_class(base_url: str, kind: str, pages: int):
+    """
+    创建请求本地 HTTP 服务的任务类
+    :param base_url: HTTP 服务地址
+    :param kind: html 或 json
+    :param pages: 请求的页面个数，任务内容按页面个数取模
+    :return:
+    """
+    class PageTask(Task):
+        response_type = ResponseType.HTML if kind == 'html' else ResponseType.JSON
+
+        def __init__(self, data):
+            super().__init__(data)
+            self.url = '{}/{}/{}'.format(base_url, kind, data % pages)
+
+        async def handle(self):
+            if kind == 'html':
+                return len(self.tree.xpath('//div[@class="comment-item"]')) > 0
+            return len(self.json['comments']) > 0
+
+    return PageTask
+
+
+async def run(options, workers: int) -> Dict:
+    """
+    用指定的 worker 个数运行一次
+    :param options: 命令行参数
+    :param workers: 最大同时执行任务个数
+    :return: 结果
+    """
+    if options.broker == 'redis':
+        host, _, rest = options.redis.partition(':')
+        port, _, db = rest.partition('/')
+        manager_args = (RedisBroker, (host, int(port or 6379), int(db or 0)))
+    else:
+        manager_args = (MemoryBroker, ())
+
+    recorder = Recorder(options.tasks)
+    manager = Manager(*manager_args, metrics=recorder)
+    name = 'gearpy-bench:{}:{}'.format(os.getpid(), workers)
+    manager.handle(name, worker=workers, prefetch=options.prefetch)(
+        create_task_class('http://{}:{}'.format(options.host, options.port), options.kind, options.pages)
+    )
+
+    await manager.new_many(name, range(options.tasks))
+    usage = Usage()
+    await manager.serve(name)
+    try:
+        await asyncio.wait_for(recorder.done.wait(), options.timeout)
+    finally:
+        elapsed = usage.elapsed()
+        await manager.shutdown(5)
+
+    if options.broker == 'redis':
+        # 删除这次运行留下的键（投递 ID 计数器等）
+        await manager.init_broker(name)
+        con = manager.tasks[name][0].con
+        keys = await con.execute('KEYS', name + '*')
+        if keys:
+            await con.execute('DEL', *keys)
+        await manager.close()
+
+    fetch = recorder.observations.get('gearpy_fetch_seconds', [])
+    wait = recorder.observations.get('gearpy_queue_wait_seconds', [])
+    return {
+        'broker': options.broker,
+        'workers': workers,
+        'tasks': options.tasks,
+        'seconds': elapsed['wall'],
+        'tasks/s': options.tasks / elapsed['wall'],
+        'fetch_p50': percentile(fetch, 50),
+        'fetch_p99': percentile(fetch, 99),
+        'wait_p99': percentile(wait, 99),
+        'failures': int(recorder.counters.get('gearpy_tasks_total:failure', 0)),
+        'cpu_s': elapsed['cpu'],
+        'cpu%': 100 * elapsed['cpu'] / elapsed['wall'],
+        'rss_kb': elapsed['rss'],
+        'max_rss_kb': elapsed['max_rss'],
+    }
+
+
+async def main(options):
+    rows = []
+    for workers in options.workers:
+        rows.append(await run(options, workers))
+        print_table(rows[-1:], COLUMNS)
+    print()
+    print_table(rows, COLUMNS)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='end to end gearpy throughput')
+    parser.add_argument('--broker', choices=('memory', 'redis'), default='memory')
+    parser.add_argument('--redis', default='localhost:6379/15', help='host:port/db, the queues are created there')
+    parser.add_argument('--workers', default='1,10,50', type=lambda value: [int(x) for x in value.split(',')],
+                        help='comma separated worker counts, one run each')
+    parser.add_argument('--tasks', type=int, default=2000)
+    parser.add_argument('--prefetch', type=int, default=1)
+    parser.add_argument('--kind', choices=('html', 'json'), default='html')
+    parser.add_argument('--pages', type=int, default=100, help='distinct pages requested')
+    parser.add_argument('--items', type=int, default=20, help='comments per page')
+    parser.add_argument('--latency', type=float, default=0.01, help='average server latency in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for each run')
+    options = parser.parse_args()
+
+    server = multiprocessing.Process(target=run_server, daemon=True,
+                                     args=(options.host, options.port, options.latency, options.failure_rate,
+                                           options.items))
+    server.start()
+    try:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(wait_for_port(options.host, options.port))
+        loop.run_until_complete(main(options))
+    finally:
+        server.terminate()
+        server.join()
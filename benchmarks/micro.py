@@ -0,0 +1,201 @@
+"""
+这个文件是用来测量单个组件性能的微基准
+
+    python -m benchmarks.micro                          # 全部，Redis 连不上时跳过 Redis
+    python -m benchmarks.micro --only proxy,parse,extract   # 只运行部分
+    python -m benchmarks.micro --redis localhost:6379/15 --prefetch 1,10
+"""
+import argparse
+import asyncio
+import inspect
+import time
+
+from typing import Callable, Dict, List
+
+from lxml import etree
+
+from benchmarks.server import html_page
+from benchmarks.utils import print_table
+from gearpy.broker import MemoryBroker, RedisBroker
+from gearpy.extract import Field, Item
+from gearpy.proxy import ProxyPool
+
+COLUMNS = ('benchmark', 'ops', 'seconds', 'ops/s', 'us/op')
+
+
+def result(name: str, ops: int, seconds: float) -> Dict:
+    return {'benchmark': name, 'ops': ops, 'seconds': seconds, 'ops/s': ops / seconds, 'us/op': seconds / ops * 1e6}
+
+
+async def measure(name: str, ops: int, func: Callable) -> Dict:
+    """
+    测量执行 ops 次 func 的时间，func 返回可等待对象时等待它完成
+    :param name: 基准名字
+    :param ops: 执行次数
+    :param func: 参数为序号的函数
+    :return:
+    """
+    start = time.perf_counter()
+    for index in range(ops):
+        ret = func(index)
+        if inspect.isawaitable(ret):
+            await ret
+    return result(name, ops, time.perf_counter() - start)
+
+
+async def bench_broker(broker, label: str, ops: int) -> List[Dict]:
+    """
+    测量 broker 的 push、push_many 和 get_task + ack，结束时队列为空
+    :param broker: 已经初始化的 broker
+    :param label: 结果中的名字前缀
+    :param ops: 操作次数
+    :return:
+    """
+    rows = [await measure('{} push'.format(label), ops, lambda index: broker.push({'page': index}))]
+
+    start = time.perf_counter()
+    for offset in range(0, ops, 1000):
+        await broker.push_many([{'page': index} for index in range(offset, min(offset + 1000, ops))])
+    rows.append(result('{} push_many(1000)'.format(label), ops, time.perf_counter() - start))
+
+    async def get_ack(index):
+        delivery = await broker.get_task()
+        await broker.ack(delivery.id)
+
+    rows.append(await measure('{} get_task+ack'.format(label), ops * 2, get_ack))
+    return rows
+
+
+async def bench_brokers(options) -> List[Dict]:
+    rows = []
+    for prefetch in options.prefetch:
+        broker = MemoryBroker('gearpy-bench-micro', prefetch=prefetch)
+        await broker.init_broker()
+        rows += await bench_broker(broker, 'MemoryBroker prefetch={}'.format(prefetch), options.ops)
+
+    if 'redis' not in options.only:
+        return rows
+
+    host, _, rest = options.redis.partition(':')
+    port, _, db = rest.partition('/')
+    for prefetch in options.prefetch:
+        broker = RedisBroker('gearpy-bench-micro', host, int(port or 6379), int(db or 0), prefetch=prefetch)
+        try:
+            await broker.init_broker()
+        except OSError as e:
+            print('skip RedisBroker:', e, str(e))
+            break
+
+        try:
+            rows += await bench_broker(broker, 'RedisBroker prefetch={}'.format(prefetch), options.ops)
+        finally:
+            keys = await broker.con.execute('KEYS', 'gearpy-bench-micro*')
+            if keys:
+                await broker.con.execute('DEL', *keys)
+            broker.con.close()
+            await broker.con.wait_closed()
+    return rows
+
+
+async def bench_proxy(options) -> List[Dict]:
+    rows = []
+    for size in (10, 1000):
+        pool = ProxyPool()
+        for index in range(size):
+            pool.add('10.0.{}.{}'.format(index // 256, index % 256), 8080, 1)
+
+        async def get_feedback(index):
+            proxy = await pool.get()
+            pool.feedback(proxy, index % 10 != 0, 0.1 + index % 7 / 100)
+
+        rows.append(await measure('ProxyPool get+feedback ({} proxies)'.format(size), options.ops * 5, get_feedback))
+    return rows
+
+
+async def bench_parse(options) -> List[Dict]:
+    rows = []
+    for items in (20, 200):
+        page = html_page(1, items).encode()
+        rows.append(await measure('etree.HTML {} KB ({} items)'.format(len(page) // 1024, items), options.ops // 10,
+                                  lambda index: etree.HTML(page)))
+
+        tree = etree.HTML(page)
+        xpath = etree.XPath('//div[@class="comment-item"]')
+        rows.append(await measure('  string xpath ({} items)'.format(items), options.ops // 10,
+                                  lambda index: tree.xpath('//div[@class="comment-item"]')))
+        rows.append(await measure('  etree.XPath ({} items)'.format(items), options.ops // 10,
+                                  lambda index: xpath(tree)))
+    return rows
+
+
+class Comment(Item):
+    root = '//*[@id="comments"]/div[@class="comment-item"]'
+
+    user_href = Field('./div[2]/h3/span[2]/a/@href')
+    user_name = Field('./div[2]/h3/span[2]/a/text()')
+    votes = Field('./div[2]/h3/span[1]/span/text()', type=int, default=0)
+    star = Field('./div[2]/h3/span[2]/span[contains(@class, "rating")]/@class', pattern=r'allstar(\d+)', type=int,
+                 default=0)
+    date = Field('./div[2]/h3/span[2]/span[@class="comment-time"]/text()')
+    content = Field('./div[2]/p/span/text()')
+
+
+def extract_by_hand(tree) -> List[Dict]:
+    """
+    和 demo 中的 handle 一样，每条评论执行多次字符串 xpath，作为 Comment.extract 的对照
+    """
+    records = []
+    for comment in tree.xpath('//*[@id="comments"]/div[@class="comment-item"]'):
+        user = comment.xpath('./div[2]/h3/span[2]/a')
+        star = comment.xpath('./div[2]/h3/span[2]/span[contains(@class, "rating")]/@class')[0]
+        records.append({
+            'user_href': user[0].attrib['href'],
+            'user_name': user[0].text,
+            'votes': int(comment.xpath('./div[2]/h3/span[1]/span')[0].text),
+            'star': int(star.split(' ')[0][7:]) if 'rating' in star else 0,
+            'date': comment.xpath('./div[2]/h3/span[2]/span[@class="comment-time"]')[0].text.strip(),
+            'content': comment.xpath('./div[2]/p/span')[0].text,
+        })
+    return records
+
+
+async def bench_extract(options) -> List[Dict]:
+    rows = []
+    for items in (20, 200):
+        tree = etree.HTML(html_page(1, items).encode())
+        assert extract_by_hand(tree) == Comment.extract(tree)
+
+        ops = max(options.ops // items, 10)
+        rows.append(await measure('hand-written xpath ({} items)'.format(items), ops,
+                                  lambda index: extract_by_hand(tree)))
+        rows.append(await measure('Item.extract ({} items)'.format(items), ops,
+                                  lambda index: Comment.extract(tree)))
+    return rows
+
+
+BENCHMARKS = {
+    'broker': bench_brokers,
+    'proxy': bench_proxy,
+    'parse': bench_parse,
+    'extract': bench_extract,
+}
+
+
+async def main(options):
+    rows = []
+    for name, bench in BENCHMARKS.items():
+        if name in options.only:
+            rows += await bench(options)
+    print_table(rows, COLUMNS)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='gearpy micro benchmarks')
+    parser.add_argument('--only', default='broker,redis,proxy,parse,extract', type=lambda value: value.split(','),
+                        help='comma separated: broker (memory), redis, proxy, parse, extract')
+    parser.add_argument('--ops', type=int, default=10000)
+    parser.add_argument('--prefetch', default='1,10', type=lambda value: [int(x) for x in value.split(',')])
+    parser.add_argument('--redis', default='localhost:6379/15', help='host:port/db')
+    options = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(main(options))
@@ -0,0 +1,137 @@
+"""
+这个文件是用来定义性能测试用的本地 HTTP 服务的
+
+    GET /html/{page}  类似豆瓣短评的 HTML 页面，每页 items 条评论
+    GET /json/{page}  同样内容的 JSON
+
+每个请求随机等待 latency * (1 ± jitter) 秒，按 failure_rate 的概率返回 500
+"""
+import asyncio
+import json
+import random
+
+from aiohttp import web
+
+COMMENT_ITEM = '''<div class="comment-item" data-cid="{cid}">
+  <div class="avatar"><a title="user{user}" href="https://example.com/people/{user}/"><img src="/avatar/{user}.jpg"></a></div>
+  <div class="comment">
+    <h3>
+      <span class="comment-vote"><span class="votes">{votes}</span><a href="javascript:;" class="j a_vote_comment">有用</a></span>
+      <span class="comment-info">
+        <a href="https://example.com/people/{user}/">user{user}</a>
+        <span>看过</span>
+        <span class="allstar{stars}0 rating" title="rating"></span>
+        <span class="comment-time" title="2017-06-{day:02d} 12:00:00">2017-06-{day:02d}</span>
+      </span>
+    </h3>
+    <p class=""><span class="short">comment {cid} {text}</span></p>
+  </div>
+</div>
+'''
+
+COMMENT_TEXT = '这部电影的节奏很好，演员的表演也很到位，推荐大家去电影院看。'
+
+
+def comments(page: int, items: int):
+    """
+    生成一页评论
+    :param page: 页码
+    :param items: 每页评论个数
+    :return: 评论列表
+    """
+    rng = random.Random(page)  # 同一页的内容固定
+    return [
+        {
+            'cid': page * items + index,
+            'user': rng.randrange(100000),
+            'votes': rng.randrange(1000),
+            'stars': rng.randint(1, 5),
+            'day': rng.randint(1, 30),
+            'text': COMMENT_TEXT * rng.randint(1, 4),
+        }
+        for index in range(items)
+    ]
+
+
+def html_page(page: int, items: int=20) -> str:
+    """
+    生成一页 HTML
+    :param page: 页码
+    :param items: 每页评论个数
+    :return: HTML 文本
+    """
+    body = ''.join(COMMENT_ITEM.format(**comment) for comment in comments(page, items))
+    return ('<html><head><meta charset="utf-8"><title>page {}</title></head><body>'
+            '<div id="comments" class="mod-bd">{}</div>'
+            '<div id="paginator"><a href="?start={}" class="next">后页</a></div>'
+            '</body></html>').format(page, body, (page + 1) * items)
+
+
+def json_page(page: int, items: int=20) -> str:
+    """
+    生成一页 JSON
+    :param page: 页码
+    :param items: 每页评论个数
+    :return: JSON 文本
+    """
+    return json.dumps({'page': page, 'next': page + 1, 'comments': comments(page, items)}, ensure_ascii=False)
+
+
+def create_app(latency: float=0, jitter: float=0.5, failure_rate: float=0, items: int=20) -> web.Application:
+    """
+    创建 HTTP 服务
+    :param latency: 平均响应延迟（秒）
+    :param jitter: 延迟随机变化的比例
+    :param failure_rate: 返回 500 的概率
+    :param items: 每页评论个数
+    :return:
+    """
+    cache = {}  # 生成的页面，(类型, 页码): 内容
+
+    async def page(request):
+        if latency > 0:
+            await asyncio.sleep(latency * (1 + jitter * (2 * random.random() - 1)))
+        if failure_rate > 0 and random.random() < failure_rate:
+            return web.Response(status=500, text='synthetic failure')
+
+        kind = request.match_info['kind']
+        number = int(request.match_info['page'])
+        key = (kind, number)
+        if key not in cache:
+            cache[key] = html_page(number, items) if kind == 'html' else json_page(number, items)
+
+        content_type = 'text/html' if kind == 'html' else 'application/json'
+        return web.Response(text=cache[key], content_type=content_type, charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get(r'/{kind:html|json}/{page:\d+}', page)
+    return app
+
+
+async def start_server(host: str='127.0.0.1', port: int=8765, **options) -> web.AppRunner:
+    """
+    在当前事件循环中启动 HTTP 服务
+    :param host: 监听地址
+    :param port: 监听端口
+    :param options: create_app 的参数
+    :return: 服务的 AppRunner，用 cleanup 关闭
+    """
+    runner = web.AppRunner(create_app(**options), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='synthetic HTTP server for gearpy benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0, help='average latency in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0)
+    parser.add_argument('--items', type=int, default=20, help='comments per page')
+    args = parser.parse_args()
+
+    web.run_app(create_app(args.latency, failure_rate=args.failure_rate, items=args.items),
+                host=args.host, port=args.port, access_log=None)
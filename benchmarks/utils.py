@@ -0,0 +1,75 @@
+"""
+这个文件是用来定义性能测试共用的统计和输出函数的
+"""
+import resource
+import time
+
+from typing import Dict, List, Sequence
+
+
+def percentile(values: Sequence[float], p: float) -> float:
+    """
+    计算百分位数（最近秩）
+    :param values: 观测值
+    :param p: 百分位，0 到 100
+    :return: 没有观测值时为 0
+    """
+    if not values:
+        return 0
+    ordered = sorted(values)
+    index = min(max(int(round(p / 100 * len(ordered) + 0.5)) - 1, 0), len(ordered) - 1)
+    return ordered[index]
+
+
+def current_rss() -> int:
+    """
+    当前进程占用的物理内存（KB），读取 /proc，不支持时返回历史峰值
+    :return:
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Usage:
+    """
+    测量一段时间内的墙上时间和 CPU 时间
+    """
+
+    def __init__(self):
+        self.wall = time.perf_counter()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.cpu = usage.ru_utime + usage.ru_stime
+
+    def elapsed(self) -> Dict[str, float]:
+        """
+        从创建到现在的用量
+        :return: wall 墙上时间（秒），cpu CPU 时间（秒），rss 当前物理内存（KB），max_rss 峰值物理内存（KB）
+        """
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            'wall': time.perf_counter() - self.wall,
+            'cpu': usage.ru_utime + usage.ru_stime - self.cpu,
+            'rss': current_rss(),
+            'max_rss': usage.ru_maxrss,
+        }
+
+
+def print_table(rows: List[Dict], columns: Sequence[str]):
+    """
+    按列对齐输出结果
+    :param rows: 每行一个字典
+    :param columns: 输出的列
+    :return:
+    """
+    def cell(value):
+        return '{:.4g}'.format(value) if isinstance(value, float) else str(value)
+
+    cells = [[cell(row.get(column, '')) for column in columns] for row in rows]
+    widths = [max([len(column)] + [len(line[index]) for line in cells]) for index, column in enumerate(columns)]
+
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for line in cells:
+        print('  '.join(value.rjust(width) for value, width in zip(line, widths)))
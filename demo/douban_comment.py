@@ -1,13 +1,21 @@
-from gearpy import Manager, RedisBroker, Task
+from gearpy import Manager, RedisBroker, Task, ResponseType
 from gearpy.proxy import ProxyPool
+from gearpy.scheduler import HostScheduler
+from gearpy.retry import RetryPolicy
+from gearpy.dedup import RedisSetFilter, fingerprint
+from gearpy.pipeline import Pipeline, CallableSink
+from gearpy.cache import HttpCache
+from gearpy.extract import Item, Field
 from douban.utils import *
 import motor.motor_asyncio
-import json
 import asyncio
 import traceback
 
 
-manager = Manager(broker=RedisBroker, args=('localhost', 6400, 0))  # 建立管理员实例
+# 每个代理 IP 每 3 秒最多请求一次，以免速度过快
+scheduler = HostScheduler(proxy_rate=1 / 3)
+
+manager = Manager(broker=RedisBroker, args=('localhost', 6400, 0), scheduler=scheduler)  # 建立管理员实例
 
 proxy = ProxyPool()  # 代理池实例
 
@@ -16,31 +24,62 @@ client = motor.motor_asyncio.AsyncIOMotorClient('localhost', 27017)
 database = client['douban']
 
 
+def comment_fingerprint(comment):
+    # 同一个用户的同一条评论只保存一次，点赞数变化不影响
+    return fingerprint([comment['user_name'], comment['content']])
+
+
+# 评论不在任务中逐条写入，而是攒成一批后一次写入数据库，数据库慢时抓取也会跟着慢下来
+comments = Pipeline(
+    CallableSink(lambda items: database.comments.insert_many(items, ordered=False)),
+    batch_size=200, flush_interval=2, name='comments',
+    dedup=RedisSetFilter('localhost', 6400, 0), fingerprint=comment_fingerprint,
+    retry=RetryPolicy(max_attempts=3, backoff=1),
+)
+
+
 # 添加代理池任务
 @manager.handle('proxy', worker=)
 class ProxyTask(Task):
 
+    response_type = ResponseType.JSON  # 代理列表是 JSON 接口，不需要解析 HTML
+
     def __init__(self, data):
         super().__init__(data)
         self.url = data
 
     async def handle(self):
-        json_body = json.loads(self.content)
-        for item in json_body:
+        for item in self.json:
             ip, port, priority = item
             proxy.add(ip, port, priority)
 
         return True
 
     async def success(self):
-        await asyncio.sleep(30)
-        await manager.new('proxy', 'http://localhost:4000')
+        await manager.new('proxy', 'http://localhost:4000', delay=30)  # 30 秒后重新读取代理列表
+
+
+# 评论的结构，选择器只在这里编译一次
+class Comment(Item):
+    root = '//*[@id="comments"]/div[@class="comment-item"]'  # 每条评论
 
+    user_href = Field('./div[2]/h3/span[2]/a/@href')
+    user_name = Field('./div[2]/h3/span[2]/a/text()')
+    votes = Field('./div[2]/h3/span[1]/span/text()', type=int, default=0)
+    star = Field('./div[2]/h3/span[2]/span[2]/@class', pattern=r'allstar(\d+)', type=int, default=0)
+    date = Field('./div[2]/h3/span[2]/span[contains(@class, "comment-time")]/text()')
+    content = Field('./div[2]/p/text()')
 
-# 添加电影评论任务，最大工作 5
-@manager.handle('comment', worker=5)
+
+# 添加电影评论任务，最大工作 5，自动从代理池中读取代理，并把代理的使用结果反馈给代理池
+# 重复添加的同一页评论（比如重新运行添加第一页的脚本）一天内只添加一次，重新抓取时内容没有变化的页面不重新下载
+@manager.handle('comment', worker=5, proxy_pool=proxy, retry=RetryPolicy(max_attempts=5, backoff=10),
+                dedup=RedisSetFilter('localhost', 6400, 0, ttl=24 * 3600), pipeline=comments,
+                http_cache=HttpCache('.cache/douban', max_size=512 * 1024 ** 2))
 class CommentTask(Task):
 
+    item = Comment  # 按 Comment 提取评论，结果在 self.records 中
+
     def __init__(self, data):
         super().__init__(data)
 
@@ -57,8 +96,6 @@ class CommentTask(Task):
         :return:
         """
 
-        self.proxy = await proxy.get()  # 从代理池中捞一个代理 IP 出来
-
         # 伪造 HTTP 请求头，让他看起来更像一次正常人类的访问
         self.headers['Cookie'] = 'bid={}'.format(random_bid())
         self.headers['User-Agent'] = random_user_agent()
@@ -83,57 +120,20 @@ class CommentTask(Task):
         定义用户查询的内容
         :return:
         """
-        save_num = 0  # 记录储存了多少条新评论
-
         # 如果访问失败则反馈任务失败
         if '检测到有异常请求' in self.content:
             return False
 
-        # XPATH 方式读取出所有评论
-        all_comment = self.tree.xpath('//*[@id="comments"]/div[@class="comment-item"]')
-
         # 如果有 0 条评论，那么证明没有下一页了
-        if len(all_comment) == 0:
+        if len(self.records) == 0:
             self.has_next_page = False
 
         else:
 
-            # 逐条读取评论
-            for comment in all_comment:
-                try:
-                    # 全部都是 XPATH 的读取方式，读取你想要的内容
-                    user = comment.xpath('./div[2]/h3/span[2]/a')
-                    user_href = user[0].attrib['href']
-                    user_name = user[0].text
-                    votes = comment.xpath('./div[2]/h3/span[1]/span')[0].text
-
-                    star = comment.xpath('./div[2]/h3/span[2]/span[2]/@class')[0]
-                    star = star.split(' ')[0][7:] if 'rating' in star else 0
-
-                    date = comment.xpath('./div[2]/h3/span[2]/span[@class="comment-time "]')[0].text.strip().strip(
-                        '\n').strip()
-
-                    content = comment.xpath('./div[2]/p')[0].text
-
-                    # 判断是否在数据库中
-                    comment_existed = await database.movies.find({'user_name': user_name, 'content': content}).count()
-
-                    if comment_existed == 0:
-                        # 如果数据库中找不到，那么插入数据库
-                        save_num += 1
-                        await database.comments.insert_one({
-                            'mid': self.id,
-                            'user_href': user_href,
-                            'user_name': user_name,
-                            'votes': int(votes),
-                            'star': int(star),
-                            'date': date,
-                            'content': content
-                        })
-                except Exception as e:
-                    print('  handle function raise', e, str(e))
-
-            print('saving {} comment from id {} page {}'.format(save_num, self.id, self.page))
+            # 输出评论，任务成功后由 comments 管道去重、批量写入数据库
+            self.emit(*[dict(comment, mid=self.id) for comment in self.records])
+
+            print('got {} comment from id {} page {}'.format(len(self.records), self.id, self.page))
 
         return True
 
@@ -142,43 +142,38 @@ class CommentTask(Task):
         任务成功时触发的函数
         :return:
         """
-        proxy.feedback(self.proxy)  # 任务成功，代表刚刚用的 代理 IP 可用，则反馈给代理池
-        await asyncio.sleep(3)  # 等待3秒，以免速度过快
-
         # 判断是否还有下一页
         if self.page <= 9:
 
-            # 插入一个新的任务，即下一页
+            # 插入一个新的任务，即下一页，循环抓取时同一页会被再次添加，所以不检查重复
             await manager.new('comment', {
                 'id': self.id,
                 'page': self.page + 1,
                 'type': self.type
-            })
+            }, dedup=False)
         if self.page == 10:
             # 如果已经是第10 页，那么重新从第 0 页开始爬
             await manager.new('comment', {
                 'id': self.id,
                 'page': 0,
                 'type': self.type
-            })
+            }, dedup=False)
 
 
 async def initial():
     await manager.init_all_broker()  # 初始化所有数据库队列
 
     # await manager.new('proxy', 'http://localhost:4000')
-    # async for movie in database.movies.find():
-    #     print(movie['mid'], movie['content'])
-    #     await manager.new('comment', {
-    #         'id': movie['mid'],
-    #         'page': 1,
-    #         'type': 'new_score'
-    #     })
-    #     await manager.new('comment', {
-    #         'id': movie['mid'],
-    #         'page': 1,
-    #         'type': 'time'
-    #     })
+    # async def all_comment_task():
+    #     async for movie in database.movies.find():
+    #         for comment_type in ['new_score', 'time']:
+    #             yield {
+    #                 'id': movie['mid'],
+    #                 'page': 1,
+    #                 'type': comment_type
+    #             }
+    #
+    # await manager.new_many('comment', all_comment_task())  # 批量插入，不需要逐个请求数据库
 
     # 执行两种任务，评论任务，代理任务
     await manager.serve(['comment', 'proxy'], restore=True)
@@ -1,41 +1,47 @@
 import asyncio
-import re
 
-from gearpy import Queue
-from gearpy import TaskManager, Task
+from gearpy import Manager, MemoryBroker, Task
 
-jandan = TaskManager(provider=Queue(), worker=5)
+jandan = Manager(broker=MemoryBroker)  # 单机运行，任务储存在内存中
 
 
-class TestHandler(Task):
+# 解析页面在进程池中执行，不阻塞其他请求
+@jandan.handle('duan', worker=5, executor='process')
+class DuanTask(Task):
 
-    async def on_handle(self):
+    def __init__(self, data):
+        super().__init__(data)
+        self.url = data
 
-        print("fetching url {}".format(self.url))
+    @classmethod
+    def extract(cls, body, encoding=None):
+        tree = cls.parse(body, encoding)
 
-        all_li = self.content.find_all('li', id=re.compile('^comment-'))
-        for li in all_li:
-            text = li.find_all('p')
-            content = '\n'.join([p.text for p in text])
+        duans = ['\n'.join(li.xpath('.//p/text()')) for li in tree.xpath('//li[starts-with(@id, "comment-")]')]
+        next_page = tree.xpath('//a[@title="Older Comments"]/@href')
 
-    async def on_result(self):
-        next_page = self.content.find('a', {'title': 'Older Comments'})
+        return {'duans': duans, 'next_page': next_page[0] if next_page else None}
 
-        await asyncio.sleep(10)
+    async def handle(self):
 
-        if next_page:
-            await jandan.add("http:{}".format(next_page.get('href')))
+        print("fetching url {}, {} duans".format(self.url, len(self.records['duans'])))
 
+        return True
 
-jandan.observe(TestHandler)
+    async def success(self):
+        if self.records['next_page']:
+            # 10 秒后再抓取下一页，等待期间不占用执行名额
+            await jandan.new('duan', "http:{}".format(self.records['next_page']), delay=10)
 
 
 async def initial():
-    await jandan.add("http://jandan.net/duan")
+    await jandan.new('duan', "http://jandan.net/duan")
 
-    await jandan.start_serve()
+    await jandan.serve(['duan'])
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(asyncio.gather(initial()))
-
-loop.close()
+# 进程池中的子进程会重新导入这个模块，启动代码只能在主进程中执行
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.gather(initial()))
+    loop.run_forever()
+    loop.close()
@@ -1,101 +1,56 @@
-import asyncio
-import re
-import aiohttp
-import json
 import logging
-import aiofiles
-import random
 
 import motor.motor_asyncio
 
-from gearpy import Queue
-from gearpy import TaskManager, Task
+from gearpy import Manager, MemoryBroker, Task, ResponseType
+from gearpy.proxy import ProxyPool
 
 from douban.utils import *
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
 
-class ProxyPool:
-
-    def __init__(self):
-        self.__pool = {}
-
-    def add(self, ip, port, priority):
-
-        if 'http://{}:{}'.format(ip, port) not in self.__pool:
-            self.__pool['http://{}:{}'.format(ip, port)] = {
-                'priority': priority,
-                'unused_time': 20
-            }
-        else:
-            self.__pool['http://{}:{}'.format(ip, port)]['priority'] = priority
-            self.__pool['http://{}:{}'.format(ip, port)]['unused_time'] += priority
-
-    async def get(self):
-        is_done = False
-        proxy = None
-
-        while not is_done:
-            proxies = self.__pool.items()
-            proxies_sorted = sorted(list(proxies), reverse=True, key=lambda x: x[1]['unused_time'])
-            if len(proxies_sorted) > 0:
-                self.__pool[proxies_sorted[0][0]]['unused_time'] -= 1
-                proxy = proxies_sorted[0][0]
-                is_done = True
-
-            if not is_done:
-                await asyncio.sleep(1)
-
-        return proxy
-
-    def feedback(self, item):
-        self.__pool[item]['unused_time'] += 1
-
-
 proxy_pool = ProxyPool()
 
-proxy_manager = TaskManager(provider=Queue(), worker=1)
-movies = TaskManager(provider=Queue(), worker=1)
-comments = TaskManager(provider=Queue(), worker=5)
+manager = Manager(broker=MemoryBroker)  # 单机运行，任务储存在内存中
 
 client = motor.motor_asyncio.AsyncIOMotorClient('localhost', 27017)
 database = client['douban']
 
-@proxy_manager.observe
+
+@manager.handle('proxy', worker=1)
 class GetProxy(Task):
 
-    async def on_task(self):
-        logging.info("getting proxy list from local...")
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.url) as r:
-                json_body = json.loads(await r.text())
-                for proxy in json_body:
-                    ip, port, priority = proxy
-                    proxy_pool.add(ip, port, priority)
+    response_type = ResponseType.JSON
 
-    async def on_result(self):
-        await asyncio.sleep(60)
-        await proxy_manager.add("http://localhost:4000")
+    def __init__(self, data):
+        super().__init__(data)
+        self.url = data
 
+    async def handle(self):
+        logging.info("getting proxy list from local...")
+        for proxy in self.json:
+            ip, port, priority = proxy
+            proxy_pool.add(ip, port, priority)
 
-class ProxyTask(Task):
+        return True
 
-    async def on_before(self):
+    async def success(self):
+        await manager.new('proxy', self.url, delay=60)
 
-        self.proxy = await proxy_pool.get()
 
+@manager.handle('movie', worker=1, proxy_pool=proxy_pool)
+class TestHandler(Task):
 
-@movies.observe
-class TestHandler(ProxyTask):
+    response_type = ResponseType.JSON
 
-    def __init__(self, content):
-        super().__init__(content)
+    def __init__(self, data):
+        super().__init__(data)
 
-        self.page = content
+        self.page = data
         self.has_next_page = True
 
-    async def on_before(self):
+    async def before(self):
 
         self.headers['Cookie'] = 'bid={}'.format(random_bid())
         self.headers['User-Agent'] = random_user_agent()
@@ -112,11 +67,11 @@ class TestHandler(ProxyTask):
         self.time_out = 3
         self.url = 'https://movie.douban.com/j/search_subjects?type=movie&tag=%E7%83%AD%E9%97%A8&sort=recommend&page_limit=20&page_start={}'.format(int(self.page)*20)
 
-    async def on_handle(self):
+    async def handle(self):
 
         print("fetching movie info page {}".format(self.page))
 
-        data_json = json.loads(self.content)
+        data_json = self.json
         if len(data_json['subjects']) != 0:
             for movie in data_json['subjects']:
 
@@ -131,16 +86,15 @@ class TestHandler(ProxyTask):
         else:
             self.has_next_page = False
 
-    async def on_result(self):
-        if self.has_next_page:
+        return True
 
-            proxy_pool.feedback(self.proxy)
-            await asyncio.sleep(1)
-            await movies.add(int(self.page) + 1)
+    async def success(self):
+        if self.has_next_page:
+            await manager.new('movie', int(self.page) + 1, delay=1)
 
 
-@comments.observe
-class Comment(ProxyTask):
+@manager.handle('comment', worker=5, proxy_pool=proxy_pool)
+class Comment(Task):
 
     def __init__(self, comment):
         super().__init__(comment)
@@ -150,10 +104,7 @@ class Comment(ProxyTask):
         self.type = comment['type']
         self.has_next_page = True
 
-    async def on_before(self):
-
-        # self.proxy = 'http://127.0.0.1:3128'
-        self.proxy = await proxy_pool.get()
+    async def before(self):
 
         self.headers['Cookie'] = 'bid={}'.format(random_bid())
         self.headers['User-Agent'] = random_user_agent()
@@ -171,12 +122,12 @@ class Comment(ProxyTask):
 
         # print('fetching comment page with id {} page {} proxy {}'.format(self.id, self.page, self.proxy))
 
-    async def on_handle(self):
+    async def handle(self):
 
         save_num = 0
         all_comment = self.tree.xpath('//*[@id="comments"]/div[@class="comment-item"]')
-        if '检测到有异常请求' in self.content:
-            raise ValueError()
+        if '检测到有异常请求' in self.text:
+            return False
 
         if len(all_comment) == 0:
             self.has_next_page = False
@@ -210,35 +161,35 @@ class Comment(ProxyTask):
 
             print('saving {} comment from id {} page {} with proxy {}'.format(save_num, self.id, self.page, self.proxy))
 
-    async def on_result(self):
-        proxy_pool.feedback(self.proxy)
-        await asyncio.sleep(1)
+        return True
+
+    async def success(self):
         if self.has_next_page:
-            await comments.add({
+            await manager.new('comment', {
                 'id': self.id,
                 'page': self.page + 1,
                 'type': self.type
-            })
+            }, delay=1)
 
 
 
 async def initial():
 
-    proxy_manager.start_serve(['http://localhost:4000'])
-    # movies.start_serve([0])
-    async for movie in database.movies.find():
-        await comments.add({
-            'id': movie['mid'],
-            'page': 0,
-            'type': 'new_score'
-        })
-        await comments.add({
-            'id': movie['mid'],
-            'page': 0,
-            'type': 'time'
-        })
-
-    comments.start_serve()
+    await manager.new('proxy', 'http://localhost:4000')
+    # await manager.new('movie', 0)
+
+    async def all_comment_task():
+        async for movie in database.movies.find():
+            for comment_type in ['new_score', 'time']:
+                yield {
+                    'id': movie['mid'],
+                    'page': 0,
+                    'type': comment_type
+                }
+
+    await manager.new_many('comment', all_comment_task())  # 批量插入，不需要逐个请求数据库
+
+    await manager.serve(['proxy', 'comment'])
 #
 #
 # loop = asyncio.get_event_loop()
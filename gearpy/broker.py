@@ -2,8 +2,58 @@
 这个文件是用来定义任务储存介质的
 """
 import abc
+import asyncio
+import collections
+import heapq
+import itertools
+import math
+import random
 import aioredis
-import json
+import time
+import uuid
+
+from typing import Any, List, NamedTuple, Optional, Sequence
+
+from gearpy.serializer import MAX_PRIORITY, Envelope, get_serializer, encode, unpack
+
+
+class Delivery(NamedTuple):
+    """
+    从「准备执行队列」取出的一次任务投递
+    """
+    id: str  # 投递 ID，每次取出任务时生成，用于确认（ack）和回滚任务
+    item: Any  # 任务内容
+    attempts: int = 0  # 这个任务之前已经失败的次数
+    priority: int = 0  # 任务的优先级
+
+
+def get_priority_weights(priorities: int, weights: Optional[Sequence[float]]=None) -> List[float]:
+    """
+    检查优先级个数，并计算每个优先级的权重
+    :param priorities: 优先级个数，优先级为 0 到 priorities - 1，越大越优先
+    :param weights: 每个优先级的权重，为空时每高一级权重翻倍
+    :return: 每个优先级的权重
+    """
+    if not 1 <= priorities <= MAX_PRIORITY + 1:
+        raise ValueError('priorities must be between 1 and {}'.format(MAX_PRIORITY + 1))
+
+    if weights is None:
+        return [2 ** level for level in range(priorities)]
+
+    if len(weights) != priorities or any(weight <= 0 for weight in weights):
+        raise ValueError('priority_weights must be {} positive numbers'.format(priorities))
+    return list(weights)
+
+
+def check_priority(priority: int, priorities: int):
+    """
+    检查任务的优先级是否有效
+    :param priority: 任务的优先级
+    :param priorities: 优先级个数
+    :return:
+    """
+    if not 0 <= priority < priorities:
+        raise ValueError('priority must be between 0 and {}'.format(priorities - 1))
 
 
 class BasicBroker:
@@ -12,30 +62,86 @@ class BasicBroker:
     """
     __metaclass__ = abc.ABCMeta
 
+    @property
+    def pool_key(self):
+        """
+        连接池的键，键相同的储存介质可以共用一个连接池，为空时表示不需要连接池
+        :return:
+        """
+        return None
+
+    async def create_pool(self, **options):
+        """
+        创建一个可以被多个储存介质共用的连接池
+        :param options: 连接池配置
+        :return: 连接池
+        """
+        return None
+
+    async def init_broker(self, pool=None):
+        """
+        初始化函数
+        :param pool: 共用的连接池，为空时自己创建
+        :return:
+        """
+        pass
+
     @abc.abstractmethod
-    async def push(self, item):
+    async def push(self, item, eta: Optional[float]=None, priority: int=0):
         """
         把任务放进「准备执行队列」
         :param item: 任务内容
+        :param eta: 任务的执行时间（时间戳），设置时先放进「延迟队列」，到时间后才放进「准备执行队列」
+        :param priority: 任务的优先级，越大越优先
         :return:
         """
         pass
 
+    async def push_many(self, items, eta: Optional[float]=None, priority: int=0) -> int:
+        """
+        批量把任务放进「准备执行队列」，默认逐个插入，子类可以用一次请求插入多个任务
+        :param items: 任务内容列表
+        :param eta: 任务的执行时间（时间戳）
+        :param priority: 任务的优先级
+        :return: 返回插入任务的个数
+        """
+        for item in items:
+            await self.push(item, eta, priority)
+        return len(items)
+
     @abc.abstractmethod
-    async def delete(self, item, working_queue=False) -> int:
+    async def delete(self, item, priority: int=0) -> int:
         """
-        从队列中删除任务
+        从「准备执行队列」中删除任务
         :param item: 任务内容
-        :param working_queue: 如果是 True 的话，从「工作中队列」删除，否则，从「准备执行队列」删除
+        :param priority: 任务的优先级
+        :return: 返回删除任务的个数
+        """
+        pass
+
+    @abc.abstractmethod
+    async def get_task(self) -> Delivery:
+        """
+        从「准备执行队列」获取一个任务（按权重优先取出高优先级的任务），然后从队列中删除，同时生成一个投递 ID，以投递 ID 为键放入「工作中队列」
+        :return: 任务投递
+        """
+        pass
+
+    @abc.abstractmethod
+    async def ack(self, delivery_id) -> int:
+        """
+        确认任务执行完成，从「工作中队列」删除
+        :param delivery_id: 投递 ID
         :return: 返回删除任务的个数
         """
         pass
 
     @abc.abstractmethod
-    async def get_task(self):
+    async def rollback(self, delivery_id) -> int:
         """
-        从「准备执行队列」获取一个任务，然后从队列中删除，同时把它插入「工作中队列」
-        :return: 任务内容
+        从「工作中队列」中删除，然后把任务放入「准备执行队列」
+        :param delivery_id: 投递 ID
+        :return: 返回回滚任务的个数
         """
         pass
 
@@ -47,33 +153,392 @@ class BasicBroker:
         """
         pass
 
+    @abc.abstractmethod
+    async def retry(self, delivery: Delivery, eta: Optional[float]=None) -> int:
+        """
+        从「工作中队列」中删除，失败次数加一后放回「准备执行队列」，用于重试失败的任务
+        :param delivery: 任务投递
+        :param eta: 重试的时间（时间戳），设置时先放进「延迟队列」
+        :return: 返回重试任务的个数
+        """
+        pass
+
+    @abc.abstractmethod
+    async def dead(self, delivery: Delivery) -> int:
+        """
+        从「工作中队列」中删除，失败次数加一后放入「死信队列」，用于失败次数太多、不再重试的任务
+        :param delivery: 任务投递
+        :return: 返回放入「死信队列」的任务个数
+        """
+        pass
+
+    @abc.abstractmethod
+    async def dead_tasks(self, start: int=0, stop: int=-1) -> List[Envelope]:
+        """
+        查看「死信队列」中的任务，最新放入的任务在最前面
+        :param start: 开始位置
+        :param stop: 结束位置（包括），-1 表示到最后
+        :return: 任务内容和失败次数
+        """
+        pass
+
+    @abc.abstractmethod
+    async def replay_dead(self, limit: int=0) -> int:
+        """
+        把「死信队列」中的任务清空失败次数后放回「准备执行队列」，最早放入的任务最先放回
+        :param limit: 最多放回多少个任务，0 表示全部放回
+        :return: 返回放回的任务个数
+        """
+        pass
+
+    @abc.abstractmethod
+    async def purge_dead(self) -> int:
+        """
+        清空「死信队列」
+        :return: 返回删除的任务个数
+        """
+        pass
+
+    async def requeue_expired(self) -> int:
+        """
+        把超过可见时间（visibility timeout）仍未确认的任务放回「准备执行队列」，不支持可见时间的储存介质不做任何事
+        :return: 返回放回的任务个数
+        """
+        return 0
+
+    async def renew(self, delivery_id) -> int:
+        """
+        把任务的租约延长一个可见时间，用于任务因为请求频率控制等待时，不支持可见时间的储存介质不做任何事
+        :param delivery_id: 投递 ID
+        :return: 任务仍在「工作中队列」中时返回 1，已经因为租约到期被放回时返回 0
+        """
+        return 1
+
+    async def release(self) -> int:
+        """
+        把已经取出但还没有交给 Manager 的任务（预取的任务）回滚，用于关闭系统前，不预取任务的储存介质不做任何事
+        :return: 返回回滚的任务个数
+        """
+        return 0
+
+    async def promote(self) -> int:
+        """
+        把「延迟队列」中到时间的任务放进「准备执行队列」，由 Manager 定期调用，不需要定期移动的储存介质不做任何事
+        :return: 返回移动的任务个数
+        """
+        return 0
+
+
+# 根据任务内容头部中的优先级选择「准备执行队列」，各个优先级的「准备执行队列」放在 KEYS 的最后，first 为优先级 0 的位置。
+# 超过最高优先级的任务放进最高优先级的队列
+READY_KEY_LUA = r"""
+local function ready_key(payload, first)
+    local level = 0
+    if string.sub(payload, 1, 1) == '\1' then
+        level = string.byte(payload, 5)
+    end
+    return KEYS[math.min(first + level, #KEYS)]
+end
+"""
+
+# 把任务内容头部中的失败次数加一，没有头部的旧版本任务内容加上头部（失败次数为 1）
+ADD_ATTEMPT_LUA = r"""
+local function add_attempt(payload)
+    if string.sub(payload, 1, 1) == '\1' then
+        local attempts = math.min(string.byte(payload, 3) * 256 + string.byte(payload, 4) + 1, 65535)
+        return string.sub(payload, 1, 2) .. string.char(math.floor(attempts / 256), attempts % 256) .. string.sub(payload, 5)
+    end
+    return '\1j\0\1\0' .. payload
+end
+"""
+
+# 唤醒一个阻塞等待新任务的 get_task：往「通知列表」写入一个通知，列表最多保留一个通知，没有人等待时也不会越积越多。
+# 所有把任务放进「准备执行队列」的脚本都在最后调用
+NOTIFY_LUA = """
+local function notify(key)
+    redis.call('LPUSH', key, 1)
+    redis.call('LTRIM', key, 0, 0)
+end
+"""
+
+# 批量放进任务：KEYS = [通知列表, 准备执行队列]，ARGV = [任务内容, ...]
+# unpack 的参数个数有限制，每次 LPUSH 最多 1000 个
+PUSH_SCRIPT = NOTIFY_LUA + """
+for i = 1, #ARGV, 1000 do
+    redis.call('LPUSH', KEYS[2], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+notify(KEYS[1])
+return #ARGV
+"""
+
+# 取出多个任务：KEYS = [工作中队列, 投递 ID 计数器, 租约集合, 通知列表, 优先级 0 的准备执行队列, 优先级 1 的准备执行队列, ...]，
+# ARGV = [租约到期时间, 最多取出个数, 0 到 1 之间的随机数, 优先级 0 的权重, 优先级 1 的权重, ...]
+# 每次在非空的队列中按权重随机选择一个，高优先级的任务先执行，低优先级的任务也不会饿死。
+# Lua 脚本需要可重放，所以随机数由客户端生成，取出多个任务时用黄金分割数生成后续的随机数。
+# 租约到期时间为空字符串时，不设置租约。取完后队列中还有任务时唤醒下一个等待的 get_task。
+# 返回 {投递 ID, 任务内容, 投递 ID, 任务内容, ...}
+FETCH_SCRIPT = NOTIFY_LUA + """
+local levels = #KEYS - 4
+local random = tonumber(ARGV[3])
+local fetched = {}
+for i = 1, tonumber(ARGV[2]) do
+    local total = 0
+    local weights = {}
+    for level = 1, levels do
+        weights[level] = 0
+        if redis.call('LLEN', KEYS[4 + level]) > 0 then
+            weights[level] = tonumber(ARGV[3 + level])
+            total = total + weights[level]
+        end
+    end
+    if total == 0 then
+        break
+    end
+
+    local target = random * total
+    local level = 0
+    for candidate = levels, 1, -1 do
+        if weights[candidate] > 0 then
+            level = candidate
+            if target < weights[candidate] then
+                break
+            end
+            target = target - weights[candidate]
+        end
+    end
+    random = (random + 0.6180339887) % 1
+
+    local payload = redis.call('RPOP', KEYS[4 + level])
+    local id = redis.call('INCR', KEYS[2])
+    redis.call('HSET', KEYS[1], id, payload)
+    if ARGV[1] ~= '' then
+        redis.call('ZADD', KEYS[3], ARGV[1], id)
+    end
+    fetched[#fetched + 1] = id
+    fetched[#fetched + 1] = payload
+end
+for level = 1, levels do
+    if redis.call('LLEN', KEYS[4 + level]) > 0 then
+        notify(KEYS[4])
+        break
+    end
+end
+return fetched
+"""
+
+# 确认一个任务：KEYS = [工作中队列, 租约集合]，ARGV = [投递 ID]
+ACK_SCRIPT = """
+redis.call('ZREM', KEYS[2], ARGV[1])
+return redis.call('HDEL', KEYS[1], ARGV[1])
+"""
+
+# 延长一个任务的租约：KEYS = [工作中队列, 租约集合]，ARGV = [投递 ID, 新的租约到期时间]
+# 任务已经因为租约到期被放回时返回 0
+RENEW_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+return 1
+"""
+
+# 回滚一个任务：KEYS = [工作中队列, 租约集合, 通知列表, 各个优先级的准备执行队列...]，ARGV = [投递 ID]
+ROLLBACK_SCRIPT = READY_KEY_LUA + NOTIFY_LUA + """
+redis.call('ZREM', KEYS[2], ARGV[1])
+local payload = redis.call('HGET', KEYS[1], ARGV[1])
+if not payload then
+    return 0
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('LPUSH', ready_key(payload, 4), payload)
+notify(KEYS[3])
+return 1
+"""
+
+# 恢复所有任务：KEYS = [工作中队列, 租约集合, 通知列表, 各个优先级的准备执行队列...]
+# 兼容旧版本用列表储存的「工作中队列」
+RESTORE_SCRIPT = READY_KEY_LUA + NOTIFY_LUA + """
+local count = 0
+redis.call('DEL', KEYS[2])
+if redis.call('TYPE', KEYS[1]).ok == 'list' then
+    while redis.call('RPOPLPUSH', KEYS[1], KEYS[4]) do
+        count = count + 1
+    end
+else
+    local payloads = redis.call('HVALS', KEYS[1])
+    for i = 1, #payloads do
+        redis.call('LPUSH', ready_key(payloads[i], 4), payloads[i])
+    end
+    redis.call('DEL', KEYS[1])
+    count = #payloads
+end
+if count > 0 then
+    notify(KEYS[3])
+end
+return count
+"""
+
+# 放回租约到期的任务：KEYS = [工作中队列, 租约集合, 通知列表, 各个优先级的准备执行队列...]，ARGV = [当前时间, 最多处理个数]
+# 租约到期说明执行任务的进程可能已经崩溃，和失败一样把失败次数加一，每次都让进程崩溃的任务最终会进入死信队列
+REQUEUE_SCRIPT = READY_KEY_LUA + ADD_ATTEMPT_LUA + NOTIFY_LUA + """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local count = 0
+for i = 1, #ids do
+    local payload = redis.call('HGET', KEYS[1], ids[i])
+    if payload then
+        payload = add_attempt(payload)
+        redis.call('LPUSH', ready_key(payload, 4), payload)
+        redis.call('HDEL', KEYS[1], ids[i])
+        count = count + 1
+    end
+    redis.call('ZREM', KEYS[2], ids[i])
+end
+if count > 0 then
+    notify(KEYS[3])
+end
+return count
+"""
+
+# 移动到时间的延迟任务：KEYS = [延迟队列, 通知列表, 各个优先级的准备执行队列...]，ARGV = [当前时间, 最多移动个数]
+# 延迟队列的成员为 32 位 ID + ':' + 任务内容，ID 用于区分内容相同的任务
+PROMOTE_SCRIPT = READY_KEY_LUA + NOTIFY_LUA + """
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for i = 1, #members do
+    local payload = string.sub(members[i], 34)
+    redis.call('LPUSH', ready_key(payload, 3), payload)
+    redis.call('ZREM', KEYS[1], members[i])
+end
+if #members > 0 then
+    notify(KEYS[2])
+end
+return #members
+"""
+
+# 重试或放弃一个任务：KEYS = [工作中队列, 租约集合, 延迟队列, 死信队列, 通知列表, 各个优先级的准备执行队列...]，
+# ARGV = [投递 ID, 目标（ready, delayed 或 dead）, 重试时间, 32 位 ID]
+# 在服务器上把任务内容头部中的失败次数加一（没有头部的旧版本任务内容加上头部），然后放进目标队列。任务已经因为租约到期被放回时返回 0
+RETRY_SCRIPT = READY_KEY_LUA + ADD_ATTEMPT_LUA + NOTIFY_LUA + """
+redis.call('ZREM', KEYS[2], ARGV[1])
+local payload = redis.call('HGET', KEYS[1], ARGV[1])
+if not payload then
+    return 0
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+payload = add_attempt(payload)
+if ARGV[2] == 'dead' then
+    redis.call('LPUSH', KEYS[4], payload)
+elseif ARGV[2] == 'delayed' then
+    redis.call('ZADD', KEYS[3], ARGV[3], ARGV[4] .. ':' .. payload)
+else
+    redis.call('LPUSH', ready_key(payload, 6), payload)
+    notify(KEYS[5])
+end
+return 1
+"""
+
+# 重放死信任务：KEYS = [死信队列, 通知列表, 各个优先级的准备执行队列...]，ARGV = [最多放回个数，0 表示全部]
+# 放回前把头部中的失败次数清零
+REPLAY_SCRIPT = READY_KEY_LUA + NOTIFY_LUA + r"""
+local limit = tonumber(ARGV[1])
+local count = 0
+while limit == 0 or count < limit do
+    local payload = redis.call('RPOP', KEYS[1])
+    if not payload then
+        break
+    end
+    if string.sub(payload, 1, 1) == '\1' then
+        payload = string.sub(payload, 1, 2) .. '\0\0' .. string.sub(payload, 5)
+    end
+    redis.call('LPUSH', ready_key(payload, 3), payload)
+    count = count + 1
+end
+if count > 0 then
+    notify(KEYS[2])
+end
+return count
+"""
+
+# 清空死信队列：KEYS = [死信队列]
+PURGE_SCRIPT = """
+local count = redis.call('LLEN', KEYS[1])
+redis.call('DEL', KEYS[1])
+return count
+"""
+
 
 class RedisBroker(BasicBroker):
     """
     基于 Redis 数据库的任务储存介质
+
+    「准备执行队列」是一个列表，「工作中队列」是一个以投递 ID 为键的哈希表，确认和回滚任务都是 O(1) 的操作。
+    设置了可见时间时，每个取出的任务在「租约集合」（以到期时间排序的有序集合）中有一个租约，到期未确认的任务会被放回「准备执行队列」。
+    设置了预取个数时，一次 Lua 调用取出多个任务放在本地缓冲区中，预取的任务和普通取出的任务一样在「工作中队列」中，重启或租约到期时同样会被恢复。
+    延迟任务放在以执行时间排序的「延迟队列」（有序集合）中，到时间后由 promote 批量移动到「准备执行队列」。
+    失败次数记录在任务内容的头部中，重试和放弃任务时由 Lua 脚本在服务器上修改，放弃的任务放在「死信队列」（列表）中。
+    每个优先级有一个「准备执行队列」，取出时在一个 Lua 脚本中按权重随机选择非空的队列，优先级也记录在头部中，回滚和重试的任务回到原来的优先级。
+    所有队列都为空时，get_task 用 BLPOP 阻塞等待「通知列表」，放进任务的操作会写入通知，所以新任务马上被读取，
+    每个等待中的 get_task 占用连接池中的一个连接
     """
 
-    def __init__(self, name: str, host: str='localhost', port: int=6379, db: int=0):
+    scripts = {
+        'push': PUSH_SCRIPT,
+        'fetch': FETCH_SCRIPT,
+        'ack': ACK_SCRIPT,
+        'renew': RENEW_SCRIPT,
+        'rollback': ROLLBACK_SCRIPT,
+        'restore': RESTORE_SCRIPT,
+        'requeue': REQUEUE_SCRIPT,
+        'promote': PROMOTE_SCRIPT,
+        'retry': RETRY_SCRIPT,
+        'replay': REPLAY_SCRIPT,
+        'purge': PURGE_SCRIPT,
+    }
+
+    def __init__(self, name: str, host: str='localhost', port: int=6379, db: int=0, poll_interval: float=1,
+                 visibility_timeout: Optional[float]=None, prefetch: int=1, serializer=None, priorities: int=1,
+                 priority_weights: Optional[Sequence[float]]=None):
         """
         初始化函数
         :param name: 队列名称
         :param host: 数据库地址
         :param port: 数据库端口
         :param db: 第几个数据库
+        :param poll_interval: 「准备执行队列」为空时阻塞等待新任务的最长时间（秒，向上取整），超时后重新读取
+        :param visibility_timeout: 可见时间（秒），任务取出后超过这个时间没有确认，会被重新放回「准备执行队列」，为空时不限制
+        :param prefetch: 预取个数，一次从数据库中取出多少个任务
+        :param serializer: 任务内容的序列化方式，名字或者实例，见 gearpy.serializer，默认为 JSON
+        :param priorities: 优先级个数，优先级为 0 到 priorities - 1，越大越优先
+        :param priority_weights: 每个优先级的权重，取出任务时非空队列被选中的概率和权重成正比，默认每高一级权重翻倍
         """
         self.name = name
         self.host = host
         self.port = port
         self.db = db
+        self.poll_interval = poll_interval
+        self.visibility_timeout = visibility_timeout
+        self.prefetch = prefetch
+        self.serializer = get_serializer(serializer)
+        self.priorities = priorities
+        self.priority_weights = get_priority_weights(priorities, priority_weights)
+        self.buffer = collections.deque()  # 预取的任务，(可见时间的截止时间, 任务投递)
         self.con = None
+        self.script_hashes = {}  # 已加载的 Lua 脚本的 SHA1
+
+    def __ready_queue(self, priority: int=0):
+        """
+        用 「队列名称:ready」 表示优先级 0 的「准备执行队列」，用 「队列名称:ready:优先级」 表示其他优先级的「准备执行队列」
+        :param priority: 优先级
+        :return:
+        """
+        return '{}:ready'.format(self.name) if priority == 0 else '{}:ready:{}'.format(self.name, priority)
 
     @property
-    def __ready_queue(self):
+    def __ready_queues(self):
         """
-        用 「队列名称:ready」 表示「准备执行队列」
+        所有优先级的「准备执行队列」，从优先级 0 开始
         :return:
         """
-        return '{}:ready'.format(self.name)
+        return [self.__ready_queue(priority) for priority in range(self.priorities)]
 
     @property
     def __working_queue(self):
@@ -83,60 +548,594 @@ class RedisBroker(BasicBroker):
         """
         return '{}:working'.format(self.name)
 
-    async def init_broker(self):
+    @property
+    def __delivery_counter(self):
+        """
+        用 「队列名称:delivery」 储存投递 ID 计数器
+        :return:
+        """
+        return '{}:delivery'.format(self.name)
+
+    @property
+    def __lease_set(self):
+        """
+        用 「队列名称:leases」 表示「租约集合」
+        :return:
+        """
+        return '{}:leases'.format(self.name)
+
+    @property
+    def __notify_list(self):
+        """
+        用 「队列名称:notify」 表示「通知列表」，放进任务时写入通知，get_task 在队列为空时阻塞等待通知
+        :return:
+        """
+        return '{}:notify'.format(self.name)
+
+    @property
+    def __delayed_queue(self):
+        """
+        用 「队列名称:delayed」 表示「延迟队列」
+        :return:
+        """
+        return '{}:delayed'.format(self.name)
+
+    @property
+    def __dead_queue(self):
+        """
+        用 「队列名称:dead」 表示「死信队列」
+        :return:
+        """
+        return '{}:dead'.format(self.name)
+
+    @property
+    def pool_key(self):
+        """
+        用数据库连接地址作为连接池的键，连接同一个数据库的 RedisBroker 共用一个连接池
+        :return:
+        """
+        return 'redis://{}:{}/{}'.format(self.host, self.port, self.db)
+
+    async def create_pool(self, minsize: int=5, maxsize: int=20, **options):
+        """
+        创建数据库连接池
+        :param minsize: 最少连接个数
+        :param maxsize: 最多连接个数
+        :param options: 其他配置，参数见 aioredis.create_pool
+        :return: 连接池
+        """
+        return await aioredis.create_pool(self.pool_key, minsize=minsize, maxsize=maxsize, **options)
+
+    async def init_broker(self, pool=None):
         """
-        初始化函数，用于连接数据库
+        初始化函数，用于连接数据库，重复调用时不会重新连接，连接池被关闭后才重新连接
+        :param pool: 共用的连接池，为空时自己创建
         :return:
         """
+        if self.con is not None and not self.con.closed:
+            return
+
         # 连接数据库
-        self.con = await aioredis.create_pool(
-            'redis://{}:{}/{}'.format(self.host, self.port, self.db),
-            minsize=5, maxsize=10
-        )
+        self.con = pool if pool is not None else await self.create_pool()
+
+        # 预先加载 Lua 脚本，之后只需要发送脚本的 SHA1
+        for name, script in self.scripts.items():
+            self.script_hashes[name] = (await self.con.execute('SCRIPT', 'LOAD', script)).decode()
+
+    async def run_script(self, name, keys, args=()):
+        """
+        执行 Lua 脚本
+        :param name: 脚本名称
+        :param keys: 脚本用到的键
+        :param args: 脚本参数
+        :return: 脚本返回值
+        """
+        try:
+            return await self.con.execute('EVALSHA', self.script_hashes[name], len(keys), *keys, *args)
+        except aioredis.ReplyError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+
+            # 数据库重启后脚本缓存会丢失，直接发送脚本内容，同时重新缓存
+            return await self.con.execute('EVAL', self.scripts[name], len(keys), *keys, *args)
 
-    async def push(self, item):
+    async def push(self, item, eta: Optional[float]=None, priority: int=0):
         """
         把任务放进「准备执行队列」
         :param item: 任务内容
+        :param eta: 任务的执行时间（时间戳），设置时先放进「延迟队列」
+        :param priority: 任务的优先级，越大越优先
         :return:
         """
-        await self.con.execute('LPUSH', self.__ready_queue, json.dumps(item))
+        await self.push_many([item], eta, priority)
 
-    async def delete(self, item, working_queue=False) -> int:
+    async def push_many(self, items, eta: Optional[float]=None, priority: int=0) -> int:
         """
-        从队列中删除任务
+        批量把任务放进「准备执行队列」，在一个 Lua 脚本中插入多个任务并唤醒等待的 get_task，任务顺序和列表顺序一致
+        :param items: 任务内容列表
+        :param eta: 任务的执行时间（时间戳），设置时先放进「延迟队列」
+        :param priority: 任务的优先级，越大越优先
+        :return: 返回插入任务的个数
+        """
+        check_priority(priority, self.priorities)
+        if not items:
+            return 0
+
+        payloads = [encode(item, self.serializer, priority=priority) for item in items]
+        if eta is None:
+            await self.run_script('push', [self.__notify_list, self.__ready_queue(priority)], payloads)
+        else:
+            members = []
+            for member_id, payload in zip(self.__member_ids(len(payloads)), payloads):
+                members.extend([eta, member_id.encode() + b':' + payload])
+            await self.con.execute('ZADD', self.__delayed_queue, *members)
+
+        return len(items)
+
+    @staticmethod
+    def __member_ids(count: int) -> List[str]:
+        """
+        生成「延迟队列」成员的 ID，用于区分内容相同的任务
+        32 位 ID = 16 位微秒时间戳 + 6 位序号 + 10 位随机数，执行时间相同的任务按插入顺序排序
+        :param count: 生成的个数
+        :return: ID 列表
+        """
+        prefix = '{:016d}'.format(int(time.time() * 1000000))
+        return ['{}{:06d}{}'.format(prefix, i % 1000000, uuid.uuid4().hex[:10]) for i in range(count)]
+
+    async def delete(self, item, priority: int=0) -> int:
+        """
+        从「准备执行队列」中删除任务，只能删除没有失败过的任务
         :param item: 任务内容
-        :param working_queue: 如果是 True 的话，从「工作中队列」删除，否则，从「准备执行队列」删除
+        :param priority: 任务的优先级
+        :return: 返回删除任务的个数
+        """
+        payload = encode(item, self.serializer, priority=priority)
+        return await self.con.execute('LREM', self.__ready_queue(priority), 0, payload)  # 删除
+
+    async def ack(self, delivery_id) -> int:
+        """
+        确认任务执行完成，从「工作中队列」删除
+        :param delivery_id: 投递 ID
         :return: 返回删除任务的个数
         """
+        return await self.run_script('ack', [self.__working_queue, self.__lease_set], [delivery_id])
 
-        queue = self.__working_queue if working_queue else self.__ready_queue  # 判断是从哪个队列删除
+    async def renew(self, delivery_id) -> int:
+        """
+        把任务的租约延长一个可见时间
+        :param delivery_id: 投递 ID
+        :return: 任务仍在「工作中队列」中时返回 1，已经因为租约到期被放回时返回 0
+        """
+        if self.visibility_timeout is None:
+            return 1
 
-        return await self.con.execute('LREM', queue, 0, json.dumps(item))  # 删除
+        deadline = time.time() + self.visibility_timeout
+        return await self.run_script('renew', [self.__working_queue, self.__lease_set], [delivery_id, deadline])
 
-    async def rollback(self, item):
+    async def rollback(self, delivery_id) -> int:
         """
-        从「工作中队列」中删除，然后把任务放入「准备执行队列」
+        从「工作中队列」中删除，然后把任务放入「准备执行队列」，在一个 Lua 脚本中原子执行
+        :param delivery_id: 投递 ID
+        :return: 返回回滚任务的个数
+        """
+        return await self.run_script('rollback', [self.__working_queue, self.__lease_set, self.__notify_list, *self.__ready_queues],
+                                     [delivery_id])
+
+    async def restore(self):
+        """
+        恢复机制，用于应用重启时。把「工作中队列」的任务全部放入「准备执行队列」，在一个 Lua 脚本中完成
+        :return: 返回恢复的任务个数
+        """
+        return await self.run_script('restore', [self.__working_queue, self.__lease_set, self.__notify_list, *self.__ready_queues])
+
+    async def retry(self, delivery: Delivery, eta: Optional[float]=None) -> int:
+        """
+        从「工作中队列」中删除，失败次数加一后放回「准备执行队列」，在一个 Lua 脚本中原子执行
+        :param delivery: 任务投递
+        :param eta: 重试的时间（时间戳），设置时先放进「延迟队列」
+        :return: 返回重试任务的个数
+        """
+        keys = [self.__working_queue, self.__lease_set, self.__delayed_queue, self.__dead_queue, self.__notify_list,
+                *self.__ready_queues]
+        if eta is None:
+            return await self.run_script('retry', keys, [delivery.id, 'ready', '', ''])
+        return await self.run_script('retry', keys, [delivery.id, 'delayed', eta, self.__member_ids(1)[0]])
+
+    async def dead(self, delivery: Delivery) -> int:
+        """
+        从「工作中队列」中删除，失败次数加一后放入「死信队列」，在一个 Lua 脚本中原子执行
+        :param delivery: 任务投递
+        :return: 返回放入「死信队列」的任务个数
+        """
+        keys = [self.__working_queue, self.__lease_set, self.__delayed_queue, self.__dead_queue, self.__notify_list,
+                *self.__ready_queues]
+        return await self.run_script('retry', keys, [delivery.id, 'dead', '', ''])
+
+    async def dead_tasks(self, start: int=0, stop: int=-1) -> List[Envelope]:
+        """
+        查看「死信队列」中的任务，最新放入的任务在最前面
+        :param start: 开始位置
+        :param stop: 结束位置（包括），-1 表示到最后
+        :return: 任务内容和失败次数
+        """
+        return [unpack(payload) for payload in await self.con.execute('LRANGE', self.__dead_queue, start, stop)]
+
+    async def replay_dead(self, limit: int=0) -> int:
+        """
+        把「死信队列」中的任务清空失败次数后放回「准备执行队列」，最早放入的任务最先放回
+        :param limit: 最多放回多少个任务，0 表示全部放回
+        :return: 返回放回的任务个数
+        """
+        return await self.run_script('replay', [self.__dead_queue, self.__notify_list, *self.__ready_queues], [limit])
+
+    async def purge_dead(self) -> int:
+        """
+        清空「死信队列」
+        :return: 返回删除的任务个数
+        """
+        return await self.run_script('purge', [self.__dead_queue])
+
+    async def requeue_expired(self, limit: int=1000) -> int:
+        """
+        把租约到期的任务的失败次数加一后放回「准备执行队列」，由 Manager 定期调用，用于恢复崩溃的工作进程中的任务
+        :param limit: 一次最多处理的任务个数
+        :return: 返回放回的任务个数
+        """
+        if self.visibility_timeout is None:
+            return 0
+
+        keys = [self.__working_queue, self.__lease_set, self.__notify_list, *self.__ready_queues]
+        return await self.run_script('requeue', keys, [time.time(), limit])
+
+    async def promote(self, limit: int=1000) -> int:
+        """
+        把「延迟队列」中到时间的任务放进「准备执行队列」
+        :param limit: 一次最多移动的任务个数
+        :return: 返回移动的任务个数
+        """
+        keys = [self.__delayed_queue, self.__notify_list, *self.__ready_queues]
+        return await self.run_script('promote', keys, [time.time(), limit])
+
+    async def release(self) -> int:
+        """
+        把预取在本地缓冲区中的任务回滚到「准备执行队列」
+        :return: 返回回滚的任务个数
+        """
+        count = 0
+        while self.buffer:
+            _, delivery = self.buffer.popleft()
+            count += await self.rollback(delivery.id)
+        return count
+
+    async def get_task(self) -> Delivery:
+        """
+        从「准备执行队列」获取一个任务，然后从队列中删除，同时生成一个投递 ID，以投递 ID 为键放入「工作中队列」。
+        本地缓冲区为空时，一次取出最多 prefetch 个任务，每个任务按权重从非空的优先级队列中选择。
+        在缓冲区中等到可见时间过期的任务可能已经被放回「准备执行队列」，不再执行，直接回滚
+        :return: 任务投递
+        """
+        keys = [self.__working_queue, self.__delivery_counter, self.__lease_set, self.__notify_list,
+                *self.__ready_queues]
+        while True:
+            while self.buffer:
+                deadline, delivery = self.buffer.popleft()
+                if deadline is None or deadline > time.time():
+                    return delivery
+                await self.rollback(delivery.id)
+
+            deadline = None if self.visibility_timeout is None else time.time() + self.visibility_timeout
+            fetched = await self.run_script('fetch', keys, [deadline or '', self.prefetch, random.random(),
+                                                            *self.priority_weights])
+            if fetched:
+                for i in range(0, len(fetched), 2):
+                    envelope = unpack(fetched[i + 1])
+                    self.buffer.append((deadline, Delivery(str(fetched[i]), *envelope)))
+                continue
+
+            await self.__wait_notify()
+
+    async def __wait_notify(self):
+        """
+        Lua 脚本不能阻塞等待，队列为空时用 BLPOP 阻塞等待「通知列表」，有新任务时马上返回。
+        读取和等待之间放进的任务留下的通知不会丢失；超时后也会重新读取，用于兼容不写通知的旧版本和重启后丢失的通知。
+        BLPOP 会占住连接，所以从连接池中单独取出一个连接，等待被取消时关闭这个连接，避免连接池中留下还在阻塞的连接
+        :return:
+        """
+        timeout = max(math.ceil(self.poll_interval), 1)  # Redis 6.0 以前只支持整数秒
+        async with self.con.get() as con:
+            try:
+                await con.execute('BLPOP', self.__notify_list, timeout)
+            except asyncio.CancelledError:
+                con.close()
+                raise
+
+
+class MemoryBroker(BasicBroker):
+    """
+    基于内存的任务储存介质，不需要数据库，用于单机运行和测试
+
+    和 RedisBroker 一样分为每个优先级一个的「准备执行队列」和以投递 ID 为键的「工作中队列」，
+    任务和失败次数、优先级一起以 Python 对象储存，进程退出后任务会丢失
+    """
+
+    def __init__(self, name: str, visibility_timeout: Optional[float]=None, prefetch: int=1, serializer=None,
+                 priorities: int=1, priority_weights: Optional[Sequence[float]]=None):
+        """
+        初始化函数
+        :param name: 队列名称
+        :param visibility_timeout: 可见时间（秒），任务取出后超过这个时间没有确认，会被重新放回「准备执行队列」，为空时不限制
+        :param prefetch: 预取个数，内存中取任务没有网络开销，这个参数只是为了和其他储存介质保持一致
+        :param serializer: 任务直接以 Python 对象储存，不需要序列化，这个参数只是为了和其他储存介质保持一致
+        :param priorities: 优先级个数，优先级为 0 到 priorities - 1，越大越优先
+        :param priority_weights: 每个优先级的权重，取出任务时非空队列被选中的概率和权重成正比，默认每高一级权重翻倍
+        """
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self.prefetch = prefetch
+        self.priorities = priorities
+        self.priority_weights = get_priority_weights(priorities, priority_weights)
+
+        self.ready = [collections.deque() for _ in range(priorities)]  # 每个优先级的「准备执行队列」，从左边插入，从右边取出
+        self.working = {}  # 「工作中队列」，投递 ID: 任务内容和失败次数
+        self.leases = {}  # 「租约」，投递 ID: 到期时间
+        self.delayed = []  # 「延迟队列」，(执行时间, 序号, 任务内容和失败次数) 的堆
+        self.dead_letters = collections.deque()  # 「死信队列」，从左边插入，从右边取出
+        self.sequence = itertools.count()  # 延迟任务的序号，执行时间相同时先插入的任务先执行
+        self.counter = 0  # 投递 ID 计数器
+        self.condition = None  # 「准备执行队列」有新任务时通知等待中的 get_task
+
+    async def init_broker(self, pool=None):
+        """
+        初始化函数，内存储存不需要连接数据库
+        :param pool: 不需要连接池，为了和其他储存介质保持一致
+        :return:
+        """
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+
+    async def __notify(self):
+        """
+        通知等待中的 get_task 有新任务
+        :return:
+        """
+        await self.init_broker()
+        async with self.condition:
+            self.condition.notify_all()
+
+    async def push(self, item, eta: Optional[float]=None, priority: int=0):
+        """
+        把任务放进「准备执行队列」
         :param item: 任务内容
+        :param eta: 任务的执行时间（时间戳），设置时先放进「延迟队列」
+        :param priority: 任务的优先级，越大越优先
         :return:
         """
-        await self.delete(item, working_queue=True)  # 删除任务
-        await self.push(item)  # 插入任务
+        await self.push_many([item], eta, priority)
 
-    async def restore(self):
+    async def push_many(self, items, eta: Optional[float]=None, priority: int=0) -> int:
         """
-        恢复机制，用于应用重启时。把「工作中队列」的任务全部放入「准备执行队列」
+        批量把任务放进「准备执行队列」
+        :param items: 任务内容列表
+        :param eta: 任务的执行时间（时间戳），设置时先放进「延迟队列」
+        :param priority: 任务的优先级，越大越优先
+        :return: 返回插入任务的个数
+        """
+        check_priority(priority, self.priorities)
+        await self.__push([Envelope(item, 0, priority) for item in items], eta)
+        return len(items)
+
+    async def __push(self, envelopes, eta: Optional[float]=None):
+        """
+        把任务内容和失败次数放进「准备执行队列」或者「延迟队列」
+        :param envelopes: 任务内容和失败次数列表
+        :param eta: 任务的执行时间（时间戳）
+        :return:
+        """
+        if eta is None:
+            for envelope in envelopes:
+                self.__ready_queue(envelope).appendleft(envelope)
+        else:
+            for envelope in envelopes:
+                heapq.heappush(self.delayed, (eta, next(self.sequence), envelope))
+
+        await self.__notify()
+
+    def __ready_queue(self, envelope: Envelope) -> collections.deque:
+        """
+        选择任务所在优先级的「准备执行队列」
+        :param envelope: 任务内容和头部信息
+        :return: 「准备执行队列」
+        """
+        return self.ready[min(envelope.priority, self.priorities - 1)]
+
+    def __move_due(self) -> int:
+        """
+        把「延迟队列」中到时间的任务放进「准备执行队列」
+        :return: 返回移动的任务个数
+        """
+        count = 0
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            envelope = heapq.heappop(self.delayed)[-1]
+            self.__ready_queue(envelope).appendleft(envelope)
+            count += 1
+        return count
+
+    async def promote(self) -> int:
+        """
+        把「延迟队列」中到时间的任务放进「准备执行队列」，get_task 等待时也会自动移动
+        :return: 返回移动的任务个数
+        """
+        count = self.__move_due()
+        if count:
+            await self.__notify()
+        return count
+
+    async def delete(self, item, priority: int=0) -> int:
+        """
+        从「准备执行队列」中删除任务
+        :param item: 任务内容
+        :param priority: 任务的优先级
+        :return: 返回删除任务的个数
+        """
+        count = len(self.ready[priority])
+        self.ready[priority] = collections.deque(envelope for envelope in self.ready[priority] if envelope.item != item)
+        return count - len(self.ready[priority])
+
+    async def ack(self, delivery_id) -> int:
+        """
+        确认任务执行完成，从「工作中队列」删除
+        :param delivery_id: 投递 ID
+        :return: 返回删除任务的个数
+        """
+        self.leases.pop(delivery_id, None)
+        return 1 if self.working.pop(delivery_id, None) is not None else 0
+
+    async def renew(self, delivery_id) -> int:
+        """
+        把任务的租约延长一个可见时间
+        :param delivery_id: 投递 ID
+        :return: 任务仍在「工作中队列」中时返回 1，已经因为租约到期被放回时返回 0
+        """
+        if delivery_id not in self.working:
+            return 0
+
+        if self.visibility_timeout is not None:
+            self.leases[delivery_id] = time.time() + self.visibility_timeout
+        return 1
+
+    async def rollback(self, delivery_id) -> int:
+        """
+        从「工作中队列」中删除，然后把任务放入「准备执行队列」
+        :param delivery_id: 投递 ID
+        :return: 返回回滚任务的个数
+        """
+        self.leases.pop(delivery_id, None)
+        if delivery_id not in self.working:
+            return 0
+
+        await self.__push([self.working.pop(delivery_id)])
+        return 1
+
+    async def restore(self) -> int:
+        """
+        恢复机制，把「工作中队列」的任务全部放入「准备执行队列」
         :return: 返回恢复的任务个数
         """
-        while await self.con.execute('LLEN', self.__working_queue) > 0:  # 只要「工作中队列」还有任务就执行，知道队列为空
-            await self.con.execute('BRPOPLPUSH', self.__working_queue, self.__ready_queue, 0)  # 执行一次 rollback 操作
+        count = len(self.working)
+        for envelope in self.working.values():
+            self.__ready_queue(envelope).appendleft(envelope)
+        self.working.clear()
+        self.leases.clear()
+        await self.__notify()
+        return count
+
+    async def retry(self, delivery: Delivery, eta: Optional[float]=None) -> int:
+        """
+        从「工作中队列」中删除，失败次数加一后放回「准备执行队列」
+        :param delivery: 任务投递
+        :param eta: 重试的时间（时间戳），设置时先放进「延迟队列」
+        :return: 返回重试任务的个数
+        """
+        self.leases.pop(delivery.id, None)
+        if delivery.id not in self.working:
+            return 0
 
+        envelope = self.working.pop(delivery.id)
+        await self.__push([envelope._replace(attempts=envelope.attempts + 1)], eta)
         return 1
 
-    async def get_task(self):
+    async def dead(self, delivery: Delivery) -> int:
         """
-        从「准备执行队列」获取一个任务，然后从队列中删除，同时把它插入「工作中队列」
-        :return: 任务内容
+        从「工作中队列」中删除，失败次数加一后放入「死信队列」
+        :param delivery: 任务投递
+        :return: 返回放入「死信队列」的任务个数
+        """
+        self.leases.pop(delivery.id, None)
+        if delivery.id not in self.working:
+            return 0
+
+        envelope = self.working.pop(delivery.id)
+        self.dead_letters.appendleft(envelope._replace(attempts=envelope.attempts + 1))
+        return 1
+
+    async def dead_tasks(self, start: int=0, stop: int=-1) -> List[Envelope]:
         """
-        task = await self.con.execute('BRPOPLPUSH', self.__ready_queue, self.__working_queue, 0)
-        return json.loads(task)
+        查看「死信队列」中的任务，最新放入的任务在最前面
+        :param start: 开始位置
+        :param stop: 结束位置（包括），-1 表示到最后
+        :return: 任务内容和失败次数
+        """
+        return list(self.dead_letters)[start:None if stop == -1 else stop + 1]
+
+    async def replay_dead(self, limit: int=0) -> int:
+        """
+        把「死信队列」中的任务清空失败次数后放回「准备执行队列」，最早放入的任务最先放回
+        :param limit: 最多放回多少个任务，0 表示全部放回
+        :return: 返回放回的任务个数
+        """
+        count = len(self.dead_letters) if limit == 0 else min(limit, len(self.dead_letters))
+        await self.__push([self.dead_letters.pop()._replace(attempts=0) for _ in range(count)])
+        return count
+
+    async def purge_dead(self) -> int:
+        """
+        清空「死信队列」
+        :return: 返回删除的任务个数
+        """
+        count = len(self.dead_letters)
+        self.dead_letters.clear()
+        return count
+
+    async def requeue_expired(self, limit: int=1000) -> int:
+        """
+        把租约到期的任务的失败次数加一后放回「准备执行队列」
+        :param limit: 一次最多处理的任务个数
+        :return: 返回放回的任务个数
+        """
+        if self.visibility_timeout is None:
+            return 0
+
+        now = time.time()
+        expired = [delivery_id for delivery_id, deadline in self.leases.items() if deadline <= now][:limit]
+        envelopes = []
+        for delivery_id in expired:
+            # 和失败一样把失败次数加一，每次都让进程崩溃的任务最终会进入死信队列
+            del self.leases[delivery_id]
+            envelope = self.working.pop(delivery_id)
+            envelopes.append(envelope._replace(attempts=envelope.attempts + 1))
+        await self.__push(envelopes)
+        return len(expired)
+
+    async def get_task(self) -> Delivery:
+        """
+        从「准备执行队列」获取一个任务，然后从队列中删除，同时生成一个投递 ID，以投递 ID 为键放入「工作中队列」。
+        队列为空时等待新任务
+        :return: 任务投递
+        """
+        await self.init_broker()
+        async with self.condition:
+            while not any(self.ready):
+                if self.__move_due():
+                    break
+
+                # 等待新任务，或者等到下一个延迟任务的执行时间
+                timeout = self.delayed[0][0] - time.time() if self.delayed else None
+                try:
+                    await asyncio.wait_for(self.condition.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            # 在非空的队列中按权重随机选择一个
+            queues = [(queue, weight) for queue, weight in zip(self.ready, self.priority_weights) if queue]
+            queue, = random.choices([queue for queue, _ in queues], [weight for _, weight in queues])
+            envelope = queue.pop()
+
+        self.counter += 1
+        delivery_id = str(self.counter)
+        self.working[delivery_id] = envelope
+        if self.visibility_timeout is not None:
+            self.leases[delivery_id] = time.time() + self.visibility_timeout
+
+        return Delivery(delivery_id, *envelope)
@@ -0,0 +1,215 @@
+"""
+这个文件是用来定义 HTTP 响应缓存的
+
+GET 请求成功的响应按「方法 + URL」保存在本地磁盘，同时保存 ETag 和 Last-Modified。
+再次请求同一个 URL 时带上 If-None-Match / If-Modified-Since，服务器返回 304 时直接使用缓存的内容，不重新下载。
+缓存超过 max_size 时删除最久没有使用的响应。offline 模式下完全不请求网络，只从缓存中读取，用于离线调试 handle
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+import uuid
+
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+
+
+class CacheMiss(Exception):
+    """
+    offline 模式下缓存中没有这个请求
+    """
+    pass
+
+
+class CacheEntry(NamedTuple):
+    """
+    缓存的响应
+    """
+    url: str
+    status: int
+    body: bytes
+    encoding: Optional[str] = None  # 响应的编码，响应头中声明的或者从响应内容检测到的
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    stored: float = 0  # 保存的时间（时间戳）
+
+    def validators(self) -> Dict[str, str]:
+        """
+        条件请求的请求头
+        :return:
+        """
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class HttpCache:
+    """
+    磁盘上的 HTTP 响应缓存，每个响应一个文件：第一行是 JSON 格式的元数据，之后是原始的响应内容
+
+    文件按使用时间排序，第一次使用时扫描缓存目录建立索引，之后在内存中维护 LRU 顺序和总大小，
+    命中时更新文件的修改时间，所以重新启动后仍然按使用时间淘汰。文件读写在线程池中执行，不阻塞事件循环。
+    多个进程共用一个缓存目录时，每个进程按自己的索引淘汰，总大小可能暂时超过 max_size
+    """
+
+    def __init__(self, path: str, max_size: int=1024 ** 3, offline: bool=False):
+        """
+        初始化
+        :param path: 缓存目录，不存在时自动创建
+        :param max_size: 缓存的最大字节数
+        :param offline: 是否离线，离线时只从缓存读取，缓存中没有的请求抛出 CacheMiss
+        """
+        self.path = path
+        self.max_size = max_size
+        self.offline = offline
+
+        self.__index: Optional[OrderedDict] = None  # 缓存键: 文件大小，最久没有使用的在最前面
+        self.__size = 0  # 缓存文件的总大小
+
+    @staticmethod
+    def key(method: str, url: str) -> str:
+        """
+        缓存键
+        :param method: HTTP 方法
+        :param url: URL
+        :return:
+        """
+        return hashlib.sha1('{} {}'.format(method.upper(), url).encode()).hexdigest()
+
+    def __file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key)
+
+    def __load_index(self):
+        """
+        扫描缓存目录，按修改时间建立索引
+        :return:
+        """
+        entries = []
+        os.makedirs(self.path, exist_ok=True)
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+            for file in os.scandir(directory.path):
+                if file.is_file() and '.' not in file.name:  # 跳过没写完的临时文件
+                    stat = file.stat()
+                    entries.append((stat.st_mtime, file.name, stat.st_size))
+
+        entries.sort()
+        self.__index = OrderedDict((key, size) for _, key, size in entries)
+        self.__size = sum(size for _, _, size in entries)
+
+    def __read(self, key: str) -> Optional[CacheEntry]:
+        """
+        读取缓存文件，并更新它的修改时间
+        :param key: 缓存键
+        :return: 缓存的响应，文件不存在时为空
+        """
+        try:
+            with open(self.__file(key), 'rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+            os.utime(self.__file(key))
+        except (OSError, ValueError):
+            return None
+
+        return CacheEntry(body=body, **meta)
+
+    def __write(self, key: str, meta: Dict, body: bytes) -> int:
+        """
+        写入缓存文件，先写临时文件再改名，读取时不会读到写了一半的文件
+        :param key: 缓存键
+        :param meta: 元数据
+        :param body: 响应内容
+        :return: 文件大小
+        """
+        file = self.__file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+
+        temp = '{}.{}'.format(file, uuid.uuid4().hex)
+        with open(temp, 'wb') as f:
+            f.write(json.dumps(meta).encode() + b'\n')
+            f.write(body)
+            size = f.tell()
+        os.replace(temp, file)
+        return size
+
+    def __remove(self, key: str):
+        try:
+            os.remove(self.__file(key))
+        except OSError:
+            pass
+
+    async def __run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def get(self, method: str, url: str) -> Optional[CacheEntry]:
+        """
+        读取缓存的响应
+        :param method: HTTP 方法
+        :param url: URL
+        :return: 缓存的响应，没有缓存时为空
+        """
+        if self.__index is None:
+            await self.__run(self.__load_index)
+
+        key = self.key(method, url)
+        if key not in self.__index:
+            return None
+
+        entry = await self.__run(self.__read, key)
+        if entry is None:
+            # 文件被其他进程删除了
+            self.__size -= self.__index.pop(key, 0)
+            return None
+
+        if key in self.__index:
+            self.__index.move_to_end(key)
+        return entry
+
+    async def put(self, method: str, url: str, status: int, body: bytes, encoding: Optional[str]=None,
+                  etag: Optional[str]=None, last_modified: Optional[str]=None):
+        """
+        保存响应，超过最大字节数时删除最久没有使用的响应，比最大字节数还大的响应不保存
+        :param method: HTTP 方法
+        :param url: URL
+        :param status: 状态码
+        :param body: 原始的响应内容
+        :param encoding: 响应的编码，响应头中声明的或者从响应内容检测到的
+        :param etag: ETag 响应头
+        :param last_modified: Last-Modified 响应头
+        :return:
+        """
+        if len(body) > self.max_size:
+            return
+
+        if self.__index is None:
+            await self.__run(self.__load_index)
+
+        key = self.key(method, url)
+        meta = {'url': url, 'status': status, 'encoding': encoding, 'etag': etag, 'last_modified': last_modified,
+                'stored': time.time()}
+        size = await self.__run(self.__write, key, meta, body)
+
+        self.__size += size - self.__index.pop(key, 0)
+        self.__index[key] = size
+
+        while self.__size > self.max_size and self.__index:
+            oldest, oldest_size = self.__index.popitem(last=False)
+            self.__size -= oldest_size
+            await self.__run(self.__remove, oldest)
+
+    @property
+    def size(self) -> int:
+        """
+        缓存文件的总大小，索引还没有建立时为 0
+        :return:
+        """
+        return self.__size
+
+    def __len__(self):
+        return len(self.__index) if self.__index is not None else 0
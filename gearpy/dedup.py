@@ -0,0 +1,432 @@
+"""
+这个文件是用来定义任务去重过滤器的
+
+添加任务前先计算任务内容的指纹，过滤器中已经有这个指纹的任务不会被重复添加。
+设置了有效时间（ttl）时，指纹过期后同样的任务可以再次添加，用于定期重新抓取
+"""
+import abc
+import hashlib
+import json
+import math
+import time
+
+import aioredis
+
+from typing import List, Optional
+
+
+def fingerprint(item) -> str:
+    """
+    默认的任务指纹，按键排序后的 JSON 的 SHA1，键的顺序不同的字典指纹相同
+    :param item: 任务内容
+    :return: 指纹
+    """
+    return hashlib.sha1(json.dumps(item, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def hash_pair(value: str):
+    """
+    把指纹映射成两个 64 位的哈希值，布隆过滤器用 h1 + i * h2 模拟 k 个哈希函数
+    :param value: 指纹
+    :return: (h1, h2)
+    """
+    digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+    return int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+
+
+def bloom_parameters(capacity: int, error_rate: float):
+    """
+    计算布隆过滤器的大小
+    :param capacity: 最多储存多少个指纹
+    :param error_rate: 储存满时的误判率
+    :return: (位数, 哈希函数个数)
+    """
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+class BloomFilter:
+    """
+    固定大小的布隆过滤器，储存满后误判率会上升
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        """
+        初始化
+        :param capacity: 最多储存多少个指纹
+        :param error_rate: 储存满时的误判率
+        """
+        self.capacity = capacity
+        self.size, self.hashes = bloom_parameters(capacity, error_rate)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __positions(self, value: str):
+        """
+        计算指纹对应的位
+        :param value: 指纹
+        :return: 位的列表
+        """
+        h1, h2 = hash_pair(value)
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, value: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(value))
+
+    def add(self, value: str):
+        """
+        添加一个指纹
+        :param value: 指纹
+        :return:
+        """
+        for position in self.__positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+
+class ScalableBloomFilter:
+    """
+    可扩展的布隆过滤器，当前的布隆过滤器储存满时，添加一个容量更大、误判率更低的布隆过滤器，
+    总的误判率不超过 error_rate / (1 - tightening)，不需要预先知道任务个数
+    """
+
+    def __init__(self, capacity: int=100000, error_rate: float=0.001, growth: int=2, tightening: float=0.5):
+        """
+        初始化
+        :param capacity: 第一个布隆过滤器的容量
+        :param error_rate: 第一个布隆过滤器的误判率
+        :param growth: 每个新的布隆过滤器的容量倍数
+        :param tightening: 每个新的布隆过滤器的误判率倍数
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.filters: List[BloomFilter] = []
+
+    def __contains__(self, value: str) -> bool:
+        return any(value in bloom for bloom in self.filters)
+
+    def __len__(self):
+        return sum(bloom.count for bloom in self.filters)
+
+    def add(self, value: str):
+        """
+        添加一个指纹
+        :param value: 指纹
+        :return:
+        """
+        if not self.filters or self.filters[-1].count >= self.filters[-1].capacity:
+            level = len(self.filters)
+            self.filters.append(BloomFilter(
+                self.capacity * self.growth ** level, self.error_rate * self.tightening ** level
+            ))
+        self.filters[-1].add(value)
+
+
+class BasicFilter:
+    """
+    去重过滤器的抽象类
+    """
+    __metaclass__ = abc.ABCMeta
+
+    @property
+    def pool_key(self):
+        """
+        连接池的键，和储存介质的连接池键相同时共用 Manager 创建的连接池，为空时表示不需要连接池
+        :return:
+        """
+        return None
+
+    async def create_pool(self, **options):
+        """
+        创建连接池
+        :param options: 连接池配置
+        :return: 连接池
+        """
+        return None
+
+    async def init_filter(self, name: str, pool=None):
+        """
+        初始化函数
+        :param name: 任务类型，用于区分不同任务类型的指纹
+        :param pool: 共用的连接池，为空时自己创建
+        :return:
+        """
+        pass
+
+    @abc.abstractmethod
+    async def add_many(self, fingerprints: List[str]) -> List[bool]:
+        """
+        批量添加指纹，同一批中重复的指纹只有第一个算作新的
+        :param fingerprints: 指纹列表
+        :return: 每个指纹之前是否不存在，不存在的任务才需要添加
+        """
+        pass
+
+    async def add(self, value: str) -> bool:
+        """
+        添加一个指纹
+        :param value: 指纹
+        :return: 指纹之前是否不存在
+        """
+        return (await self.add_many([value]))[0]
+
+
+class MemoryFilter(BasicFilter):
+    """
+    基于内存中可扩展布隆过滤器的去重过滤器，用于单机运行，有很小的概率把新任务误判为重复任务
+
+    设置了有效时间时，指纹按时间分成两代，每隔 ttl 秒丢弃上一代，所以指纹在 ttl 到 2 * ttl 秒后过期
+    """
+
+    def __init__(self, ttl: Optional[float]=None, capacity: int=100000, error_rate: float=0.001):
+        """
+        初始化
+        :param ttl: 指纹的有效时间（秒），为空时永不过期
+        :param capacity: 布隆过滤器的初始容量，超过时自动扩展
+        :param error_rate: 误判率
+        """
+        self.ttl = ttl
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        self.current = ScalableBloomFilter(capacity, error_rate)  # 这一代的指纹
+        self.previous = None  # 上一代的指纹
+        self.rotated = time.time()  # 这一代开始的时间
+
+    def __rotate(self):
+        """
+        到时间时开始新的一代，丢弃上一代的指纹
+        :return:
+        """
+        if self.ttl is None:
+            return
+
+        now = time.time()
+        if now - self.rotated >= 2 * self.ttl:
+            self.previous = None  # 很久没有添加任务，两代都已经过期
+            self.current = ScalableBloomFilter(self.capacity, self.error_rate)
+            self.rotated = now
+        elif now - self.rotated >= self.ttl:
+            self.previous = self.current
+            self.current = ScalableBloomFilter(self.capacity, self.error_rate)
+            self.rotated = now
+
+    async def add_many(self, fingerprints: List[str]) -> List[bool]:
+        """
+        批量添加指纹
+        :param fingerprints: 指纹列表
+        :return: 每个指纹之前是否不存在
+        """
+        self.__rotate()
+
+        added = []
+        for value in fingerprints:
+            exists = value in self.current or (self.previous is not None and value in self.previous)
+            if not exists:
+                self.current.add(value)
+            added.append(not exists)
+        return added
+
+
+# 添加指纹：KEYS = [指纹集合]，ARGV = [有效时间，0 表示不过期, 指纹, 指纹, ...]
+# 不过期时所有指纹放在一个集合中，否则每个指纹是一个带有效时间的键。返回 {是否新指纹, ...}
+SET_ADD_SCRIPT = """
+local ttl = tonumber(ARGV[1])
+local added = {}
+for i = 2, #ARGV do
+    if ttl == 0 then
+        added[#added + 1] = redis.call('SADD', KEYS[1], ARGV[i])
+    elseif redis.call('SET', KEYS[1] .. ':' .. ARGV[i], 1, 'NX', 'EX', ttl) then
+        added[#added + 1] = 1
+    else
+        added[#added + 1] = 0
+    end
+end
+return added
+"""
+
+# 添加指纹到布隆过滤器：KEYS = [这一代的位图, 上一代的位图]，ARGV = [哈希函数个数, 位图过期时间，0 表示不过期, 位, 位, ...]
+# 每个指纹对应连续的 k 个位，所有位都已设置时是重复的指纹。返回 {是否新指纹, ...}
+BLOOM_ADD_SCRIPT = """
+local hashes = tonumber(ARGV[1])
+local added = {}
+for i = 3, #ARGV, hashes do
+    local current, previous = true, KEYS[2] ~= ''
+    for j = i, i + hashes - 1 do
+        current = current and redis.call('GETBIT', KEYS[1], ARGV[j]) == 1
+        previous = previous and redis.call('GETBIT', KEYS[2], ARGV[j]) == 1
+    end
+    if current or previous then
+        added[#added + 1] = 0
+    else
+        for j = i, i + hashes - 1 do
+            redis.call('SETBIT', KEYS[1], ARGV[j], 1)
+        end
+        added[#added + 1] = 1
+    end
+end
+if ARGV[2] ~= '0' then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return added
+"""
+
+
+class RedisFilter(BasicFilter):
+    """
+    基于 Redis 的去重过滤器，多个工作进程共用，可以和 RedisBroker 共用连接池
+    """
+
+    scripts = {}
+
+    def __init__(self, host: str='localhost', port: int=6379, db: int=0, ttl: Optional[float]=None,
+                 key: Optional[str]=None):
+        """
+        初始化
+        :param host: 数据库地址
+        :param port: 数据库端口
+        :param db: 第几个数据库
+        :param ttl: 指纹的有效时间（秒），为空时永不过期
+        :param key: 储存指纹的键，为空时使用「任务类型:dedup」
+        """
+        self.host = host
+        self.port = port
+        self.db = db
+        self.ttl = ttl
+        self.key = key
+        self.con = None
+        self.script_hashes = {}  # 已加载的 Lua 脚本的 SHA1
+
+    @property
+    def pool_key(self):
+        """
+        用数据库连接地址作为连接池的键，和连接同一个数据库的 RedisBroker 共用一个连接池
+        :return:
+        """
+        return 'redis://{}:{}/{}'.format(self.host, self.port, self.db)
+
+    async def create_pool(self, minsize: int=1, maxsize: int=5, **options):
+        """
+        创建数据库连接池
+        :param minsize: 最少连接个数
+        :param maxsize: 最多连接个数
+        :param options: 其他配置，参数见 aioredis.create_pool
+        :return: 连接池
+        """
+        return await aioredis.create_pool(self.pool_key, minsize=minsize, maxsize=maxsize, **options)
+
+    async def init_filter(self, name: str, pool=None):
+        """
+        初始化函数，用于连接数据库，重复调用时不会重新连接，连接池被关闭后才重新连接
+        :param name: 任务类型
+        :param pool: 共用的连接池，为空时自己创建
+        :return:
+        """
+        if self.con is not None and not self.con.closed:
+            return
+
+        if self.key is None:
+            self.key = '{}:dedup'.format(name)
+        self.con = pool if pool is not None else await self.create_pool()
+
+        for script_name, script in self.scripts.items():
+            self.script_hashes[script_name] = (await self.con.execute('SCRIPT', 'LOAD', script)).decode()
+
+    async def run_script(self, name, keys, args=()):
+        """
+        执行 Lua 脚本
+        :param name: 脚本名称
+        :param keys: 脚本用到的键
+        :param args: 脚本参数
+        :return: 脚本返回值
+        """
+        try:
+            return await self.con.execute('EVALSHA', self.script_hashes[name], len(keys), *keys, *args)
+        except aioredis.ReplyError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+
+            # 数据库重启后脚本缓存会丢失，直接发送脚本内容
+            return await self.con.execute('EVAL', self.scripts[name], len(keys), *keys, *args)
+
+
+class RedisSetFilter(RedisFilter):
+    """
+    基于 Redis 集合的去重过滤器，没有误判，每个指纹占用几十字节
+
+    不过期时所有指纹放在「键」集合中，设置了有效时间时每个指纹是一个「键:指纹」的键，用 SET NX EX 添加，到期由 Redis 自动删除
+    """
+
+    scripts = {'add': SET_ADD_SCRIPT}
+
+    async def add_many(self, fingerprints: List[str]) -> List[bool]:
+        """
+        批量添加指纹，在一个 Lua 脚本中完成
+        :param fingerprints: 指纹列表
+        :return: 每个指纹之前是否不存在
+        """
+        if not fingerprints:
+            return []
+
+        ttl = 0 if self.ttl is None else max(math.ceil(self.ttl), 1)
+        return [bool(added) for added in await self.run_script('add', [self.key], [ttl, *fingerprints])]
+
+
+class RedisBloomFilter(RedisFilter):
+    """
+    基于 Redis 位图的布隆过滤器，每个指纹只占用十几个位，有很小的概率把新任务误判为重复任务
+
+    容量固定，超过容量后误判率会上升。设置了有效时间时，位图按时间分成「键:代数」的多代，
+    同时检查这一代和上一代，每一代在 2 * ttl 秒后由 Redis 自动删除，所以指纹在 ttl 到 2 * ttl 秒后过期
+    """
+
+    scripts = {'add': BLOOM_ADD_SCRIPT}
+
+    def __init__(self, host: str='localhost', port: int=6379, db: int=0, ttl: Optional[float]=None,
+                 key: Optional[str]=None, capacity: int=10000000, error_rate: float=0.001):
+        """
+        初始化
+        :param host: 数据库地址
+        :param port: 数据库端口
+        :param db: 第几个数据库
+        :param ttl: 指纹的有效时间（秒），为空时永不过期
+        :param key: 储存指纹的键，为空时使用「任务类型:dedup」
+        :param capacity: 每一代最多储存多少个指纹，位图的大小为 capacity * 1.44 * log2(1 / error_rate) 位
+        :param error_rate: 储存满时的误判率
+        """
+        super().__init__(host, port, db, ttl, key)
+        self.size, self.hashes = bloom_parameters(capacity, error_rate)
+        if self.size > 2 ** 32:
+            raise ValueError('bloom filter is larger than the 512MB Redis string limit')
+
+    def __keys(self) -> List[str]:
+        """
+        这一代和上一代位图的键
+        :return: [这一代, 上一代]，不过期时上一代为空字符串
+        """
+        if self.ttl is None:
+            return [self.key, '']
+
+        generation = int(time.time() // self.ttl)
+        return ['{}:{}'.format(self.key, generation), '{}:{}'.format(self.key, generation - 1)]
+
+    async def add_many(self, fingerprints: List[str]) -> List[bool]:
+        """
+        批量添加指纹，在一个 Lua 脚本中完成，指纹对应的位在客户端计算
+        :param fingerprints: 指纹列表
+        :return: 每个指纹之前是否不存在
+        """
+        if not fingerprints:
+            return []
+
+        positions = []
+        for value in fingerprints:
+            h1, h2 = hash_pair(value)
+            positions.extend((h1 + i * h2) % self.size for i in range(self.hashes))
+
+        expire = 0 if self.ttl is None else max(math.ceil(2 * self.ttl), 1)
+        added = await self.run_script('add', self.__keys(), [self.hashes, expire, *positions])
+        return [bool(value) for value in added]
@@ -0,0 +1,186 @@
+"""
+这个文件是用来定义声明式的数据提取的
+
+    class Comment(Item):
+        root = '//*[@id="comments"]/div[@class="comment-item"]'  # 每条记录的节点
+
+        user_name = Field('.//span[@class="comment-info"]/a/text()')
+        votes = Field('.//span[@class="votes"]/text()', type=int, default=0)
+        star = Field('.//span[contains(@class, "rating")]/@class', pattern=r'allstar(\\d)', type=int, default=0)
+
+    Comment.extract(tree)  # [{'user_name': ..., 'votes': ..., 'star': ...}, ...]
+
+选择器在定义 Item 时编译成 etree.XPath，之后每次提取都直接执行，不需要重新编译表达式。
+CSS 选择器需要安装 cssselect，同样在定义时翻译成 XPath
+"""
+import inspect
+import re
+
+from typing import Any, Callable, Dict, Optional
+
+from lxml import etree
+
+MISSING = object()  # 没有提取到值的标记
+
+
+def compile_selector(xpath: Optional[str]=None, css: Optional[str]=None) -> etree.XPath:
+    """
+    编译选择器，xpath 和 css 只能设置一个，都为空时选择节点本身
+    :param xpath: XPath 表达式
+    :param css: CSS 选择器，需要 cssselect
+    :return: 编译好的 XPath
+    """
+    if xpath is not None and css is not None:
+        raise ValueError('set either xpath or css, not both')
+
+    if css is not None:
+        try:
+            from cssselect import GenericTranslator
+        except ImportError:
+            raise ImportError('css selectors require cssselect, install it with `pip install cssselect`')
+        xpath = GenericTranslator().css_to_xpath(css, prefix='descendant-or-self::')
+
+    # smart_strings=False 时字符串结果不保留到节点的引用，更快，也可以被 pickle
+    return etree.XPath(xpath if xpath is not None else '.', smart_strings=False)
+
+
+class Field:
+    """
+    Item 的一个字段
+
+    选择器的每个结果依次：节点取属性 attr 或全部文本（type 为 Item 子类时按这个 Item 提取），去掉首尾空白，
+    用 pattern 匹配（有分组时取第一个分组），用 type 转换。匹配不到或转换出错的结果被忽略。
+    many 为 False 时取第一个结果，没有结果时为 default；many 为 True 时取所有结果的列表
+    """
+
+    def __init__(self, xpath: Optional[str]=None, css: Optional[str]=None, attr: Optional[str]=None,
+                 type: Optional[Callable[[Any], Any]]=None, pattern: Optional[str]=None, many: bool=False,
+                 default: Any=None, strip: bool=True):
+        """
+        初始化
+        :param xpath: 相对于记录节点的 XPath 表达式，比如 './/a/@href'
+        :param css: CSS 选择器，和 xpath 只能设置一个
+        :param attr: 结果是节点时取这个属性，为空时取节点的全部文本
+        :param type: 类型转换函数，比如 int，也可以是 Item 子类，表示嵌套的记录
+        :param pattern: 正则表达式，只保留匹配的部分
+        :param many: 是否取所有结果
+        :param default: 没有结果时的值
+        :param strip: 是否去掉字符串首尾的空白
+        """
+        self.selector = compile_selector(xpath, css)
+        self.attr = attr
+        self.type = type
+        self.pattern = re.compile(pattern) if pattern is not None else None
+        self.many = many
+        self.default = default
+        self.strip = strip
+
+        self.item = type if inspect.isclass(type) and issubclass(type, Item) else None  # 嵌套的记录结构
+
+    def convert(self, value) -> Any:
+        """
+        转换选择器的一个结果
+        :param value: 节点、字符串或数字
+        :return: 转换后的值，没有值时为 MISSING
+        """
+        if isinstance(value, etree._Element):
+            if self.item is not None:
+                return self.item.extract_one(value)
+            value = value.get(self.attr) if self.attr is not None else ''.join(value.itertext())
+            if value is None:
+                return MISSING
+
+        if isinstance(value, str):
+            if self.strip:
+                value = value.strip()
+            if self.pattern is not None:
+                match = self.pattern.search(value)
+                if match is None:
+                    return MISSING
+                value = match.group(1) if match.re.groups else match.group(0)
+
+        if self.type is not None:
+            try:
+                value = self.type(value)
+            except (TypeError, ValueError):
+                return MISSING
+
+        return value
+
+    def extract(self, node) -> Any:
+        """
+        从一个节点中提取这个字段
+        :param node: lxml 节点
+        :return:
+        """
+        results = self.selector(node)
+        if not isinstance(results, list):
+            results = [results]  # count()、string() 等表达式返回单个值
+
+        if self.many:
+            values = []
+            for result in results:
+                value = self.convert(result)
+                if value is not MISSING:
+                    values.append(value)
+            return values
+
+        for result in results:
+            value = self.convert(result)
+            if value is not MISSING:
+                return value
+        return self.default
+
+
+class Item:
+    """
+    声明式的记录结构，类属性中的 Field 是记录的字段，定义子类时收集字段、编译选择器
+
+    root 或 root_css 是每条记录的节点的选择器，设置时 extract 返回记录列表，为空时把整个文档作为一条记录
+    """
+
+    root: Optional[str] = None  # 记录节点的 XPath 表达式
+    root_css: Optional[str] = None  # 记录节点的 CSS 选择器
+
+    fields: Dict[str, Field] = {}  # 字段名: 字段，包括父类的字段
+    root_selector: Optional[etree.XPath] = None  # 编译好的记录节点选择器
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        fields = {}
+        for klass in reversed(cls.__mro__):
+            for name, value in vars(klass).items():
+                if isinstance(value, Field):
+                    fields[name] = value
+        cls.fields = fields
+
+        if cls.root is not None or cls.root_css is not None:
+            cls.root_selector = compile_selector(cls.root, cls.root_css)
+        else:
+            cls.root_selector = None
+
+    @classmethod
+    def extract_one(cls, node) -> Dict[str, Any]:
+        """
+        从一个记录节点中提取一条记录
+        :param node: lxml 节点
+        :return: 字段名: 值
+        """
+        return {name: field.extract(node) for name, field in cls.fields.items()}
+
+    @classmethod
+    def extract(cls, node):
+        """
+        从文档中提取记录
+        :param node: lxml 根节点，比如 Task.tree 或者 Task.parse 的结果
+        :return: 设置了 root 时为记录列表，否则为一条记录
+        """
+        if node is None:
+            return [] if cls.root_selector is not None else cls.extract_one(etree.Element('empty'))
+
+        if cls.root_selector is None:
+            return cls.extract_one(node)
+
+        extract_one = cls.extract_one
+        return [extract_one(record) for record in cls.root_selector(node)]
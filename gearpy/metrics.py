@@ -0,0 +1,303 @@
+"""
+这个文件是用来定义运行指标的输出方式的
+
+Manager 在任务的各个阶段记录计数器（inc）、直方图（observe）和仪表（set），交给 MetricsSink 输出。
+没有设置 MetricsSink 时 Manager 不会计算任何指标
+"""
+import abc
+import asyncio
+import bisect
+import json
+import logging
+import time
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# 内置的指标：名字: (类型, 说明)
+METRICS = {
+    'gearpy_queue_wait_seconds': ('histogram', 'Time from dispatch to the start of the HTTP request, '
+                                               'including waiting for a proxy and for the host scheduler'),
+    'gearpy_fetch_seconds': ('histogram', 'Time spent in Task.on_task'),
+    'gearpy_extract_seconds': ('histogram', 'Time spent in Task.extract, including executor overhead'),
+    'gearpy_handle_seconds': ('histogram', 'Time spent in Task.handle'),
+    'gearpy_tasks_total': ('counter', 'Finished deliveries by outcome (success, failure, retry, dead)'),
+    'gearpy_in_flight': ('gauge', 'Tasks currently being executed'),
+    'gearpy_broker_seconds': ('histogram', 'Broker round trip latency by operation'),
+    'gearpy_proxy_total': ('counter', 'Proxy uses by outcome (success, failure, released)'),
+}
+
+# 直方图默认的分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class MetricsSink:
+    """
+    指标输出方式的抽象类
+    """
+    __metaclass__ = abc.ABCMeta
+
+    async def start(self):
+        """
+        开始输出，Manager.serve 时调用
+        :return:
+        """
+        pass
+
+    async def close(self):
+        """
+        停止输出，Manager.close 时调用
+        :return:
+        """
+        pass
+
+    def set_worker(self, worker: int):
+        """
+        多进程运行时，在工作进程中启动 Manager 前调用，每个工作进程有自己的指标，需要分开输出时使用
+        :param worker: 工作进程序号，从 0 开始
+        :return:
+        """
+        pass
+
+    @abc.abstractmethod
+    def inc(self, name: str, value: float=1, **labels):
+        """
+        增加计数器
+        :param name: 指标名字
+        :param value: 增加的值
+        :param labels: 标签
+        :return:
+        """
+        pass
+
+    @abc.abstractmethod
+    def observe(self, name: str, value: float, **labels):
+        """
+        记录直方图的一个观测值
+        :param name: 指标名字
+        :param value: 观测值
+        :param labels: 标签
+        :return:
+        """
+        pass
+
+    @abc.abstractmethod
+    def set(self, name: str, value: float, **labels):
+        """
+        设置仪表的值
+        :param name: 指标名字
+        :param value: 当前值
+        :param labels: 标签
+        :return:
+        """
+        pass
+
+
+class PrometheusSink(MetricsSink):
+    """
+    在内存中汇总指标，通过本地 HTTP 端口以 Prometheus 文本格式输出，任何路径的 GET 请求都返回所有指标
+    """
+
+    def __init__(self, host: str='127.0.0.1', port: int=9100, buckets: Sequence[float]=DEFAULT_BUCKETS):
+        """
+        初始化
+        :param host: 监听地址
+        :param port: 监听端口，为 0 时只汇总不监听，可以自己调用 render 输出。
+                     多进程运行时每个工作进程的指标分开汇总，第 n 个工作进程监听 port + n
+        :param buckets: 直方图的分桶上限（秒）
+        """
+        self.host = host
+        self.port = port
+        self.worker = 0  # 工作进程序号
+        self.buckets = sorted(buckets)
+
+        self.counters: Dict[Tuple, float] = {}  # (名字, 标签): 值
+        self.gauges: Dict[Tuple, float] = {}  # (名字, 标签): 值
+        self.histograms: Dict[Tuple, List] = {}  # (名字, 标签): [每个分桶的个数..., 总和, 个数]
+        self.server = None
+
+    def inc(self, name: str, value: float=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            histogram[index] += 1  # 只记录所在的分桶，输出时再累加
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def set(self, name: str, value: float, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    @staticmethod
+    def __labels(labels, extra=()) -> str:
+        """
+        格式化标签
+        :param labels: 标签
+        :param extra: 额外的标签
+        :return: {key="value",...}
+        """
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        return '{' + ','.join('{}="{}"'.format(key, escape(value)) for key, value in pairs) + '}'
+
+    def render(self) -> str:
+        """
+        以 Prometheus 文本格式输出所有指标
+        :return:
+        """
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in METRICS:
+                    lines.append('# HELP {} {}'.format(name, METRICS[name][1]))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), value in sorted(self.counters.items()):
+            describe(name, 'counter')
+            lines.append('{}{} {}'.format(name, self.__labels(labels), value))
+
+        for (name, labels), value in sorted(self.gauges.items()):
+            describe(name, 'gauge')
+            lines.append('{}{} {}'.format(name, self.__labels(labels), value))
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            describe(name, 'histogram')
+            count = 0
+            for bucket, bucket_count in zip(self.buckets, histogram):
+                count += bucket_count
+                lines.append('{}_bucket{} {}'.format(name, self.__labels(labels, [('le', bucket)]), count))
+            lines.append('{}_bucket{} {}'.format(name, self.__labels(labels, [('le', '+Inf')]), histogram[-1]))
+            lines.append('{}_sum{} {}'.format(name, self.__labels(labels), histogram[-2]))
+            lines.append('{}_count{} {}'.format(name, self.__labels(labels), histogram[-1]))
+
+        return '\n'.join(lines) + '\n'
+
+    async def __handle(self, reader, writer):
+        """
+        处理一个 HTTP 请求，读取请求头后返回所有指标
+        :param reader:
+        :param writer:
+        :return:
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line or line in (b'\r\n', b'\n'):
+                    break
+
+            body = self.render().encode()
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                         b'Connection: close\r\n\r\n' + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def set_worker(self, worker: int):
+        self.worker = worker
+
+    async def start(self):
+        """
+        开始监听 HTTP 端口，重复调用时只监听一次，多进程运行时每个工作进程监听不同的端口
+        :return:
+        """
+        if self.port and self.server is None:
+            self.server = await asyncio.start_server(self.__handle, self.host, self.port + self.worker)
+
+    async def close(self):
+        """
+        停止监听
+        :return:
+        """
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+class LogSink(MetricsSink):
+    """
+    把每个指标事件作为一行 JSON 写入日志，用于接入日志系统，日志级别关闭时几乎没有开销
+    """
+
+    def __init__(self, logger: Optional[logging.Logger]=None, level: int=logging.INFO):
+        """
+        初始化
+        :param logger: 日志记录器，默认为 gearpy.metrics
+        :param level: 日志级别
+        """
+        self.logger = logger or logging.getLogger('gearpy.metrics')
+        self.level = level
+
+    def __log(self, kind, name, value, labels):
+        """
+        写入一条指标日志
+        :param kind: 指标类型
+        :param name: 指标名字
+        :param value: 值
+        :param labels: 标签
+        :return:
+        """
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, json.dumps(dict(labels, metric=name, type=kind, value=value, time=time.time())))
+
+    def inc(self, name: str, value: float=1, **labels):
+        self.__log('counter', name, value, labels)
+
+    def observe(self, name: str, value: float, **labels):
+        self.__log('histogram', name, value, labels)
+
+    def set(self, name: str, value: float, **labels):
+        self.__log('gauge', name, value, labels)
+
+
+class MultiSink(MetricsSink):
+    """
+    同时输出到多个 MetricsSink
+    """
+
+    def __init__(self, *sinks: MetricsSink):
+        """
+        初始化
+        :param sinks: 输出方式
+        """
+        self.sinks = sinks
+
+    async def start(self):
+        for sink in self.sinks:
+            await sink.start()
+
+    async def close(self):
+        for sink in self.sinks:
+            await sink.close()
+
+    def set_worker(self, worker: int):
+        for sink in self.sinks:
+            sink.set_worker(worker)
+
+    def inc(self, name: str, value: float=1, **labels):
+        for sink in self.sinks:
+            sink.inc(name, value, **labels)
+
+    def observe(self, name: str, value: float, **labels):
+        for sink in self.sinks:
+            sink.observe(name, value, **labels)
+
+    def set(self, name: str, value: float, **labels):
+        for sink in self.sinks:
+            sink.set(name, value, **labels)
@@ -0,0 +1,267 @@
+"""
+这个文件是用来定义抓取结果的处理管道的
+
+任务在 handle 中用 emit 输出记录，任务成功后 Manager 把记录放进 Pipeline 的有界队列，
+后台的写入循环按批次大小和时间攒成一批，去重后交给 ItemSink 批量写入，数据库延迟不再占用任务的执行名额。
+队列满时放入记录的任务会等待，所以写入跟不上时抓取速度会自动慢下来。关闭 Manager 时写完队列中剩余的记录
+"""
+import abc
+import asyncio
+import inspect
+import json
+
+from typing import Any, Callable, List, Optional
+
+from gearpy.dedup import BasicFilter, fingerprint as default_fingerprint
+from gearpy.retry import RetryPolicy
+
+
+class ItemSink:
+    """
+    记录写入方式的抽象类
+    """
+    __metaclass__ = abc.ABCMeta
+
+    async def open(self):
+        """
+        开始写入前调用，比如打开文件或者连接数据库
+        :return:
+        """
+        pass
+
+    @abc.abstractmethod
+    async def write(self, items: List):
+        """
+        批量写入一批记录，抛出异常时这一批按 Pipeline 的重试策略重试
+        :param items: 记录列表
+        :return:
+        """
+        pass
+
+    async def close(self):
+        """
+        所有记录写完后调用
+        :return:
+        """
+        pass
+
+
+class JsonLinesSink(ItemSink):
+    """
+    把记录追加到 JSON Lines 文件，每行一条记录，文件写入在线程池中执行，不阻塞事件循环
+    """
+
+    def __init__(self, path: str, encoding: str='utf-8', ensure_ascii: bool=False):
+        """
+        初始化
+        :param path: 文件路径
+        :param encoding: 文件编码
+        :param ensure_ascii: 是否把非 ASCII 字符转义
+        """
+        self.path = path
+        self.encoding = encoding
+        self.ensure_ascii = ensure_ascii
+        self.file = None
+
+    async def open(self):
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding=self.encoding)
+
+    def __write(self, lines: str):
+        self.file.write(lines)
+        self.file.flush()
+
+    async def write(self, items: List):
+        lines = ''.join(json.dumps(item, ensure_ascii=self.ensure_ascii, default=str) + '\n' for item in items)
+        await asyncio.get_event_loop().run_in_executor(None, self.__write, lines)
+
+    async def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class CallableSink(ItemSink):
+    """
+    用一个函数批量写入记录，比如 collection.insert_many，函数可以是普通函数或者协程函数
+    """
+
+    def __init__(self, func: Callable[[List], Any]):
+        """
+        初始化
+        :param func: 参数为记录列表的函数
+        """
+        self.func = func
+
+    async def write(self, items: List):
+        ret = self.func(items)
+        if inspect.isawaitable(ret):
+            await ret
+
+
+class Pipeline:
+    """
+    记录处理管道：有界队列 + 批量写入
+
+    写入循环凑够 batch_size 条记录，或者第一条记录等待超过 flush_interval 秒时写入一批。
+    设置了去重过滤器时，写入前过滤掉指纹重复的记录。写入失败时按重试策略重试，不再重试的批次打印后丢弃。
+    一个 Pipeline 可以被多种任务类型共用
+    """
+
+    def __init__(self, sink: ItemSink, batch_size: int=100, flush_interval: float=1, max_queue: int=1000,
+                 concurrency: int=1, dedup: Optional[BasicFilter]=None,
+                 fingerprint: Optional[Callable[[Any], str]]=None, retry: Optional[RetryPolicy]=None,
+                 name: str='pipeline'):
+        """
+        初始化
+        :param sink: 写入方式
+        :param batch_size: 每批最多写入多少条记录
+        :param flush_interval: 一批记录最长的等待时间（秒）
+        :param max_queue: 队列最多容纳多少条记录，满时放入记录的任务等待
+        :param concurrency: 同时写入的批次个数
+        :param dedup: 去重过滤器，见 gearpy.dedup
+        :param fingerprint: 计算记录指纹的函数，默认为按键排序后的 JSON 的 SHA1
+        :param retry: 写入失败时的重试策略，为空时不重试
+        :param name: 名字，用于区分去重过滤器的指纹
+        """
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.concurrency = concurrency
+        self.dedup = dedup
+        self.fingerprint = fingerprint or default_fingerprint
+        self.retry = retry
+        self.name = name
+
+        self.queue: Optional[asyncio.Queue] = None
+        self.writers: List[asyncio.Future] = []  # 写入循环
+        self.written = 0  # 写入的记录个数
+        self.duplicated = 0  # 被去重过滤掉的记录个数
+        self.dropped = 0  # 写入失败被丢弃的记录个数
+
+    @property
+    def started(self) -> bool:
+        return self.queue is not None
+
+    async def start(self, pool=None):
+        """
+        打开写入方式，启动写入循环，重复调用时只启动一次
+        :param pool: 去重过滤器共用的连接池，为空时自己创建
+        :return:
+        """
+        if self.started:
+            return
+
+        self.queue = asyncio.Queue(self.max_queue)
+        if self.dedup is not None:
+            await self.dedup.init_filter(self.name, pool)
+        await self.sink.open()
+        self.writers = [asyncio.ensure_future(self.__write_loop()) for _ in range(self.concurrency)]
+
+    async def put(self, item):
+        """
+        放入一条记录，队列满时等待
+        :param item: 记录
+        :return:
+        """
+        if not self.started:
+            await self.start()
+        await self.queue.put(item)
+
+    async def put_many(self, items):
+        """
+        放入多条记录，队列满时等待
+        :param items: 记录列表
+        :return:
+        """
+        for item in items:
+            await self.put(item)
+
+    async def __next_batch(self) -> List:
+        """
+        从队列中取出一批记录
+        :return:
+        """
+        loop = asyncio.get_event_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.flush_interval
+
+        while len(batch) < self.batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def __write_loop(self):
+        """
+        写入循环
+        :return:
+        """
+        while True:
+            batch = await self.__next_batch()
+            try:
+                await self.__write(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def __write(self, batch: List):
+        """
+        去重后写入一批记录，失败时按重试策略重试
+        :param batch: 记录列表
+        :return:
+        """
+        if self.dedup is not None:
+            try:
+                added = await self.dedup.add_many([self.fingerprint(item) for item in batch])
+            except Exception as e:
+                print('pipeline {} dedup raised'.format(self.name), e, str(e))
+            else:
+                self.duplicated += len(batch) - sum(added)
+                batch = [item for item, new in zip(batch, added) if new]
+
+        if not batch:
+            return
+
+        attempts = 0
+        while True:
+            try:
+                await self.sink.write(batch)
+                self.written += len(batch)
+                return
+            except Exception as e:
+                attempts += 1
+                delay = self.retry.delay(attempts) if self.retry is not None else None
+                if delay is None:
+                    print('pipeline {} dropped {} items after {} attempts'.format(self.name, len(batch), attempts),
+                          e, str(e))
+                    self.dropped += len(batch)
+                    return
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        """
+        等待队列中的记录全部写完，停止写入循环，关闭写入方式
+        :return:
+        """
+        if not self.started:
+            return
+
+        await self.queue.join()
+        for writer in self.writers:
+            writer.cancel()
+        await asyncio.gather(*self.writers, return_exceptions=True)
+        self.writers = []
+        self.queue = None
+
+        await self.sink.close()
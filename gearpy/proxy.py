@@ -1,16 +1,113 @@
 import asyncio
+import heapq
+import itertools
+import time
 
 
 class ProxyPool:
     """
     简易代理池
+
+    每个代理记录成功次数、失败次数、延迟的指数加权平均（EWMA）和连续失败次数，用「预期吞吐量」作为得分：
+    成功率 / 平均延迟 / (正在使用的次数 + 1)。代理按得分放在一个堆中，每次读取得分最高的代理，
+    正在使用的代理得分会降低，所以请求会按预期吞吐量分散到各个代理上。读取、添加和反馈都是 O(log n) 的操作。
+
+    连续失败太多次的代理会被隔离一段时间，之前没有成功过的话每次隔离的时间翻倍，连续隔离次数太多的代理会被移出代理池。
+    每次 get 都需要对应一次 feedback，Manager 会自动反馈，自己使用代理池时需要手动调用
     """
 
-    def __init__(self):
+    REMOVED = None  # 失效记录的标记
+
+    def __init__(self, max_failures: int=3, cooldown: float=30, max_cooldown: float=600, max_quarantines: int=5,
+                 smoothing: float=0.3):
         """
         初始化
+        :param max_failures: 连续失败多少次后隔离代理
+        :param cooldown: 第一次隔离的时间（秒），之后每次隔离时间翻倍
+        :param max_cooldown: 最长的隔离时间（秒）
+        :param max_quarantines: 被隔离多少次后移出代理池
+        :param smoothing: 延迟 EWMA 的平滑系数，越大越看重最近的延迟
         """
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_quarantines = max_quarantines
+        self.smoothing = smoothing
+
         self.__pool = {}  # 把池的内容设置为空
+        self.__heap = []  # [-得分, 序号, 代理地址]，堆顶为得分最高的代理
+        self.__entries = {}  # 可用的代理地址: 堆中的有效记录
+        self.__quarantine = []  # (解除隔离的时间, 代理地址)
+        self.__counter = itertools.count()  # 序号，得分相同时先加入的代理优先
+        self.__available = asyncio.Event()  # 有可用代理时被设置，用于唤醒等待代理的任务
+
+    def __len__(self):
+        return len(self.__pool)
+
+    def stats(self, proxy):
+        """
+        读取代理的统计数据
+        :param proxy: 代理地址
+        :return: 统计数据，代理不在池中时为空
+        """
+        return self.__pool.get(proxy)
+
+    @staticmethod
+    def score(stats) -> float:
+        """
+        计算代理的得分，即预期吞吐量
+        :param stats: 代理的统计数据
+        :return: 得分
+        """
+        # 把权重当作先验的成功次数，用拉普拉斯平滑计算成功率
+        prior = max(stats['priority'], 0)
+        success_rate = (stats['successes'] + prior + 1) / (stats['successes'] + stats['failures'] + prior + 2)
+        latency = stats['latency'] if stats['latency'] is not None else 0  # 没用过的代理得分最高，保证每个代理都会被尝试
+
+        return success_rate / max(latency, 0.001) / (stats['in_use'] + 1)
+
+    def __update(self, proxy):
+        """
+        把代理的最新得分放入堆中，同时把旧记录标记为失效
+        :param proxy: 代理地址
+        :return:
+        """
+        self.__remove(proxy)
+
+        entry = [-self.score(self.__pool[proxy]), next(self.__counter), proxy]
+        self.__entries[proxy] = entry
+        heapq.heappush(self.__heap, entry)
+        self.__available.set()  # 唤醒等待代理的任务
+
+        # 失效记录太多时重建堆，避免堆无限增长
+        if len(self.__heap) > 2 * len(self.__entries) + 64:
+            self.__heap = list(self.__entries.values())
+            heapq.heapify(self.__heap)
+
+    def __remove(self, proxy):
+        """
+        把代理从堆中移除（标记为失效）
+        :param proxy: 代理地址
+        :return:
+        """
+        if proxy in self.__entries:
+            self.__entries.pop(proxy)[-1] = self.REMOVED
+
+        if not self.__entries:
+            self.__available.clear()
+
+    def __release(self):
+        """
+        解除到期的隔离
+        :return:
+        """
+        now = time.time()
+        while self.__quarantine and self.__quarantine[0][0] <= now:
+            _, proxy = heapq.heappop(self.__quarantine)
+            if proxy in self.__pool:
+                self.__pool[proxy]['cooldown_until'] = 0
+                self.__pool[proxy]['consecutive_failures'] = self.max_failures - 1  # 解除隔离后再失败一次就重新隔离
+                self.__update(proxy)
 
     def add(self, ip, port, priority):
         """
@@ -20,46 +117,120 @@ class ProxyPool:
         :param priority: 权重，越高越好
         :return:
         """
+        proxy = 'http://{}:{}'.format(ip, port)
+
         # 判断代理池中有没有该 IP
-        if 'http://{}:{}'.format(ip, port) not in self.__pool:
+        if proxy not in self.__pool:
 
             # 若不存在，添加进 IP 代理池
-            self.__pool['http://{}:{}'.format(ip, port)] = {
+            self.__pool[proxy] = {
                 'priority': priority,
-                'unused_time': 20  # 设置可使用次数为 20 次
+                'successes': 0,  # 成功次数
+                'failures': 0,  # 失败次数
+                'consecutive_failures': 0,  # 连续失败次数
+                'latency': None,  # 延迟的 EWMA（秒）
+                'in_use': 0,  # 正在使用的次数
+                'quarantines': 0,  # 被隔离的次数
+                'cooldown_until': 0,  # 隔离结束的时间
             }
         else:
 
             # 若存在，则更新数据
-            self.__pool['http://{}:{}'.format(ip, port)]['priority'] = priority  # 重制权重
-            self.__pool['http://{}:{}'.format(ip, port)]['unused_time'] += priority  # 添加可使用次数
+            self.__pool[proxy]['priority'] = priority  # 重制权重
+
+        if self.__pool[proxy]['cooldown_until'] == 0:
+            self.__update(proxy)
+
+    def remove(self, proxy):
+        """
+        把代理移出代理池
+        :param proxy: 代理地址
+        :return:
+        """
+        self.__remove(proxy)
+        self.__pool.pop(proxy, None)
 
     async def get(self):
         """
-        从代理池中读取一个 IP
+        从代理池中读取一个 IP，读取得分最高的 IP
         :return:
         """
-        is_done = False
-        proxy = None
+        self.__release()
+        while not self.__entries:
+            # 没有可用代理时，等待新的代理加入，或者等到下一个代理解除隔离
+            timeout = self.__quarantine[0][0] - time.time() if self.__quarantine else None
+            try:
+                await asyncio.wait_for(self.__available.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.__release()
 
-        while not is_done:
-            proxies = self.__pool.items()  # 获取所有 IP
-            proxies_sorted = sorted(list(proxies), reverse=True, key=lambda x: x[1]['unused_time'])  # 根据「可使用次数」排序
-            if len(proxies_sorted) > 0:
-                # 读取出最高次数的IP
-                self.__pool[proxies_sorted[0][0]]['unused_time'] -= 1  # 「可使用次数」减 1
-                proxy = proxies_sorted[0][0]
-                is_done = True
+        while True:
+            entry = self.__heap[0]
+            if entry[-1] is not self.REMOVED:
+                break
+            heapq.heappop(self.__heap)  # 跳过失效记录
 
-            if not is_done:
-                await asyncio.sleep(1)  # 代理池为空时，等待1秒后重新读取
+        proxy = entry[-1]
+        self.__pool[proxy]['in_use'] += 1
+        self.__update(proxy)
 
         return proxy
 
-    def feedback(self, item):
+    def release(self, item):
+        """
+        归还读取后没有使用的代理，不记录使用结果
+        :param item: 代理 IP 地址
+        :return:
+        """
+        stats = self.__pool.get(item)
+        if stats is not None and stats['in_use'] > 0:
+            stats['in_use'] -= 1
+            if stats['cooldown_until'] == 0:
+                self.__update(item)
+
+    def feedback(self, item, success=True, latency=None):
         """
-        反馈机制，用于优质IP的反馈。让优质IP 可以使用更多次数
+        反馈机制，反馈代理的使用结果，更新代理的得分，连续失败太多次的代理会被隔离
         :param item: 代理 IP 地址
+        :param success: 是否成功
+        :param latency: 请求用了多少秒
         :return:
         """
-        self.__pool[item]['unused_time'] += 1  # 「可使用次数」 加 1
+        stats = self.__pool.get(item)
+        if stats is None:
+            return  # 代理已经被移出代理池
+
+        stats['in_use'] = max(stats['in_use'] - 1, 0)
+        if latency is not None:
+            if stats['latency'] is None:
+                stats['latency'] = latency
+            else:
+                stats['latency'] += self.smoothing * (latency - stats['latency'])
+
+        if success:
+            stats['successes'] += 1
+            stats['consecutive_failures'] = 0
+            stats['quarantines'] = 0  # 成功过的代理重新计算隔离时间
+        else:
+            stats['failures'] += 1
+            stats['consecutive_failures'] += 1
+
+        if stats['cooldown_until'] != 0:
+            return  # 已经在隔离中
+
+        if stats['consecutive_failures'] < self.max_failures:
+            self.__update(item)
+            return
+
+        # 连续失败太多次，隔离代理，隔离次数太多时移出代理池
+        if stats['quarantines'] >= self.max_quarantines:
+            self.remove(item)
+            return
+
+        cooldown = min(self.cooldown * 2 ** stats['quarantines'], self.max_cooldown)
+        stats['quarantines'] += 1
+        stats['consecutive_failures'] = 0
+        stats['cooldown_until'] = time.time() + cooldown
+        self.__remove(item)
+        heapq.heappush(self.__quarantine, (stats['cooldown_until'], item))
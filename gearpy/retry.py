@@ -0,0 +1,43 @@
+"""
+这个文件是用来定义失败任务的重试策略的
+"""
+import random
+
+from typing import Optional
+
+
+class RetryPolicy:
+    """
+    重试策略，失败的任务按指数退避延迟后重新执行，失败次数太多的任务放进「死信队列」
+
+    第 n 次失败后的延迟为 min(backoff * factor ** (n - 1), max_backoff)，再随机减少最多 jitter 比例，
+    避免同一时间失败的大量任务（比如网站暂时不可用）在同一时间重试
+    """
+
+    def __init__(self, max_attempts: int=5, backoff: float=1, factor: float=2, max_backoff: float=300,
+                 jitter: float=0.5):
+        """
+        初始化
+        :param max_attempts: 最多执行多少次，失败次数达到这个值后不再重试
+        :param backoff: 第一次重试前的延迟（秒）
+        :param factor: 每次重试延迟的增长倍数
+        :param max_backoff: 最长的重试延迟（秒）
+        :param jitter: 随机减少延迟的最大比例，0 表示不随机
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def delay(self, attempts: int) -> Optional[float]:
+        """
+        计算下一次重试前的延迟
+        :param attempts: 包括这一次在内已经失败的次数
+        :return: 延迟多少秒后重试，为空时表示不再重试
+        """
+        if attempts >= self.max_attempts:
+            return None
+
+        delay = min(self.backoff * self.factor ** (attempts - 1), self.max_backoff)
+        return delay * (1 - self.jitter * random.random())
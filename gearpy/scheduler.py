@@ -0,0 +1,207 @@
+"""
+这个文件是用来定义请求频率控制的
+"""
+import asyncio
+import time
+
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+
+class TokenBucket:
+    """
+    令牌桶，以固定速度生成令牌，最多储存 burst 个令牌
+    """
+
+    def __init__(self, rate: float, burst: int=1):
+        """
+        初始化
+        :param rate: 每秒生成多少个令牌
+        :param burst: 最多储存多少个令牌，即允许的突发请求个数
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """
+        预定一个令牌，令牌不够时预定未来生成的令牌
+        :return: 需要等待多少秒才能使用预定的令牌
+        """
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class ConcurrencyLimit:
+    """
+    同时请求个数限制
+
+    和 asyncio.Semaphore 不同，等待名额时不会占用名额，名额释放时唤醒所有等待者重新尝试，
+    所以等待名额的任务不会和等待执行名额的任务互相等待
+    """
+
+    def __init__(self, limit: int):
+        """
+        初始化
+        :param limit: 最多同时请求个数
+        """
+        self.limit = limit
+        self.active = 0
+        self.waiters = []
+
+    def available(self) -> bool:
+        """
+        是否有空余名额
+        :return:
+        """
+        return self.active < self.limit
+
+    def acquire(self):
+        """
+        占用一个名额，需要先确认有空余名额
+        :return:
+        """
+        self.active += 1
+
+    def release(self):
+        """
+        释放一个名额，唤醒所有等待者
+        :return:
+        """
+        self.active -= 1
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait(self):
+        """
+        等待到有空余名额，不占用名额
+        :return:
+        """
+        while not self.available():
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            await waiter
+
+
+def try_acquire(slots: List[ConcurrencyLimit]) -> bool:
+    """
+    尝试同时占用多个名额，有一个名额用完时都不占用
+    :param slots: 同时请求个数限制
+    :return: 是否成功占用
+    """
+    if not all(slot.available() for slot in slots):
+        return False
+
+    for slot in slots:
+        slot.acquire()
+    return True
+
+
+async def wait_available(slots: List[ConcurrencyLimit]):
+    """
+    等待到所有名额都有空余，不占用名额
+    :param slots: 同时请求个数限制
+    :return:
+    """
+    for slot in slots:
+        await slot.wait()
+
+
+class HostScheduler:
+    """
+    请求频率控制，按域名和代理限制请求频率（令牌桶）和同时请求个数
+
+    Manager 在请求前向它预定请求时间，需要等待的任务会暂时让出执行名额，不影响其他域名的任务
+    """
+
+    def __init__(self, rate: Optional[float]=None, burst: int=1, concurrency: Optional[int]=None,
+                 proxy_rate: Optional[float]=None, proxy_burst: int=1, proxy_concurrency: Optional[int]=None):
+        """
+        初始化，参数为空时不限制
+        :param rate: 每个域名每秒最多请求次数
+        :param burst: 每个域名允许的突发请求个数
+        :param concurrency: 每个域名最多同时请求个数
+        :param proxy_rate: 每个代理每秒最多请求次数
+        :param proxy_burst: 每个代理允许的突发请求个数
+        :param proxy_concurrency: 每个代理最多同时请求个数
+        """
+        self.host_limit = {'rate': rate, 'burst': burst, 'concurrency': concurrency}
+        self.proxy_limit = {'rate': proxy_rate, 'burst': proxy_burst, 'concurrency': proxy_concurrency}
+        self.host_limits: Dict[str, Dict] = {}  # 单独设置的域名限制
+
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.concurrency: Dict[str, ConcurrencyLimit] = {}
+
+    def limit(self, host: str, rate: Optional[float]=None, burst: int=1, concurrency: Optional[int]=None):
+        """
+        单独设置一个域名的限制
+        :param host: 域名
+        :param rate: 每秒最多请求次数
+        :param burst: 允许的突发请求个数
+        :param concurrency: 最多同时请求个数
+        :return:
+        """
+        self.host_limits[host] = {'rate': rate, 'burst': burst, 'concurrency': concurrency}
+        self.buckets.pop('host:' + host, None)
+        self.concurrency.pop('host:' + host, None)
+
+    def __keys(self, url, proxy):
+        """
+        列出一次请求受到的所有限制
+        :param url: 请求地址
+        :param proxy: 使用的代理
+        :return: [(限制的键, 限制配置)]
+        """
+        keys = []
+
+        host = urlsplit(url).hostname
+        if host:
+            keys.append(('host:' + host, self.host_limits.get(host, self.host_limit)))
+
+        if proxy:
+            keys.append(('proxy:' + proxy, self.proxy_limit))
+
+        return keys
+
+    def reserve(self, url: str, proxy: Optional[str]=None) -> float:
+        """
+        为一次请求预定令牌
+        :param url: 请求地址
+        :param proxy: 使用的代理
+        :return: 需要等待多少秒才能请求
+        """
+        delay = 0
+        for key, limit in self.__keys(url, proxy):
+            if limit['rate'] is None:
+                continue
+
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(limit['rate'], limit['burst'])
+            delay = max(delay, self.buckets[key].reserve())
+
+        return delay
+
+    def slots(self, url: str, proxy: Optional[str]=None) -> List[ConcurrencyLimit]:
+        """
+        获取一次请求需要占用的同时请求名额
+        :param url: 请求地址
+        :param proxy: 使用的代理
+        :return: 需要占用的同时请求个数限制
+        """
+        slots = []
+        for key, limit in self.__keys(url, proxy):
+            if limit['concurrency'] is None:
+                continue
+
+            if key not in self.concurrency:
+                self.concurrency[key] = ConcurrencyLimit(limit['concurrency'])
+            slots.append(self.concurrency[key])
+
+        return slots
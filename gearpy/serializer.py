@@ -0,0 +1,185 @@
+"""
+这个文件是用来定义任务内容的序列化方式的
+
+储存在数据库中的任务内容带有一个五字节的头部：第一个字节是头部版本，第二个字节是序列化方式的标记，
+第三、四个字节是任务已经失败的次数（大端序），用于重试策略，第五个字节是任务的优先级，用于把任务放回对应优先级的队列。
+读取时根据头部选择反序列化方式，所以同一个队列中可以同时存在不同序列化方式的任务，可以在不清空队列的情况下切换序列化方式。
+没有头部的任务内容是旧版本写入的 JSON，读取时失败次数和优先级都当作 0
+"""
+import abc
+import json
+import struct
+
+from typing import Any, NamedTuple
+
+HEADER_VERSION = b'\x01'  # 头部版本，JSON 文本不会以这个字节开头
+MAX_ATTEMPTS = 0xFFFF  # 头部能记录的最大失败次数
+MAX_PRIORITY = 0xFF  # 头部能记录的最大优先级
+
+
+class Envelope(NamedTuple):
+    """
+    从数据库读取的任务内容和头部信息
+    """
+    item: Any  # 任务内容
+    attempts: int = 0  # 已经失败的次数
+    priority: int = 0  # 优先级，越大越优先
+
+
+class BasicSerializer:
+    """
+    序列化方式的抽象类
+    """
+    __metaclass__ = abc.ABCMeta
+
+    tag = b''  # 序列化方式的标记，一个字节
+
+    @abc.abstractmethod
+    def dumps(self, item) -> bytes:
+        """
+        序列化
+        :param item: 任务内容
+        :return: 序列化后的内容
+        """
+        pass
+
+    @abc.abstractmethod
+    def loads(self, data: bytes):
+        """
+        反序列化
+        :param data: 序列化后的内容
+        :return: 任务内容
+        """
+        pass
+
+
+class JSONSerializer(BasicSerializer):
+    """
+    使用标准库 json 序列化
+    """
+
+    tag = b'j'
+
+    def dumps(self, item) -> bytes:
+        return json.dumps(item, separators=(',', ':')).encode()
+
+    def loads(self, data: bytes):
+        return json.loads(data)
+
+
+class MsgpackSerializer(BasicSerializer):
+    """
+    使用 msgpack 序列化，体积更小，速度更快，需要安装 msgpack
+    """
+
+    tag = b'm'
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError('MsgpackSerializer requires msgpack, install it with `pip install msgpack`')
+
+        self.msgpack = msgpack
+
+    def dumps(self, item) -> bytes:
+        return self.msgpack.packb(item, use_bin_type=True)
+
+    def loads(self, data: bytes):
+        return self.msgpack.unpackb(data, raw=False)
+
+
+class OrjsonSerializer(BasicSerializer):
+    """
+    使用 orjson 序列化，和 JSON 格式兼容，速度更快，需要安装 orjson
+    """
+
+    tag = b'o'
+
+    def __init__(self):
+        try:
+            import orjson
+        except ImportError:
+            raise ImportError('OrjsonSerializer requires orjson, install it with `pip install orjson`')
+
+        self.orjson = orjson
+
+    def dumps(self, item) -> bytes:
+        return self.orjson.dumps(item)
+
+    def loads(self, data: bytes):
+        return self.orjson.loads(data)
+
+
+# 内置的序列化方式
+SERIALIZERS = {
+    'json': JSONSerializer,
+    'msgpack': MsgpackSerializer,
+    'orjson': OrjsonSerializer,
+}
+
+# 标记: 序列化方式实例，用于反序列化时根据头部查找
+serializers_by_tag = {}
+
+
+def get_serializer(serializer=None) -> BasicSerializer:
+    """
+    获取序列化方式
+    :param serializer: 序列化方式的名字（见 SERIALIZERS）或者实例，为空时使用 JSON
+    :return: 序列化方式实例
+    """
+    if serializer is None:
+        serializer = 'json'
+
+    if isinstance(serializer, str):
+        if serializer not in SERIALIZERS:
+            raise ValueError('unknown serializer {}'.format(serializer))
+        serializer = SERIALIZERS[serializer]()
+
+    serializers_by_tag.setdefault(serializer.tag, serializer)
+    return serializer
+
+
+def encode(item, serializer: BasicSerializer, attempts: int=0, priority: int=0) -> bytes:
+    """
+    序列化任务内容，并加上头部
+    :param item: 任务内容
+    :param serializer: 序列化方式
+    :param attempts: 已经失败的次数
+    :param priority: 优先级
+    :return: 储存到数据库的内容
+    """
+    header = struct.pack('>HB', min(attempts, MAX_ATTEMPTS), min(priority, MAX_PRIORITY))
+    return HEADER_VERSION + serializer.tag + header + serializer.dumps(item)
+
+
+def unpack(data: bytes) -> Envelope:
+    """
+    根据头部反序列化任务内容，同时读取头部信息
+    :param data: 从数据库读取的内容
+    :return: 任务内容和头部信息
+    """
+    if data[:1] != HEADER_VERSION:
+        return Envelope(json.loads(data))  # 没有头部，是旧版本写入的 JSON
+
+    attempts, priority = struct.unpack('>HB', data[2:5])
+    body = data[5:]
+    tag = data[1:2]
+    if tag not in serializers_by_tag:
+        for serializer_class in SERIALIZERS.values():
+            if serializer_class.tag == tag:
+                get_serializer(serializer_class())
+                break
+        else:
+            raise ValueError('unknown serializer tag {}'.format(tag))
+
+    return Envelope(serializers_by_tag[tag].loads(body), attempts, priority)
+
+
+def decode(data: bytes):
+    """
+    根据头部反序列化任务内容
+    :param data: 从数据库读取的内容
+    :return: 任务内容
+    """
+    return unpack(data).item
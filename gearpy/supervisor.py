@@ -0,0 +1,202 @@
+"""
+这个文件是用来定义多进程运行的监督进程的
+"""
+import asyncio
+import os
+import signal
+import time
+
+from typing import Dict, List, Optional
+
+
+class Supervisor:
+    """
+    监督进程，fork 出多个工作进程，每个工作进程有自己的事件循环和数据库连接，运行同样的任务类型
+
+    工作进程异常退出时按指数退避重新启动。收到 SIGTERM 或 SIGINT 时把 SIGTERM 转发给所有工作进程，
+    工作进程停止读取任务，等待正在执行的任务完成，超时的任务回滚到「准备工作队列」，然后退出。
+    监督进程本身不运行事件循环，fork 前不持有任何连接。
+    崩溃的工作进程来不及回滚自己的任务，需要给任务类型设置可见时间，由其他工作进程把这些任务放回「准备工作队列」
+    """
+
+    def __init__(self, manager, tasks=None, workers: Optional[int]=None, restore=False, shutdown_timeout: float=30,
+                 restart_delay: float=1, max_restart_delay: float=60):
+        """
+        初始化
+        :param manager: 任务管理员
+        :param tasks: 启动的任务类型，默认为所有任务类型
+        :param workers: 工作进程个数，默认为 CPU 个数
+        :param restore: 是否在启动工作进程前把未完成的任务重新回滚进「准备工作队列」
+        :param shutdown_timeout: 关闭时工作进程等待正在执行的任务的最长时间（秒）
+        :param restart_delay: 工作进程启动后很快退出时，第一次重新启动前等待的时间（秒），之后每次翻倍
+        :param max_restart_delay: 重新启动前最长的等待时间（秒）
+        """
+        self.manager = manager
+        self.tasks = tasks
+        self.workers = workers or os.cpu_count() or 1
+        self.restore = restore
+        self.shutdown_timeout = shutdown_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+
+        self.children: Dict[int, int] = {}  # 进程 ID: 工作进程序号
+        self.started: List[float] = [0] * self.workers  # 每个工作进程最近一次启动的时间
+        self.delays: List[float] = [0] * self.workers  # 每个工作进程下次重新启动前等待的时间
+        self.stopping = False
+
+    def __fork(self, target, *args) -> int:
+        """
+        fork 一个子进程执行 target，子进程执行完后直接退出，异常退出时退出码为 1
+        :param target: 子进程执行的函数
+        :param args: 函数参数
+        :return: 子进程 ID
+        """
+        pid = os.fork()
+        if pid != 0:
+            return pid
+
+        code = 0
+        try:
+            target(*args)
+        except BaseException as e:
+            print('worker {} raised'.format(os.getpid()), e, str(e))
+            code = 1
+        finally:
+            os._exit(code)
+
+    def __run_restore(self):
+        """
+        在子进程中把所有任务类型未完成的任务重新回滚进「准备工作队列」
+        :return:
+        """
+        async def restore():
+            for task in self.__task_names():
+                await self.manager.init_broker(task)
+                count = await self.manager.tasks[task][0].restore()
+                print('restore {} task in list {}'.format(count, task))
+            await self.manager.close()
+
+        asyncio.get_event_loop().run_until_complete(restore())
+
+    def __run_worker(self, slot: int=0):
+        """
+        工作进程：启动任务类型，收到 SIGTERM 或 SIGINT 时关闭 Manager 后退出。
+        读取任务的循环出错时（比如数据库连不上）同样关闭 Manager，然后抛出异常，以非零退出码退出，由监督进程重新启动
+        :param slot: 工作进程序号，指标输出方式按序号区分工作进程（比如每个工作进程监听不同的端口）
+        :return:
+        """
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+
+        if self.manager.metrics is not None:
+            self.manager.metrics.set_worker(slot)
+
+        # 不使用 fork 前的事件循环，它可能已经被关闭，或者和监督进程共用 selector
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        stopped = loop.create_future()
+        stopping = []
+
+        def stop():
+            if not stopping:
+                stopping.append(True)
+                shutdown = asyncio.ensure_future(self.manager.shutdown(self.shutdown_timeout))
+                shutdown.add_done_callback(lambda f: stopped.set_result(None))
+
+        failures = []
+
+        def check(listener):
+            if not listener.cancelled() and listener.exception() is not None:
+                failures.append(listener.exception())
+                stop()
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop)
+
+        loop.run_until_complete(self.manager.serve(self.tasks))
+        for listener in self.manager.listeners:
+            listener.add_done_callback(check)
+        loop.run_until_complete(stopped)
+        loop.close()
+
+        if failures:
+            raise RuntimeError('listener of worker {} failed'.format(os.getpid())) from failures[0]
+
+    def __task_names(self) -> List[str]:
+        """
+        启动的任务类型
+        :return:
+        """
+        if self.tasks is None:
+            return list(self.manager.tasks.keys())
+        return self.tasks if isinstance(self.tasks, list) else [self.tasks]
+
+    def __spawn(self, slot: int):
+        """
+        启动一个工作进程
+        :param slot: 工作进程序号
+        :return:
+        """
+        self.started[slot] = time.monotonic()
+        pid = self.__fork(self.__run_worker, slot)
+        self.children[pid] = slot
+        print('started worker {} (pid {})'.format(slot, pid))
+
+    def __stop(self, signum, frame):
+        """
+        收到信号时通知所有工作进程关闭
+        :param signum: 信号
+        :param frame:
+        :return:
+        """
+        if self.stopping:
+            return
+
+        self.stopping = True
+        print('stopping {} workers'.format(len(self.children)))
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        """
+        启动工作进程，一直监督到所有工作进程退出
+        :return:
+        """
+        if self.restore:
+            _, status = os.waitpid(self.__fork(self.__run_restore), 0)
+            if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+                raise RuntimeError('restore failed')
+
+        signal.signal(signal.SIGTERM, self.__stop)
+        signal.signal(signal.SIGINT, self.__stop)
+
+        for slot in range(self.workers):
+            self.__spawn(slot)
+
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+
+            slot = self.children.pop(pid, None)
+            if slot is None or self.stopping:
+                continue
+
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                print('worker {} (pid {}) exited'.format(slot, pid))
+                continue
+
+            # 异常退出，运行时间很短时（比如数据库连不上）逐渐拉长重新启动前的等待时间
+            if time.monotonic() - self.started[slot] < self.max_restart_delay:
+                self.delays[slot] = min(max(self.delays[slot] * 2, self.restart_delay), self.max_restart_delay)
+            else:
+                self.delays[slot] = 0
+
+            print('worker {} (pid {}) crashed with status {}, restarting in {}s'.format(slot, pid, status, self.delays[slot]))
+            time.sleep(self.delays[slot])
+            if not self.stopping:
+                self.__spawn(slot)
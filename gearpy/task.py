@@ -1,7 +1,13 @@
+import codecs
+import json
+import re
+
 import aiohttp
 import async_timeout
 from lxml import etree
 
+from gearpy.cache import CacheMiss
+
 
 class BasicTask:
 
@@ -33,7 +39,107 @@ class HTTP:
     DELETE = 'delete'
 
 
+class ResponseType:
+
+    HTML = 'html'
+    XML = 'xml'
+    JSON = 'json'
+    TEXT = 'text'
+    BYTES = 'bytes'
+
+
+class BodyTooLarge(Exception):
+    """
+    响应内容超过 max_body_size
+    """
+    pass
+
+
+# HTML 的 <meta charset="..."> 或 <meta http-equiv="Content-Type" content="...; charset=...">，XML 的 <?xml encoding="..."?>
+DECLARED_ENCODING = re.compile(rb'<meta[^>]*?charset\s*=\s*["\']?\s*([\w:.-]+)|<\?xml[^>]*?encoding\s*=\s*["\']([\w:.-]+)', re.I)
+
+# 没有声明编码、也不能按 UTF-8 解码时使用的编码，GB18030 兼容 GBK 和 GB2312，没有声明编码的中文网页大多是这些编码
+FALLBACK_ENCODING = 'gb18030'
+
+
+def detect_encoding(body: bytes) -> str:
+    """
+    检测响应头中没有声明编码的响应内容的编码，依次检查 BOM、页面开头声明的编码、能否按 UTF-8 解码，都不是时使用 FALLBACK_ENCODING
+    :param body: 原始的响应内容
+    :return: 编码
+    """
+    if body.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if body.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+
+    match = DECLARED_ENCODING.search(body, 0, 4096)
+    if match:
+        try:
+            return codecs.lookup((match.group(1) or match.group(2)).decode('ascii')).name
+        except LookupError:
+            pass  # 不认识的编码，继续检测
+
+    try:
+        body.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return FALLBACK_ENCODING
+
+
+def decode_text(body: bytes, encoding=None) -> str:
+    """
+    解码响应内容
+    :param body: 原始的响应内容
+    :param encoding: 编码，为空时用 detect_encoding 检测
+    :return: 文本
+    """
+    return body.decode(encoding or detect_encoding(body), errors='replace')
+
+
+def parse_tree(body: bytes, encoding=None, xml=False):
+    """
+    用 lxml 解析响应内容
+    :param body: 原始的响应内容
+    :param encoding: 编码，为空时由 lxml 检测
+    :param xml: 是否按 XML 解析，否则按 HTML 解析
+    :return: 根节点
+    """
+    if xml:
+        return etree.fromstring(body, etree.XMLParser(encoding=encoding, recover=True))
+    return etree.HTML(body, etree.HTMLParser(encoding=encoding))
+
+
 class Task(BasicTask):
+    """
+    HTTP 请求任务
+
+    请求后只保存原始的响应内容 body，text、json 和 tree 在第一次读取时才解码、解析，之后缓存起来。
+    response_type 声明这种任务的响应类型，parsed 按响应类型返回解析结果，比如 JSON 接口的任务设置为 ResponseType.JSON，
+    不会用到 lxml。
+
+    解析很耗 CPU 的任务可以把解析和提取数据写在 extract 类方法中，Manager 在 handle 前调用，结果放在 records 中。
+    handle 设置了 executor 时 extract 在进程池或线程池中执行，不会阻塞事件循环，只有原始的响应内容和提取的结果需要跨进程传递。
+    只需要按固定结构提取记录时，可以把 item 设置为 gearpy.extract.Item 的子类，不用重写 extract，选择器只在定义时编译一次。
+    需要保存的记录用 emit 输出，handle 设置了 pipeline 时，任务成功后由 Manager 交给 gearpy.pipeline.Pipeline 批量写入。
+
+    下载很大的响应时可以设置 stream，响应内容分块交给 consume 和 on_chunk 处理，不保存完整的 body：
+    HTML 和 XML 默认边下载边用 lxml 增量解析，设置了 stream_tag 时每解析完一个这种标签就交给 on_element 处理然后释放，
+    内存占用和页面大小无关；其他响应类型默认仍然保存 body。重写 on_chunk 可以把内容直接写入文件，重写 consume 可以得到分块的异步迭代器。
+    HTML 和 XML 流式处理时不能重写 extract，设置的 item 在事件循环中从解析好的 tree 提取，不能和 stream_tag 同时设置。
+    设置了 max_body_size 时，响应内容超过这个大小马上中止下载，抛出 BodyTooLarge，任务按失败处理
+
+    设置了 http_cache 时（见 gearpy.cache.HttpCache），GET 请求带上缓存的 ETag 和 Last-Modified 发送条件请求，
+    服务器返回 304 时使用缓存的响应内容，status 为缓存的状态码，from_cache 为 True。离线模式下不请求网络，
+    缓存中没有的请求抛出 CacheMiss。流式处理的任务不使用缓存
+    """
+
+    response_type = ResponseType.HTML  # 响应类型，见 ResponseType
+    stream = False  # 是否流式处理响应内容
+    stream_tag = None  # 流式解析时逐个处理的标签，比如 'li'
+    chunk_size = 64 * 1024  # 每次读取的字节数
+    max_body_size = None  # 响应内容的最大字节数，为空时不限制
+    item = None  # 声明式的记录结构，gearpy.extract.Item 的子类，设置时 extract 默认按它提取记录
 
     def __init__(self, data):
 
@@ -43,22 +149,290 @@ class Task(BasicTask):
         self.headers = {}
         self.proxy = None
         self.time_out = 0
+        self.session = None  # 由 Manager 注入的共享 HTTP 会话，为空时每次请求临时创建会话
 
+        self.http_cache = None  # HTTP 响应缓存，由 Manager 注入，也可以自己设置
         self.response = None
-        self.content = None
-        self.tree = None
+        self.status = None  # 状态码，使用缓存时为缓存的状态码
+        self.from_cache = False  # 响应内容是否来自缓存
+        self.body = None  # 原始的响应内容
+        self.encoding = None  # 响应的编码，响应头中没有声明时从响应内容检测
+        self.records = None  # extract 提取的结果
+        self.emitted = []  # emit 输出的记录
         self.url = None
 
+        self.__cache = {}  # 解码、解析结果的缓存
+        self.__parser = None  # 流式处理时的 lxml 增量解析器
+        self.__chunks = None  # 流式处理时没有增量解析器，暂存的分块
+
     async def __fetch(self, session):
         if self.url:
-            async with getattr(session, self.method)(self.url, proxy=self.proxy) as response:
+            cache = self.http_cache if self.method == HTTP.GET and not self.stream else None
+            entry = None
+            if cache is not None:
+                entry = await cache.get(self.method, self.url)
+                if cache.offline:
+                    if entry is None:
+                        raise CacheMiss('{} is not in the cache'.format(self.url))
+                    self.response = None
+                    self.__use_cached(entry)
+                    return
+
+            # 有缓存时发送条件请求
+            headers = dict(self.headers, **entry.validators()) if entry is not None else self.headers
+
+            async with getattr(session, self.method)(self.url, headers=headers, proxy=self.proxy) as response:
                 self.response = response
-                self.content = await response.text()
-                self.tree = etree.HTML(self.content)
+                self.status = response.status
+                self.from_cache = False
+                self.body = None
+                self.encoding = response.charset
+                self.__cache.clear()
+
+                # 内容没有变化，使用缓存的响应内容
+                if entry is not None and response.status == 304:
+                    self.__use_cached(entry)
+                    return
+
+                # 响应头中的大小已经超过限制时，不读取响应内容
+                if self.max_body_size is not None and (response.content_length or 0) > self.max_body_size:
+                    raise BodyTooLarge('{} is larger than {} bytes'.format(self.url, self.max_body_size))
+
+                if self.stream:
+                    self.__start_stream()
+                    await self.consume(self.__iter_chunks(response))
+                    self.__finish_stream()
+                elif self.max_body_size is None:
+                    self.body = await response.read()
+                else:
+                    self.body = b''.join([chunk async for chunk in self.__iter_chunks(response)])
+
+            # 响应头中没有声明编码时从响应内容检测，text、tree、extract 和缓存都使用检测到的编码
+            if self.encoding is None and self.body is not None:
+                self.encoding = detect_encoding(self.body)
+
+            if cache is not None and self.status == 200 and 'no-store' not in response.headers.get('Cache-Control', ''):
+                await cache.put(self.method, self.url, self.status, self.body, self.encoding,
+                                response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+    def __use_cached(self, entry):
+        """
+        使用缓存的响应
+        :param entry: 缓存的响应
+        :return:
+        """
+        self.status = entry.status
+        self.from_cache = True
+        self.body = entry.body
+        self.encoding = entry.encoding or (detect_encoding(entry.body) if entry.body is not None else None)
+        self.__cache.clear()
+
+    async def __iter_chunks(self, response):
+        """
+        分块读取响应内容，超过 max_body_size 时中止
+        :param response: HTTP 响应
+        :return: 分块的异步迭代器
+        """
+        size = 0
+        async for chunk in response.content.iter_chunked(self.chunk_size):
+            size += len(chunk)
+            if self.max_body_size is not None and size > self.max_body_size:
+                raise BodyTooLarge('{} is larger than {} bytes'.format(self.url, self.max_body_size))
+            yield chunk
+
+    def __start_stream(self):
+        """
+        开始流式处理，HTML 和 XML 创建增量解析器，其他响应类型暂存分块
+        :return:
+        """
+        self.__parser = None
+        self.__chunks = None
+
+        if self.response_type == ResponseType.HTML:
+            if self.stream_tag is None:
+                self.__parser = etree.HTMLParser(encoding=self.encoding)
+            else:
+                self.__parser = etree.HTMLPullParser(events=('end',), tag=self.stream_tag, encoding=self.encoding)
+        elif self.response_type == ResponseType.XML:
+            if self.stream_tag is None:
+                self.__parser = etree.XMLParser(encoding=self.encoding, recover=True)
+            else:
+                self.__parser = etree.XMLPullParser(events=('end',), tag=self.stream_tag, encoding=self.encoding,
+                                                    recover=True)
+        else:
+            self.__chunks = []
+
+    def __finish_stream(self):
+        """
+        结束流式处理，缓存解析结果或者合并暂存的分块
+        :return:
+        """
+        if self.__parser is not None:
+            self.__cache['tree'] = self.__parser.close()
+            self.__parser = None
+        elif self.__chunks is not None:
+            self.body = b''.join(self.__chunks)
+            self.__chunks = None
+
+    async def consume(self, chunks):
+        """
+        流式处理时处理响应内容，默认把每个分块交给 on_chunk
+        :param chunks: 分块的异步迭代器
+        :return:
+        """
+        async for chunk in chunks:
+            await self.on_chunk(chunk)
+
+    async def on_chunk(self, chunk: bytes):
+        """
+        流式处理时处理一个分块，默认交给增量解析器，没有增量解析器时暂存
+        :param chunk: 响应内容的一个分块
+        :return:
+        """
+        if self.__parser is None:
+            if self.__chunks is not None:
+                self.__chunks.append(chunk)
+            return
+
+        self.__parser.feed(chunk)
+        if self.stream_tag is not None:
+            for _, element in self.__parser.read_events():
+                self.on_element(element)
+
+                # 释放已经处理的节点，只保留文档的骨架
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+    def on_element(self, element):
+        """
+        流式解析时处理一个解析完的 stream_tag 节点，处理后节点会被释放，需要的数据要在这里提取出来
+        :param element: lxml 节点
+        :return:
+        """
+        pass
+
+    def __cached(self, name, parse):
+        """
+        读取缓存的解析结果，第一次读取时解析
+        :param name: 缓存的名字
+        :param parse: 解析函数
+        :return: 解析结果
+        """
+        if name not in self.__cache:
+            self.__cache[name] = parse() if self.body is not None else None  # 流式处理时没有 body
+        return self.__cache[name]
+
+    @property
+    def text(self):
+        """
+        解码后的响应内容
+        :return:
+        """
+        return self.__cached('text', lambda: decode_text(self.body, self.encoding))
+
+    @property
+    def content(self):
+        """
+        解码后的响应内容，和 text 相同，为了兼容旧版本
+        :return:
+        """
+        return self.text
+
+    @property
+    def json(self):
+        """
+        按 JSON 解析的响应内容
+        :return:
+        """
+        return self.__cached('json', lambda: json.loads(self.body))
+
+    @property
+    def tree(self):
+        """
+        lxml 解析的响应内容，响应类型为 XML 时按 XML 解析，否则按 HTML 解析
+        :return:
+        """
+        return self.__cached('tree', lambda: parse_tree(self.body, self.encoding, self.response_type == ResponseType.XML))
+
+    @property
+    def parsed(self):
+        """
+        按 response_type 解析的响应内容
+        :return:
+        """
+        if self.response_type == ResponseType.JSON:
+            return self.json
+        if self.response_type == ResponseType.TEXT:
+            return self.text
+        if self.response_type == ResponseType.BYTES:
+            return self.body
+        return self.tree
+
+    @classmethod
+    def parse(cls, body: bytes, encoding=None):
+        """
+        按 response_type 解析原始的响应内容，和 parsed 相同，用于 extract 中
+        :param body: 原始的响应内容
+        :param encoding: 编码
+        :return: 解析结果
+        """
+        if cls.response_type == ResponseType.JSON:
+            return json.loads(body)
+        if cls.response_type == ResponseType.TEXT:
+            return decode_text(body, encoding)
+        if cls.response_type == ResponseType.BYTES:
+            return body
+        return parse_tree(body, encoding, cls.response_type == ResponseType.XML)
+
+    @classmethod
+    def extract(cls, body: bytes, encoding=None):
+        """
+        从原始的响应内容中提取数据，设置了 item 时按 item 提取，否则不提取。重写时只能使用参数，不能访问任务实例，
+        在进程池中执行时参数和返回值需要可以被 pickle，任务类需要定义在模块的顶层
+        :param body: 原始的响应内容
+        :param encoding: 编码
+        :return: 提取的结果，放在 records 中
+        """
+        if cls.item is not None:
+            return cls.item.extract(cls.parse(body, encoding))
+        return None
+
+    @classmethod
+    def has_extract(cls) -> bool:
+        """
+        任务类是否重写了 extract 或者设置了 item
+        :return:
+        """
+        return cls.item is not None or cls.extract.__func__ is not Task.extract.__func__
+
+    @classmethod
+    def parses_stream(cls) -> bool:
+        """
+        流式处理时是否边下载边解析，这时没有原始的响应内容，extract 拿不到 body，只能按 item 从解析好的 tree 中提取
+        :return:
+        """
+        return cls.stream and cls.response_type in (ResponseType.HTML, ResponseType.XML)
+
+    def emit(self, *items):
+        """
+        输出需要保存的记录，任务成功后才交给 Pipeline，失败的任务输出的记录会被丢弃
+        :param items: 记录
+        :return:
+        """
+        self.emitted.extend(items)
+
+    async def __request(self):
+        if self.session is not None:
+            # 使用共享的会话，复用连接
+            await self.__fetch(self.session)
+        else:
+            async with aiohttp.ClientSession() as session:
+                await self.__fetch(session)
 
     async def check(self):
-        # print('check function with status is', self.response.status)
-        return self.response.status == 200
+        # print('check function with status is', self.status)
+        return self.status == 200
 
     async def on_task(self):
         if self.method not in [HTTP.GET, HTTP.POST, HTTP.DELETE, HTTP.PUT, HTTP.PATCH]:
@@ -66,11 +440,9 @@ class Task(BasicTask):
 
         if self.time_out > 0:
             with async_timeout.timeout(self.time_out):
-                async with aiohttp.ClientSession(headers=self.headers) as session:
-                    await self.__fetch(session)
+                await self.__request()
         else:
-            async with aiohttp.ClientSession(headers=self.headers) as session:
-                await self.__fetch(session)
+            await self.__request()
 
         return await self.check()
 
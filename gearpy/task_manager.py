@@ -1,6 +1,31 @@
 import asyncio
+import os
+import time
 
-from typing import Tuple, Any, Optional, Dict, List
+import aiohttp
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Tuple, Any, Optional, Dict, List, Set, Sequence, Callable
+
+from gearpy.broker import Delivery
+from gearpy.cache import HttpCache
+from gearpy.dedup import BasicFilter, fingerprint as default_fingerprint
+from gearpy.metrics import MetricsSink
+from gearpy.pipeline import Pipeline
+from gearpy.proxy import ProxyPool
+from gearpy.retry import RetryPolicy
+from gearpy.scheduler import HostScheduler, ConcurrencyLimit, try_acquire, wait_available
+from gearpy.supervisor import Supervisor
+from gearpy.task import Task
+
+# 默认的 HTTP 连接池配置，参数见 aiohttp.TCPConnector
+DEFAULT_SESSION_OPTIONS = {
+    'limit': 100,  # 连接池最大连接个数
+    'limit_per_host': 0,  # 每个域名最大连接个数，0 表示不限制
+    'keepalive_timeout': 30,  # 空闲连接保持时间（秒）
+    'use_dns_cache': True,  # 缓存 DNS 查询结果
+    'ttl_dns_cache': 300,  # DNS 缓存时间（秒）
+    'share_cookies': False,  # 是否在共用会话的任务之间保存和发送响应设置的 Cookie，默认不保存，任务只带上自己设置的 Cookie
+}
 
 
 class Manager:
@@ -8,116 +33,695 @@ class Manager:
     任务管理员
     """
 
-    def __init__(self, broker, args: Optional[Tuple]=None):
+    def __init__(self, broker, args: Optional[Tuple]=None, session_options: Optional[Dict]=None,
+                 pool_options: Optional[Dict]=None, scheduler: Optional[HostScheduler]=None,
+                 metrics: Optional[MetricsSink]=None):
         """
         初始化
         :param broker: 使用哪种数据库作为任务储存介质
         :param args: 连接 broker 要用到的参数
+        :param session_options: HTTP 连接池配置，会覆盖 DEFAULT_SESSION_OPTIONS 中的同名配置
+        :param pool_options: 数据库连接池配置，参数见 broker 的 create_pool 函数
+        :param scheduler: 请求频率控制，按域名和代理限制所有任务类型的请求频率和同时请求个数
+        :param metrics: 运行指标的输出方式，见 gearpy.metrics，为空时不记录任何指标
         """
 
         self.broker = broker
-        if args:
-            self.args = args
+        self.args = args or ()
+
+        self.tasks: Dict[str, List[Any, Any, int, int, Dict]] = {}  # 用于储存爬虫任务类型
+        self.running: Dict[str, Set[asyncio.Future]] = {}  # 用于储存每种任务类型正在执行的任务
+        self.listeners: List[asyncio.Future] = []  # 读取任务的循环和定期维护队列的循环，关闭时取消
 
-        self.tasks: Dict[str, List[Any, Any, int, int]] = {}  # 用于储存爬虫任务类型
+        self.session_options = dict(DEFAULT_SESSION_OPTIONS, **(session_options or {}))
+        self.sessions: Dict[Optional[str], aiohttp.ClientSession] = {}  # 共享的 HTTP 会话，None 为所有任务类型共用的会话
 
-    def handle(self, task_name: str, worker: int = -1):
+        self.pool_options = pool_options or {}
+        self.pools: Dict[Any, asyncio.Future] = {}  # 共享的数据库连接池，连接地址相同的 broker 共用一个连接池
+        self.broker_inits: Dict[str, asyncio.Future] = {}  # 每种任务类型的 broker 初始化过程，保证只初始化一次
+
+        self.scheduler = scheduler
+        self.executors: Dict[str, Executor] = {}  # Manager 创建的共享进程池和线程池
+        self.metrics = metrics
+
+    def handle(self, task_name: str, worker: int=1, session_options: Optional[Dict]=None,
+               visibility_timeout: Optional[float]=None, prefetch: int=1, serializer=None,
+               proxy_pool: Optional[ProxyPool]=None, max_deferred: Optional[int]=None,
+               retry: Optional[RetryPolicy]=None, priorities: int=1, priority_weights: Optional[Sequence[float]]=None,
+               dedup: Optional[BasicFilter]=None, fingerprint: Optional[Callable[[Any], str]]=None, executor=None,
+               pipeline: Optional[Pipeline]=None, http_cache: Optional[HttpCache]=None):
         """
         添加爬虫任务类型
         :param task_name: 爬虫名字
-        :param worker: 这种任务最大同时执行任务个数
-        :return: 装饰器
+        :param worker: 这种任务最大同时执行任务个数，至少为 1
+        :param session_options: 这种任务专用的 HTTP 连接池配置，不设置时和其他任务类型共用一个连接池
+        :param visibility_timeout: 可见时间（秒），任务取出后超过这个时间没有确认，会被定期放回「准备工作队列」
+        :param prefetch: 预取个数，一次从数据库中取出多少个任务，预取的任务的可见时间从取出时开始计算
+        :param serializer: 任务内容的序列化方式，可以是 'json', 'msgpack', 'orjson' 或者 BasicSerializer 实例
+        :param proxy_pool: 代理池，设置后每个任务执行前自动从代理池读取代理，执行后自动把结果和延迟反馈给代理池
+        :param max_deferred: 因为请求频率控制而让出执行名额、等待请求的任务最多个数，默认为 worker 的 10 倍，
+                             超过时任务占着执行名额等待，防止把整个队列读进内存
+        :param retry: 重试策略，设置后失败的任务延迟一段时间后重试，失败次数太多的任务放进「死信队列」，
+                      不设置时失败的任务马上放回「准备工作队列」，不限制重试次数
+        :param priorities: 优先级个数，添加任务时可以设置 0 到 priorities - 1 的优先级，越大越优先
+        :param priority_weights: 每个优先级的权重，读取任务时非空的优先级被选中的概率和权重成正比，默认每高一级权重翻倍，
+                                 所以高优先级的任务先执行，低优先级的任务也不会饿死
+        :param dedup: 去重过滤器，见 gearpy.dedup，设置后 new 和 new_many 不会添加指纹相同的任务
+        :param fingerprint: 计算任务指纹的函数，参数为任务内容，默认为按键排序后的 JSON 的 SHA1
+        :param executor: 执行任务类 extract 的地方，'process' 使用共享的进程池，'thread' 使用共享的线程池（适合会释放 GIL 的解析库），
+                         也可以是 concurrent.futures.Executor 实例，为空时在事件循环中执行
+        :param pipeline: 记录处理管道，任务成功后把 emit 输出的记录放进管道批量写入，管道满时任务等待，可以被多种任务类型共用
+        :param http_cache: HTTP 响应缓存，见 gearpy.cache，设置后 GET 请求发送条件请求，内容没有变化时使用缓存
+        :return: 装饰器，返回任务类本身，所以任务类可以被 pickle
         """
+        if worker < 1:
+            raise ValueError('worker of task {} must be at least 1, got {}'.format(task_name, worker))
 
         def decorator(task_class):
 
+            # 边下载边解析的任务没有原始的响应内容，只能按 item 从完整的 tree 中提取
+            if issubclass(task_class, Task) and task_class.parses_stream() and task_class.has_extract() and (
+                    task_class.stream_tag is not None or task_class.extract.__func__ is not Task.extract.__func__):
+                raise ValueError('task {} parses its response while streaming, extract data in on_element, '
+                                 'or set item without stream_tag and without overriding extract'.format(task_name))
+
             # 储存这种爬虫任务类型
             self.tasks[task_name] = [
-                self.broker(task_name, *self.args),  # 数据库连接
+                self.broker(
+                    task_name, *self.args,
+                    visibility_timeout=visibility_timeout, prefetch=prefetch, serializer=serializer,
+                    priorities=priorities, priority_weights=priority_weights
+                ),  # 数据库连接
                 task_class,  # 爬虫任务处理类
                 asyncio.Semaphore(worker),  # 当前工作任务个数
-                worker  # 最大工作个数
+                worker,  # 最大工作个数
+                {
+                    'session_options': session_options,  # HTTP 连接池配置
+                    'proxy_pool': proxy_pool,  # 代理池
+                    'deferred': asyncio.Semaphore(max_deferred or max(worker, 1) * 10),  # 等待请求的任务个数
+                    'retry': retry,  # 重试策略
+                    'dedup': dedup,  # 去重过滤器
+                    'fingerprint': fingerprint or default_fingerprint,  # 任务指纹函数
+                    'executor': executor,  # 执行 extract 的进程池或线程池
+                    'pipeline': pipeline,  # 记录处理管道
+                    'http_cache': http_cache,  # HTTP 响应缓存
+                }
             ]
+            self.running[task_name] = set()
+
+            return task_class
 
         return decorator
 
+    def get_session(self, task) -> aiohttp.ClientSession:
+        """
+        获取任务类型使用的 HTTP 会话，会话在第一次使用时创建，之后一直复用，保持连接和 DNS 缓存
+        :param task: 任务类型
+        :return: HTTP 会话
+        """
+        session_options = self.tasks[task][4]['session_options']
+        key = task if session_options else None  # 没有专用配置的任务类型共用一个会话
+
+        if key not in self.sessions or self.sessions[key].closed:
+            options = dict(self.session_options, **(session_options or {}))
+
+            # 会话被很多任务共用，默认不保存 Cookie，避免一个任务的登录状态或者反爬标记被其他任务带上
+            cookie_jar = aiohttp.CookieJar() if options.pop('share_cookies', False) else aiohttp.DummyCookieJar()
+            connector = aiohttp.TCPConnector(**options)
+            self.sessions[key] = aiohttp.ClientSession(connector=connector, cookie_jar=cookie_jar)
+
+        return self.sessions[key]
+
+    def get_executor(self, task) -> Optional[Executor]:
+        """
+        获取任务类型执行 extract 的进程池或线程池，共享的进程池和线程池在第一次使用时创建
+        :param task: 任务类型
+        :return: 进程池或线程池，为空时在事件循环中执行
+        """
+        executor = self.tasks[task][4]['executor']
+        if executor is None or isinstance(executor, Executor):
+            return executor
+
+        if executor not in self.executors:
+            if executor == 'process':
+                self.executors[executor] = ProcessPoolExecutor(os.cpu_count())
+            elif executor == 'thread':
+                self.executors[executor] = ThreadPoolExecutor(os.cpu_count())
+            else:
+                raise ValueError('unknown executor {}'.format(executor))
+
+        return self.executors[executor]
+
+    async def close(self):
+        """
+        写完记录处理管道中剩余的记录，关闭所有 HTTP 会话、数据库连接池、共享的进程池、线程池和运行指标的输出
+        :return:
+        """
+        pipelines = []  # 多种任务类型可以共用一个管道
+        for *_, options in self.tasks.values():
+            if options['pipeline'] is not None and options['pipeline'] not in pipelines:
+                pipelines.append(options['pipeline'])
+        for pipeline in pipelines:
+            await pipeline.close()
+
+        if self.metrics is not None:
+            await self.metrics.close()
+
+        for executor in self.executors.values():
+            executor.shutdown(wait=False)
+        self.executors.clear()
+
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+
+        for future in self.pools.values():
+            # 创建失败或者还没创建完的连接池不需要关闭
+            if not future.done() or future.cancelled() or future.exception() is not None:
+                future.cancel()
+                continue
+            pool = future.result()
+            if pool is not None:
+                pool.close()
+                await pool.wait_closed()
+        self.pools.clear()
+        self.broker_inits.clear()
+
+    async def __init_broker(self, task):
+        """
+        初始化一种任务类型的 broker，连接地址相同的 broker 共用 Manager 创建的连接池
+        :param task: 任务类型
+        :return:
+        """
+        broker = self.tasks[task][0]
+        await broker.init_broker(await self.__get_pool(broker))
+
+        dedup = self.tasks[task][4]['dedup']
+        if dedup is not None:
+            await dedup.init_filter(task, await self.__get_pool(dedup))
+
+    async def __get_pool(self, user):
+        """
+        获取共用的连接池，连接池在第一次使用时创建
+        :param user: 使用连接池的 broker 或者去重过滤器
+        :return: 连接池，不需要连接池时为空
+        """
+        key = user.pool_key
+        if key is None:
+            return None
+
+        if key not in self.pools:
+            self.pools[key] = asyncio.ensure_future(user.create_pool(**self.pool_options))
+        future = self.pools[key]
+        try:
+            return await future
+        except Exception:
+            # 创建失败时不缓存，下次使用时重新创建
+            if self.pools.get(key) is future:
+                del self.pools[key]
+            raise
+
+    async def init_broker(self, task):
+        """
+        初始化一种任务类型的 broker，重复调用时只会初始化一次，初始化失败时下次调用会重新初始化
+        :param task: 任务类型
+        :return:
+        """
+        if task not in self.broker_inits:
+            self.broker_inits[task] = asyncio.ensure_future(self.__init_broker(task))
+        future = self.broker_inits[task]
+        try:
+            await future
+        except Exception:
+            # 初始化失败时不缓存，下次调用时重新初始化
+            if self.broker_inits.get(task) is future:
+                del self.broker_inits[task]
+            raise
+
     async def init_all_broker(self):
         """
         初始化所有任务
         :return:
         """
-        for task in self.tasks.items():
-            await task[1][0].init_broker()
+        for task in self.tasks.keys():
+            await self.init_broker(task)
 
-    async def new(self, task, data):
+    async def new(self, task, data, delay: Optional[float]=None, eta: Optional[float]=None, priority: int=0,
+                  dedup: bool=True):
         """
         添加一个任务
         :param task: 任务类型
         :param data: 任务内容
-        :return:
+        :param delay: 延迟多少秒后执行
+        :param eta: 执行时间（时间戳），和 delay 同时设置时以 eta 为准
+        :param priority: 优先级，越大越优先，需要小于 handle 设置的 priorities
+        :param dedup: 是否检查重复，为 False 时总是添加（比如循环抓取时重新添加第一页），但仍然记录指纹
+        :return: 是否添加了任务，设置了去重过滤器时重复的任务不会被添加
+        """
+        await self.init_broker(task)
+        if not await self.__dedup(task, [data], dedup):
+            return False
+
+        start = time.time()
+        await self.tasks[task][0].push(data, self.__eta(delay, eta), priority)  # 在该任务的数据库中插入该任务
+        if self.metrics is not None:
+            self.metrics.observe('gearpy_broker_seconds', time.time() - start, task=task, op='push')
+        return True
+
+    async def __dedup(self, task, items: List, check: bool=True) -> List:
+        """
+        用去重过滤器过滤掉重复的任务，没有设置去重过滤器时不过滤
+        :param task: 任务类型
+        :param items: 任务内容列表
+        :param check: 是否过滤，为 False 时只记录指纹，返回全部任务
+        :return: 不重复的任务内容列表
+        """
+        dedup = self.tasks[task][4]['dedup']
+        if dedup is None or not items:
+            return items
+
+        fingerprint = self.tasks[task][4]['fingerprint']
+        added = await dedup.add_many([fingerprint(item) for item in items])
+        if not check:
+            return items
+        return [item for item, new in zip(items, added) if new]
+
+    @staticmethod
+    def __eta(delay: Optional[float], eta: Optional[float]) -> Optional[float]:
+        """
+        计算任务的执行时间
+        :param delay: 延迟多少秒后执行
+        :param eta: 执行时间（时间戳）
+        :return: 执行时间，为空时马上执行
+        """
+        if eta is None and delay is not None and delay > 0:
+            eta = time.time() + delay
+        return eta
+
+    async def new_many(self, task, items, chunk_size: int = 1000, delay: Optional[float]=None,
+                       eta: Optional[float]=None, priority: int=0, dedup: bool=True) -> int:
+        """
+        批量添加任务，每 chunk_size 个任务合并成一次数据库请求
+        :param task: 任务类型
+        :param items: 任务内容，可以是普通的可迭代对象，也可以是异步迭代器（比如数据库游标），不需要先全部读进内存
+        :param chunk_size: 每次请求插入的任务个数
+        :param delay: 延迟多少秒后执行
+        :param eta: 执行时间（时间戳），和 delay 同时设置时以 eta 为准
+        :param priority: 优先级，越大越优先
+        :param dedup: 是否检查重复，为 False 时总是添加，但仍然记录指纹
+        :return: 添加的任务个数，不包括被去重过滤器过滤掉的任务
+        """
+        await self.init_broker(task)
+        eta = self.__eta(delay, eta)
+        chunk = []
+        count = 0
+
+        if hasattr(items, '__aiter__'):
+            async for item in items:
+                chunk.append(item)
+                if len(chunk) >= chunk_size:
+                    count += await self.__push_many(task, chunk, eta, priority, dedup)
+                    chunk = []
+        else:
+            for item in items:
+                chunk.append(item)
+                if len(chunk) >= chunk_size:
+                    count += await self.__push_many(task, chunk, eta, priority, dedup)
+                    chunk = []
+
+        # 插入剩余不满一批的任务
+        if chunk:
+            count += await self.__push_many(task, chunk, eta, priority, dedup)
+
+        return count
+
+    async def __push_many(self, task, chunk: List, eta: Optional[float], priority: int, dedup: bool) -> int:
         """
-        await self.tasks[task][0].push(data)  # 在该任务的数据库中插入该任务
+        过滤掉重复的任务后，一次数据库请求插入一批任务
+        :param task: 任务类型
+        :param chunk: 任务内容列表
+        :param eta: 执行时间（时间戳）
+        :param priority: 优先级
+        :param dedup: 是否检查重复
+        :return: 添加的任务个数
+        """
+        chunk = await self.__dedup(task, chunk, dedup)
+        start = time.time()
+        count = await self.tasks[task][0].push_many(chunk, eta, priority)
+        if self.metrics is not None:
+            self.metrics.observe('gearpy_broker_seconds', time.time() - start, task=task, op='push_many')
+        return count
 
-    async def feedback(self, task, task_data, success=True):
+    async def feedback(self, task, delivery: Delivery, success=True):
         """
         把任务执行情况反馈给数据库
         :param task: 任务类型
-        :param task_data: 任务内容
+        :param delivery: 任务投递
         :param success: 是否成功
         :return:
         """
+        broker = self.tasks[task][0]
+        retry = self.tasks[task][4]['retry']
+        start = time.time()
+
         if success:
 
             # 成功时，把任务从 「正在工作队列」 中删除
-            await self.tasks[task][0].delete(task_data, working_queue=True)
-        else:
+            outcome, op = 'success', 'ack'
+            await broker.ack(delivery.id)
+        elif retry is None:
 
             # 失败时，把任务从「正在工作队列」中放回「准备工作队列」，具体实现 看 Broker.rollback 函数
-            await self.tasks[task][0].rollback(task_data)
+            outcome, op = 'failure', 'rollback'
+            await broker.rollback(delivery.id)
+        else:
+
+            # 设置了重试策略时，按失败次数延迟重试，失败次数太多时放进「死信队列」
+            delay = retry.delay(delivery.attempts + 1)
+            if delay is None:
+                print('task in list {} failed {} times, moved to dead queue'.format(task, delivery.attempts + 1))
+                outcome, op = 'dead', 'dead'
+                await broker.dead(delivery)
+            else:
+                outcome, op = 'retry', 'retry'
+                await broker.retry(delivery, self.__eta(delay, None))
+
+        if self.metrics is not None:
+            self.metrics.observe('gearpy_broker_seconds', time.time() - start, task=task, op=op)
+            self.metrics.inc('gearpy_tasks_total', task=task, outcome=outcome)
+
+    async def dead_tasks(self, task, start: int=0, stop: int=-1):
+        """
+        查看一种任务类型「死信队列」中的任务，最新放入的任务在最前面
+        :param task: 任务类型
+        :param start: 开始位置
+        :param stop: 结束位置（包括），-1 表示到最后
+        :return: 任务内容和失败次数
+        """
+        await self.init_broker(task)
+        return await self.tasks[task][0].dead_tasks(start, stop)
+
+    async def replay_dead(self, task, limit: int=0) -> int:
+        """
+        把一种任务类型「死信队列」中的任务清空失败次数后重新放回「准备工作队列」，比如修复了处理代码之后
+        :param task: 任务类型
+        :param limit: 最多放回多少个任务，0 表示全部放回
+        :return: 放回的任务个数
+        """
+        await self.init_broker(task)
+        return await self.tasks[task][0].replay_dead(limit)
 
-    async def __end_task(self, task):
+    async def purge_dead(self, task) -> int:
         """
-        任务完成时，正在执行任务 减 1
+        清空一种任务类型的「死信队列」
         :param task: 任务类型
+        :return: 删除的任务个数
+        """
+        await self.init_broker(task)
+        return await self.tasks[task][0].purge_dead()
+
+    async def task_serve(self, task, task_class, delivery):
+        """
+        爬虫任务处理流程，任务被取消时（比如关闭系统）把任务回滚到「准备工作队列」，
+        before、handle、success 等函数抛出异常时按任务失败处理，由回滚或重试策略决定之后怎么执行
+        :param task: 任务类型
+        :param task_class: 任务处理类
+        :param delivery: 任务投递，包含投递 ID 和任务内容
         :return:
         """
-        self.tasks[task][2] -= 1
+        retry = self.tasks[task][4]['retry']
+        if retry is not None and delivery.attempts >= retry.max_attempts:
+            # 租约到期也算一次失败，每次都让工作进程崩溃的任务失败次数达到上限后不再执行，直接放进「死信队列」
+            print('task in list {} expired {} times, moved to dead queue'.format(task, delivery.attempts))
+            await self.feedback(task, delivery, success=False)
+            return
+
+        try:
+            await self.__task_serve(task, task_class, delivery)
+        except asyncio.CancelledError:
+            await self.tasks[task][0].rollback(delivery.id)
+            raise
+        except Exception as e:
+            print('task serving raised', e, str(e))
+            await self.feedback(task, delivery, success=False)
 
-    async def task_serve(self, task, task_class, task_data):
+    async def __task_serve(self, task, task_class, delivery):
         """
         爬虫任务处理流程
         :param task: 任务类型
         :param task_class: 任务处理类
-        :param task_data: 任务内容
+        :param delivery: 任务投递，包含投递 ID 和任务内容
         :return:
         """
+        metrics = self.metrics
+        received = time.time()
+        task_data = delivery.item
         task_instance = task_class(task_data)  # 实例化任务处理类，同时把任务内容穿进去
-        await task_instance.before()  # 执行 预处理函数
+
+        proxy_pool = self.tasks[task][4]['proxy_pool']
+        proxy = None
+        if isinstance(task_instance, Task):
+            task_instance.session = self.get_session(task)  # 注入共享的 HTTP 会话
+            if self.tasks[task][4]['http_cache'] is not None:
+                task_instance.http_cache = self.tasks[task][4]['http_cache']  # 注入 HTTP 响应缓存
+            if proxy_pool is not None:
+                proxy = task_instance.proxy = await proxy_pool.get()  # 从代理池中读取代理
+
+        succeeded = False
+        latency = None
+        dropped = False
         try:
-            ret = await task_instance.on_task()  # 执行 HTTP 请求
-        except Exception as e:
-            # 请求 HTTP 出错时，ret 设为 False，用于标记是否成功执行任务
-            print('task processing raised', e, str(e))
-            ret = False
-        if ret:
+            await task_instance.before()  # 执行 预处理函数
+            slots = await self.__wait_politely(task, task_instance, delivery)  # 按请求频率控制等待
+            if slots is None:
+                # 等待期间租约到期，任务已经被放回「准备工作队列」，不再执行也不反馈
+                print('lease of task in list {} expired while waiting, dropped'.format(task))
+                dropped = True
+                return
+
+            start = time.time()
+            if metrics is not None:
+                metrics.observe('gearpy_queue_wait_seconds', start - received, task=task)
+            try:
+                ret = await task_instance.on_task()  # 执行 HTTP 请求
+            except Exception as e:
+                # 请求 HTTP 出错时，ret 设为 False，用于标记是否成功执行任务
+                print('task processing raised', e, str(e))
+                ret = False
+            finally:
+                for slot in slots:
+                    slot.release()
+            latency = time.time() - start
+            if metrics is not None:
+                metrics.observe('gearpy_fetch_seconds', latency, task=task)
+
+            if ret and isinstance(task_instance, Task) and task_instance.has_extract():
+                start = time.time()
+                try:
+                    task_instance.records = await self.__extract(task, task_instance)  # 提取数据
+                except Exception as e:
+                    print('task extracting raised', e, str(e))
+                    ret = False
+                if metrics is not None:
+                    metrics.observe('gearpy_extract_seconds', time.time() - start, task=task)
+
+            if ret:
+
+                # 如果 HTTP 请求成功
+                start = time.time()
+                handled = await task_instance.handle()  # 执行 handle 函数，实际上时处理用户需要抓取哪些数据
+                if metrics is not None:
+                    metrics.observe('gearpy_handle_seconds', time.time() - start, task=task)
+
+                if handled:
+
+                    # 在抓取 用户数据时，成功就执行 success 函数
+                    succeeded = True
+                    await task_instance.success()
 
-            # 如果 HTTP 请求成功
-            if await task_instance.handle():  # 执行 handle 函数，实际上时处理用户需要抓取哪些数据
+                    # 把输出的记录放进记录处理管道，管道满时在这里等待
+                    pipeline = self.tasks[task][4]['pipeline']
+                    if pipeline is not None and isinstance(task_instance, Task) and task_instance.emitted:
+                        await pipeline.put_many(task_instance.emitted)
 
-                # 在抓取 用户数据时，成功就执行 success 函数
-                await task_instance.success()
-                await self.feedback(task, task_data)  # 反馈给数据库，任务执行成功
+                    await self.feedback(task, delivery)  # 反馈给数据库，任务执行成功
+                else:
+                    # 抓取失败时，触发 failure 函数
+                    await task_instance.failure()
+                    await self.feedback(task, delivery, success=False)  # 反馈给数据库，任务失败
             else:
-                # 抓取失败时，触发 failure 函数
-                await task_instance.failure()
-                await self.feedback(task, task_data, success=False)  # 反馈给数据库，任务失败
-        else:
 
-            # HTTP 请求失败时，也反馈给数据库，任务失败
-            await self.feedback(task, task_data, success=False)
+                # HTTP 请求失败时，也反馈给数据库，任务失败
+                await self.feedback(task, delivery, success=False)
+        finally:
+            # 把代理的使用结果反馈给代理池，before 中更换了代理或者任务被丢弃时只归还代理
+            if proxy is not None:
+                if task_instance.proxy == proxy and not dropped:
+                    proxy_pool.feedback(proxy, succeeded, latency)
+                    outcome = 'success' if succeeded else 'failure'
+                else:
+                    proxy_pool.release(proxy)
+                    outcome = 'released'
+                if metrics is not None:
+                    metrics.inc('gearpy_proxy_total', task=task, outcome=outcome)
+
+    async def __extract(self, task, task_instance):
+        """
+        执行任务类的 extract，设置了进程池或线程池时在其中执行，只传递原始的响应内容。
+        边下载边解析的任务没有原始的响应内容，按 item 从解析好的 tree 提取
+        :param task: 任务类型
+        :param task_instance: 任务处理类实例
+        :return: 提取的结果
+        """
+        task_class = type(task_instance)
+        if task_instance.body is None and task_class.parses_stream():
+            # 边下载边解析的任务没有原始的响应内容，在事件循环中从解析好的 tree 提取
+            return task_class.item.extract(task_instance.tree)
+
+        extract = task_class.extract
+        executor = self.get_executor(task)
+        if executor is None:
+            return extract(task_instance.body, task_instance.encoding)
+
+        return await asyncio.get_event_loop().run_in_executor(executor, extract, task_instance.body, task_instance.encoding)
+
+    async def __wait_politely(self, task, task_instance, delivery) -> Optional[List[ConcurrencyLimit]]:
+        """
+        按请求频率控制等待到可以请求，需要等待时暂时让出执行名额，让其他域名的任务继续执行。
+        等待时不占用任何同时请求名额，占用同时请求名额后马上请求，所以不会和其他任务互相等待。
+        设置了可见时间时，等待期间定期延长任务的租约，避免等待中的任务被放回「准备工作队列」后重复执行
+        :param task: 任务类型
+        :param task_instance: 任务处理类实例
+        :param delivery: 任务投递
+        :return: 占用的同时请求名额，请求结束后需要释放；等待期间租约已经到期、任务被放回时为空
+        """
+        if self.scheduler is None or not isinstance(task_instance, Task) or not task_instance.url:
+            return []
+
+        delay = self.scheduler.reserve(task_instance.url, task_instance.proxy)
+        slots = self.scheduler.slots(task_instance.url, task_instance.proxy)
+
+        if delay <= 0 and try_acquire(slots):
+            return slots  # 不需要等待
+
+        broker = self.tasks[task][0]
+        keeper = None
+        if broker.visibility_timeout is not None:
+            keeper = asyncio.ensure_future(self.__keep_lease(broker, delivery))
+
+        try:
+            await self.__defer(task, delay, slots)
+        finally:
+            if keeper is not None:
+                keeper.cancel()
+
+        if keeper is not None and not await broker.renew(delivery.id):
+            # 租约在等待期间到期（比如事件循环被阻塞太久），任务已经被放回，由重新读取到它的地方执行
+            for slot in slots:
+                slot.release()
+            return None
+
+        return slots
+
+    @staticmethod
+    async def __keep_lease(broker, delivery):
+        """
+        每隔可见时间的三分之一延长一次任务的租约，任务已经被放回时停止
+        :param broker: 任务储存介质
+        :param delivery: 任务投递
+        :return:
+        """
+        while True:
+            await asyncio.sleep(broker.visibility_timeout / 3)
+            try:
+                if not await broker.renew(delivery.id):
+                    return
+            except Exception as e:
+                print('renew lease raised', e, str(e))
+
+    async def __defer(self, task, delay: float, slots: List[ConcurrencyLimit]):
+        """
+        等待 delay 秒后占用所有同时请求名额，等待期间暂时让出执行名额
+        :param task: 任务类型
+        :param delay: 请求频率控制需要等待的时间（秒）
+        :param slots: 需要占用的同时请求名额
+        :return:
+        """
+        semaphore = self.tasks[task][2]
+        deferred = self.tasks[task][4]['deferred']
+
+        if deferred.locked():
+            # 等待中的任务太多，占着执行名额等待，让读取任务的速度慢下来
+            await asyncio.sleep(delay)
+            while not try_acquire(slots):
+                await wait_available(slots)
+            return
+
+        # 让出执行名额，等待期间其他任务可以执行
+        async with deferred:
+            semaphore.release()
+            holding = False
+            try:
+                await asyncio.sleep(delay)
+                while True:
+                    await wait_available(slots)
+                    await semaphore.acquire()  # 重新占用执行名额
+                    holding = True
+                    if try_acquire(slots):
+                        return
+                    semaphore.release()  # 名额又被其他任务占用了，继续等待
+                    holding = False
+            finally:
+                if not holding:
+                    await semaphore.acquire()  # 出错时也要重新占用执行名额，任务结束时会释放
+
+    def __end_task(self, task, future):
+        """
+        任务完成时，释放执行名额，并从「正在执行的任务」中移除
+        :param task: 任务类型
+        :param future: 执行该任务的 asyncio 任务
+        :return:
+        """
+        self.running[task].discard(future)
+        self.tasks[task][2].release()
+        if self.metrics is not None:
+            self.metrics.set('gearpy_in_flight', len(self.running[task]), task=task)
+
+        if not future.cancelled() and future.exception() is not None:
+            # task_serve 反馈失败时（比如数据库连接断开）的异常，打印出来，避免被 asyncio 吞掉
+            print('task serving raised', future.exception(), str(future.exception()))
+
+    def dispatch(self, task, task_class, delivery):
+        """
+        把一个任务调度成独立的 asyncio 任务执行，调用前需要先占用一个执行名额，任务完成时自动释放
+        :param task: 任务类型
+        :param task_class: 任务处理类
+        :param delivery: 任务投递
+        :return: 执行该任务的 asyncio 任务
+        """
+        future = asyncio.ensure_future(self.task_serve(task, task_class, delivery))
+        self.running[task].add(future)
+        future.add_done_callback(lambda f: self.__end_task(task, f))
+        if self.metrics is not None:
+            self.metrics.set('gearpy_in_flight', len(self.running[task]), task=task)
+        return future
+
+    async def drain(self, tasks=None):
+        """
+        等待正在执行的任务全部完成，用于关闭系统前
+        :param tasks: 任务类型，默认为所有任务类型
+        :return: 等待完成的任务个数
+        """
+        if tasks is None:
+            tasks = list(self.running.keys())
+        elif not isinstance(tasks, list):
+            tasks = [tasks]
+
+        futures = [future for task in tasks for future in self.running.get(task, ())]
+        if futures:
+            await asyncio.gather(*futures, return_exceptions=True)
 
-        # 任务执行个数减 1
-        # await self.__end_task(task)
+        return len(futures)
 
     async def task_list_serve(self, task, restore=False):
         """
@@ -128,39 +732,139 @@ class Manager:
         """
 
         print('listening on list {}'.format(task))
-        broker, task_class, _, worker_limited = self.tasks[task]  # 读取该种任务类型的信息
-        await broker.init_broker()  # 初始化该种任务的数据库
+        broker, task_class, semaphore, _, _ = self.tasks[task]  # 读取该种任务类型的信息
+        await self.init_broker(task)  # 初始化该种任务的数据库
 
         # 如果要恢复任务
         if restore:
             await broker.restore()
 
+        # 启动记录处理管道
+        pipeline = self.tasks[task][4]['pipeline']
+        if pipeline is not None:
+            await pipeline.start(await self.__get_pool(pipeline.dedup) if pipeline.dedup is not None else None)
+
+        # 设置了可见时间时，定期把超时未确认的任务放回「准备工作队列」
+        if broker.visibility_timeout is not None:
+            self.listeners.append(asyncio.ensure_future(self.requeue_serve(task)))
+
+        # 定期把到时间的延迟任务放进「准备工作队列」
+        self.listeners.append(asyncio.ensure_future(self.promote_serve(task)))
+
         # 死循环，读取任务
+        try:
+            while True:
+                # 先读取任务再占用执行名额，队列为空时不占着名额等待，
+                # 否则因为请求频率控制让出名额的任务在队列读空后无法重新占用名额
+                delivery = await broker.get_task()  # 从数据库读取一个任务
+                try:
+                    await semaphore.acquire()  # 占用一个执行名额，名额用完时在这里等待
+                except BaseException:
+                    await broker.rollback(delivery.id)  # 停止监听时，把还没执行的任务回滚
+                    raise
+
+                # 任务在独立的 asyncio 任务中执行，完成后才释放名额，所以同时执行的任务个数最多为 worker 个
+                self.dispatch(task, task_class, delivery)
+        finally:
+            # 停止监听时，把预取但还没执行的任务回滚
+            await broker.release()
+
+    async def requeue_serve(self, task):
+        """
+        定期把一种任务类型中超时未确认的任务放回「准备工作队列」，每隔可见时间的一半检查一次
+        :param task: 任务类型
+        :return:
+        """
+        broker = self.tasks[task][0]
+        interval = max(broker.visibility_timeout / 2, 1)
+
         while True:
-            with (await self.tasks[task][2]):
-            # while True:
-            #     if not worker_limited > self.tasks[task][2] >= 0:  # 任务执行个数限制在允许范围呢
-            #         await asyncio.sleep(.5)
-            #         continue
-            #
-            #     self.tasks[task][2] += 1  # 执行任务数量加 1
-                task_data = await broker.get_task()  # 从数据库读取一个任务
-                # asyncio.gather(self.task_serve(task, task_class, task_data))  # 异步任务执行这个任务
-                await self.task_serve(task, task_class, task_data)
-
-    async def serve(self, tasks, restore=False):
+            await asyncio.sleep(interval)
+            try:
+                count = await broker.requeue_expired()
+                if count:
+                    print('requeue {} expired task in list {}'.format(count, task))
+            except Exception as e:
+                print('requeue expired task raised', e, str(e))
+
+    async def promote_serve(self, task, interval: float=1):
+        """
+        定期把一种任务类型中到时间的延迟任务放进「准备工作队列」，一次移动一批，移动了任务时马上检查下一批
+        :param task: 任务类型
+        :param interval: 没有更多到时间的任务时，等待多少秒后再检查
+        :return:
+        """
+        broker = self.tasks[task][0]
+
+        while True:
+            try:
+                count = await broker.promote()
+            except Exception as e:
+                print('promote delayed task raised', e, str(e))
+                count = 0
+
+            if not count:
+                await asyncio.sleep(interval)
+
+    async def serve(self, tasks=None, restore=False):
         """
         异步启动系统
-        :param tasks: 启动的任务类型
+        :param tasks: 启动的任务类型，默认为所有任务类型
         :param restore: 是否把未完成的任务重新回滚进「准备工作队列」
         :return:
         """
-        if not isinstance(tasks, list):
+        if tasks is None:
+            tasks = list(self.tasks.keys())
+        elif not isinstance(tasks, list):
             tasks = [tasks]
 
+        if self.metrics is not None:
+            await self.metrics.start()
+
         for task in tasks:
             if task in self.tasks:
-                asyncio.gather(self.task_list_serve(task, restore))
+                self.listeners.append(asyncio.ensure_future(self.task_list_serve(task, restore)))
+
+    async def shutdown(self, timeout: Optional[float]=30) -> int:
+        """
+        关闭系统：停止读取新任务，回滚预取的任务，等待正在执行的任务完成，
+        超过等待时间仍未完成的任务被取消并回滚到「准备工作队列」，最后关闭所有连接
+        :param timeout: 等待正在执行的任务的最长时间（秒），为空时一直等待
+        :return: 被取消并回滚的任务个数
+        """
+        # 停止读取任务，task_list_serve 退出时会回滚预取的任务
+        listeners, self.listeners = self.listeners, []
+        for listener in listeners:
+            listener.cancel()
+        await asyncio.gather(*listeners, return_exceptions=True)
+
+        # 等待正在执行的任务，超时的任务取消后由 task_serve 回滚
+        futures = [future for running in self.running.values() for future in running]
+        cancelled = 0
+        if futures:
+            _, pending = await asyncio.wait(futures, timeout=timeout)
+            for future in pending:
+                future.cancel()
+            cancelled = len(pending)
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        if cancelled:
+            print('rollback {} unfinished task'.format(cancelled))
+
+        await self.close()
+        return cancelled
+
+    def serve_processes(self, tasks=None, workers: Optional[int]=None, restore=False, shutdown_timeout: float=30):
+        """
+        多进程启动爬虫系统，每个工作进程有自己的事件循环和数据库连接，崩溃的工作进程会被重新启动，
+        收到 SIGTERM 或 SIGINT 时通知所有工作进程关闭。只能在支持 fork 的系统上使用，任务需要储存在数据库中
+        :param tasks: 启动的任务类型，默认为所有任务类型
+        :param workers: 工作进程个数，默认为 CPU 个数
+        :param restore: 是否在启动工作进程前把未完成的任务重新回滚进「准备工作队列」，只在主进程中执行一次
+        :param shutdown_timeout: 关闭时等待正在执行的任务的最长时间（秒）
+        :return:
+        """
+        Supervisor(self, tasks, workers, restore, shutdown_timeout).run()
 
     def serve_sync(self, tasks=None, restore=False):
         """
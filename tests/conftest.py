@@ -0,0 +1,107 @@
+"""
+测试的公共配置
+
+Redis 测试使用 GEARPY_TEST_REDIS 指定的数据库（默认 localhost:6379/15），测试前后会清空这个数据库，
+连接不上时跳过 Redis 相关的测试
+"""
+import asyncio
+import os
+
+import aioredis
+import pytest
+
+from gearpy.broker import MemoryBroker, RedisBroker
+
+REDIS = os.environ.get('GEARPY_TEST_REDIS', 'localhost:6379/15')
+
+
+def run(coro):
+    """
+    在新的事件循环中执行协程
+    :param coro: 协程
+    :return: 协程的返回值
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+def redis_address():
+    """
+    解析 GEARPY_TEST_REDIS
+    :return: (地址, 端口, 数据库)
+    """
+    host, _, rest = REDIS.partition(':')
+    port, _, db = rest.partition('/')
+    return host or 'localhost', int(port or 6379), int(db or 15)
+
+
+async def flush_redis():
+    host, port, db = redis_address()
+    con = await aioredis.create_connection((host, port), db=db)
+    try:
+        await con.execute('FLUSHDB')
+    finally:
+        con.close()
+        await con.wait_closed()
+
+
+class Brokers:
+    """
+    在测试的事件循环中创建储存介质，测试结束时关闭它们的连接
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.created = []
+
+    async def create(self, name: str='test', **options):
+        """
+        创建并初始化一个储存介质
+        :param name: 队列名称
+        :param options: 储存介质的其他参数
+        :return:
+        """
+        if self.kind == 'memory':
+            broker = MemoryBroker(name, **options)
+        else:
+            host, port, db = redis_address()
+            broker = RedisBroker(name, host, port, db, **dict({'poll_interval': 0.05}, **options))
+        await broker.init_broker()
+        self.created.append(broker)
+        return broker
+
+    def run(self, scenario):
+        """
+        执行测试场景
+        :param scenario: 参数为 Brokers 的协程函数
+        :return:
+        """
+        async def main():
+            try:
+                await scenario(self)
+            finally:
+                for broker in self.created:
+                    if getattr(broker, 'con', None) is not None:
+                        broker.con.close()
+                        await broker.con.wait_closed()
+
+        run(main())
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def brokers(request):
+    if request.param == 'redis':
+        try:
+            run(flush_redis())
+        except (OSError, aioredis.RedisError) as e:
+            pytest.skip('redis is not available at {}: {}'.format(REDIS, e))
+
+    yield Brokers(request.param)
+
+    if request.param == 'redis':
+        run(flush_redis())
@@ -0,0 +1,259 @@
+"""
+储存介质的行为测试，每个测试分别在 MemoryBroker 和 RedisBroker 上执行
+"""
+import asyncio
+import json
+import time
+
+import pytest
+
+from gearpy.serializer import Envelope
+
+
+async def get(broker, timeout: float=2):
+    return await asyncio.wait_for(broker.get_task(), timeout)
+
+
+async def assert_empty(broker, timeout: float=0.2):
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(broker.get_task(), timeout)
+
+
+def test_push_get_ack(brokers):
+    async def scenario(brokers):
+        broker = await brokers.create()
+        await broker.push({'url': 'a'})
+        assert await broker.push_many(['b', 'c']) == 2
+
+        items = [(await get(broker)).item for _ in range(3)]
+        assert items == [{'url': 'a'}, 'b', 'c']  # 先放入的任务先取出
+        await assert_empty(broker)
+
+    brokers.run(scenario)
+
+
+def test_ack_removes_delivery(brokers):
+    async def scenario(brokers):
+        broker = await brokers.create()
+        await broker.push('a')
+        delivery = await get(broker)
+        assert await broker.ack(delivery.id) == 1
+        assert await broker.ack(delivery.id) == 0
+        assert await broker.restore() == 0
+        await assert_empty(broker)
+
+    brokers.run(scenario)
+
+
+def test_rollback_and_restore(brokers):
+    async def scenario(brokers):
+        broker = await brokers.create()
+        await broker.push_many(['a', 'b'])
+
+        first = await get(broker)
+        assert await broker.rollback(first.id) == 1
+        assert await broker.rollback(first.id) == 0
+
+        deliveries = [await get(broker), await get(broker)]
+        assert sorted(delivery.item for delivery in deliveries) == ['a', 'b']
+
+        assert await broker.restore() == 2
+        assert sorted([(await get(broker)).item, (await get(broker)).item]) == ['a', 'b']
+
+    brokers.run(scenario)
+
+
+def test_delete(brokers):
+    async def scenario(brokers):
+        broker = await brokers.create()
+        await broker.push_many(['a', 'b', 'a'])
+        assert await broker.delete('a') == 2
+        assert (await get(broker)).item == 'b'
+        await assert_empty(broker)
+
+    brokers.run(scenario)
+
+
+def test_eta_and_promote(brokers):
+    async def scenario(brokers):
+        broker = await brokers.create()
+        await broker.push('later', eta=time.time() + 0.3)
+        assert await broker.promote() == 0
+        await assert_empty(broker, 0.1)
+
+        await asyncio.sleep(0.3)
+        await broker.promote()
+        assert (await get(broker)).item == 'later'
+
+    brokers.run(scenario)
+
+
+def test_retry_counts_attempts(brokers):
+    async def scenario(brokers):
+        broker = await brokers.create()
+        await broker.push('a')
+
+        delivery = await get(broker)
+        assert await broker.retry(delivery) == 1
+        delivery = await get(broker)
+        assert delivery.attempts == 1
+
+        assert await broker.retry(delivery, eta=time.time() + 0.2) == 1
+        await assert_empty(broker, 0.1)
+        await asyncio.sleep(0.2)
+        await broker.promote()
+        assert (await get(broker)).attempts == 2
+
+    brokers.run(scenario)
+
+
+def test_dead_letters(brokers):
+    async def scenario(brokers):
+        broker = await brokers.create()
+        await broker.push_many(['a', 'b'])
+
+        for _ in range(2):
+            assert await broker.dead(await get(broker)) == 1
+        assert await broker.dead_tasks() == [Envelope('b', 1), Envelope('a', 1)]  # 最新放入的在最前面
+        assert await broker.dead_tasks(0, 0) == [Envelope('b', 1)]
+
+        assert await broker.replay_dead(limit=1) == 1
+        delivery = await get(broker)
+        assert (delivery.item, delivery.attempts) == ('a', 0)  # 最早放入的最先放回，失败次数清空
+        await assert_empty(broker)
+
+        assert await broker.purge_dead() == 1
+        assert await broker.dead_tasks() == []
+
+    brokers.run(scenario)
+
+
+def test_priority(brokers):
+    async def scenario(brokers):
+        broker = await brokers.create(priorities=2, priority_weights=[1e-9, 1])
+        await broker.push('low')
+        await broker.push('high', priority=1)
+
+        first = await get(broker)
+        assert (first.item, first.priority) == ('high', 1)
+
+        # 重试的任务回到原来的优先级
+        await broker.retry(first)
+        assert (await get(broker)).item == 'high'
+        assert (await get(broker)).item == 'low'
+
+        with pytest.raises(ValueError):
+            await broker.push('invalid', priority=2)
+
+    brokers.run(scenario)
+
+
+def test_requeue_expired(brokers):
+    async def scenario(brokers):
+        broker = await brokers.create(visibility_timeout=0.2)
+        await broker.push('a')
+
+        delivery = await get(broker)
+        assert await broker.requeue_expired() == 0
+        await asyncio.sleep(0.25)
+        assert await broker.requeue_expired() == 1
+
+        redelivery = await get(broker)
+        assert redelivery.item == 'a' and redelivery.id != delivery.id
+        assert redelivery.attempts == 1  # 租约到期算一次失败
+        assert await broker.ack(delivery.id) == 0  # 过期的投递不能再确认
+
+    brokers.run(scenario)
+
+
+def test_renew_extends_lease(brokers):
+    async def scenario(brokers):
+        broker = await brokers.create(visibility_timeout=0.2)
+        await broker.push('a')
+
+        delivery = await get(broker)
+        await asyncio.sleep(0.15)
+        assert await broker.renew(delivery.id) == 1
+        await asyncio.sleep(0.1)
+        assert await broker.requeue_expired() == 0  # 延长后没有到期
+
+        await asyncio.sleep(0.15)
+        assert await broker.requeue_expired() == 1
+        assert await broker.renew(delivery.id) == 0  # 已经被放回的任务不能再延长
+
+    brokers.run(scenario)
+
+
+def test_expired_prefetch_is_not_delivered_twice(brokers):
+    async def scenario(brokers):
+        broker = await brokers.create(visibility_timeout=0.2, prefetch=3)
+        await broker.push_many(['a', 'b', 'c'])
+
+        await get(broker)
+        await asyncio.sleep(0.25)
+        await broker.requeue_expired()
+
+        # 预取后过期的任务已经放回队列，每个任务只会再投递一次
+        items = [(await get(broker)).item for _ in range(3)]
+        assert sorted(items) == ['a', 'b', 'c']
+        await assert_empty(broker)
+
+    brokers.run(scenario)
+
+
+def test_msgpack_serializer(brokers):
+    async def scenario(brokers):
+        broker = await brokers.create(serializer='msgpack')
+        await broker.push({'url': 'a', 'body': b'\x00\xff'})
+        assert (await get(broker)).item == {'url': 'a', 'body': b'\x00\xff'}
+
+    brokers.run(scenario)
+
+
+def test_redis_waiting_get_task_wakes_on_push(brokers):
+    if brokers.kind != 'redis':
+        pytest.skip('memory broker waits on a condition')
+
+    async def scenario(brokers):
+        broker = await brokers.create(poll_interval=5)
+        loop = asyncio.get_event_loop()
+
+        async def wake(action, idle: float=0.1):
+            waiter = asyncio.ensure_future(broker.get_task())
+            await asyncio.sleep(idle)
+            start = loop.time()
+            await action()
+            delivery = await asyncio.wait_for(waiter, 1)
+            assert loop.time() - start < 0.5  # 马上被读取，不需要等到 poll_interval
+            return delivery
+
+        delivery = await wake(lambda: broker.push('a'), idle=1.5)  # 等待很久之后也马上被唤醒
+        assert (await wake(lambda: broker.rollback(delivery.id))).item == 'a'
+
+        await broker.push('b', eta=time.time())
+        assert (await wake(broker.promote)).item == 'b'
+
+        # 被取消的等待不会占住连接池
+        await assert_empty(broker)
+        await broker.push('c')
+        assert (await get(broker, 1)).item == 'c'
+
+    brokers.run(scenario)
+
+
+def test_redis_reads_legacy_payloads(brokers):
+    if brokers.kind != 'redis':
+        pytest.skip('legacy payloads only exist in redis')
+
+    async def scenario(brokers):
+        broker = await brokers.create()
+        await broker.con.execute('LPUSH', 'test:ready', json.dumps({'url': 'a'}))
+
+        delivery = await get(broker)
+        assert (delivery.item, delivery.attempts) == ({'url': 'a'}, 0)
+
+        # 重试时加上头部
+        await broker.retry(delivery)
+        assert (await get(broker)).attempts == 1
+
+    brokers.run(scenario)
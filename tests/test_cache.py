@@ -0,0 +1,117 @@
+"""
+HTTP 响应缓存的测试，使用本地的 HTTP 服务
+"""
+import aiohttp
+import pytest
+from aiohttp import web
+
+from gearpy.cache import CacheMiss, HttpCache
+from gearpy.task import Task
+
+from conftest import run
+
+
+class Page(Task):
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.url = data
+
+
+def etag_app(hits):
+    """
+    返回带 ETag 的页面，请求带上相同的 If-None-Match 时返回 304
+    :param hits: 记录每次请求的返回状态码
+    :return:
+    """
+    async def page(request):
+        if request.headers.get('If-None-Match') == '"v1"':
+            hits.append(304)
+            return web.Response(status=304, headers={'ETag': '"v1"'})
+        hits.append(200)
+        return web.Response(text='<p>hello</p>', content_type='text/html', headers={'ETag': '"v1"'})
+
+    app = web.Application()
+    app.router.add_get('/', page)
+    return app
+
+
+async def start(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, 'http://127.0.0.1:{}/'.format(site._server.sockets[0].getsockname()[1])
+
+
+async def fetch(url, cache, session):
+    task = Page(url)
+    task.http_cache = cache
+    task.session = session
+    assert await task.on_task()
+    return task
+
+
+def test_conditional_request_uses_cache_on_304(tmp_path):
+    async def scenario():
+        hits = []
+        runner, url = await start(etag_app(hits))
+        cache = HttpCache(str(tmp_path))
+        try:
+            async with aiohttp.ClientSession() as session:
+                first = await fetch(url, cache, session)
+                second = await fetch(url, cache, session)
+        finally:
+            await runner.cleanup()
+
+        assert hits == [200, 304]
+        assert not first.from_cache and first.text == '<p>hello</p>'
+        assert second.from_cache and second.status == 200 and second.body == first.body
+        assert len(cache) == 1
+
+    run(scenario())
+
+
+def test_offline_reads_only_from_cache(tmp_path):
+    async def scenario():
+        hits = []
+        runner, url = await start(etag_app(hits))
+        try:
+            async with aiohttp.ClientSession() as session:
+                await fetch(url, HttpCache(str(tmp_path)), session)
+
+                offline = HttpCache(str(tmp_path), offline=True)
+                cached = await fetch(url, offline, session)
+                with pytest.raises(CacheMiss):
+                    await fetch(url + 'missing', offline, session)
+        finally:
+            await runner.cleanup()
+
+        assert hits == [200]  # 离线时不请求网络
+        assert cached.from_cache and cached.text == '<p>hello</p>'
+
+    run(scenario())
+
+
+def test_lru_eviction(tmp_path):
+    async def scenario():
+        cache = HttpCache(str(tmp_path))
+        await cache.put('GET', 'a', 200, b'x' * 200)
+        cache.max_size = int(cache.size * 2.5)  # 能保存两个响应
+        await cache.put('GET', 'b', 200, b'x' * 200)
+        await cache.get('GET', 'a')  # a 最近使用过，b 最久没有使用
+
+        await cache.put('GET', 'c', 200, b'x' * 200)
+        assert await cache.get('GET', 'b') is None
+        assert (await cache.get('GET', 'a')).body == b'x' * 200
+        assert len(cache) == 2 and cache.size <= cache.max_size
+
+        await cache.put('GET', 'huge', 200, b'x' * (cache.max_size + 1))  # 比最大字节数还大的响应不保存
+        assert await cache.get('GET', 'huge') is None
+
+        # 重新启动后从缓存目录恢复索引
+        restarted = HttpCache(str(tmp_path))
+        assert (await restarted.get('GET', 'c')).body == b'x' * 200
+        assert len(restarted) == 2
+
+    run(scenario())
@@ -0,0 +1,309 @@
+"""
+Manager 的行为测试，使用 MemoryBroker 和本地的 HTTP 服务，不需要外部网络和数据库
+"""
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from gearpy import Manager, MemoryBroker, RedisBroker
+from gearpy.dedup import MemoryFilter
+from gearpy.extract import Field, Item
+from gearpy.retry import RetryPolicy
+from gearpy.scheduler import HostScheduler
+from gearpy.task import BasicTask, Task
+
+from conftest import run
+
+
+async def wait_until(predicate, timeout: float=2):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        assert loop.time() < deadline, 'timed out'
+        await asyncio.sleep(0.01)
+
+
+def test_success_acks_task():
+    manager = Manager(MemoryBroker)
+    handled = []
+
+    @manager.handle('echo', worker=2)
+    class Echo(BasicTask):
+        async def on_task(self):
+            return True
+
+        async def handle(self):
+            handled.append(self.data)
+            return True
+
+    async def scenario():
+        await manager.new('echo', 'a')
+        await manager.new('echo', 'b')
+        await manager.serve(['echo'])
+        await wait_until(lambda: len(handled) == 2)
+        await manager.shutdown()
+
+        broker = manager.tasks['echo'][0]
+        assert sorted(handled) == ['a', 'b']
+        assert broker.working == {} and not any(broker.ready)
+
+    run(scenario())
+
+
+def test_raising_hook_moves_task_to_dead_queue():
+    manager = Manager(MemoryBroker)
+
+    @manager.handle('broken', retry=RetryPolicy(max_attempts=2, backoff=0.01, jitter=0))
+    class Broken(BasicTask):
+        async def on_task(self):
+            return True
+
+        async def handle(self):
+            raise KeyError('missing')
+
+    async def scenario():
+        await manager.new('broken', 'a')
+        await manager.serve(['broken'])
+        await wait_until(lambda: manager.tasks['broken'][0].dead_letters)
+        await manager.shutdown()
+
+        broker = manager.tasks['broken'][0]
+        assert await manager.dead_tasks('broken') == [('a', 2, 0)]
+        assert broker.working == {}
+
+    run(scenario())
+
+
+def test_task_expiring_too_often_is_dead():
+    manager = Manager(MemoryBroker)
+    handled = []
+
+    @manager.handle('crash', visibility_timeout=0.05, retry=RetryPolicy(max_attempts=2, backoff=0.01, jitter=0))
+    class Crash(BasicTask):
+        async def on_task(self):
+            return True
+
+        async def handle(self):
+            handled.append(self.data)
+            return True
+
+    async def scenario():
+        await manager.new('crash', 'a')
+        broker = manager.tasks['crash'][0]
+
+        # 模拟执行任务的进程崩溃了两次，租约到期后任务被放回
+        for _ in range(2):
+            await broker.get_task()
+            await asyncio.sleep(0.06)
+            assert await broker.requeue_expired() == 1
+
+        await manager.serve(['crash'])
+        await wait_until(lambda: broker.dead_letters)
+        await manager.shutdown()
+
+        assert handled == []
+        assert (await manager.dead_tasks('crash'))[0][:2] == ('a', 3)
+
+    run(scenario())
+
+
+def test_deferred_task_gets_its_slot_back():
+    scheduler = HostScheduler()
+    scheduler.limit('slow.test', rate=5)
+    manager = Manager(MemoryBroker, scheduler=scheduler)
+    handled = []
+
+    @manager.handle('polite', worker=1)
+    class Polite(Task):
+        def __init__(self, data):
+            super().__init__(data)
+            self.url = data
+
+        async def on_task(self):
+            return True  # 不请求网络，只经过请求频率控制
+
+        async def handle(self):
+            handled.append(self.url)
+            return True
+
+    async def scenario():
+        await manager.new_many('polite', ['http://slow.test/1', 'http://slow.test/2',
+                                          'http://fast.test/1', 'http://fast.test/2'])
+        await manager.serve()
+        await wait_until(lambda: len(handled) == 4)
+        await manager.shutdown()
+
+        # 等待请求频率的任务让出了名额，队列读空后仍然可以重新占用名额执行
+        assert handled[-1] == 'http://slow.test/2'
+
+    run(scenario())
+
+
+def test_deferred_task_keeps_its_lease():
+    scheduler = HostScheduler()
+    scheduler.limit('slow.test', rate=5)
+    manager = Manager(MemoryBroker, scheduler=scheduler)
+    handled = []
+
+    @manager.handle('lease', worker=1, visibility_timeout=0.3)
+    class Lease(Task):
+        def __init__(self, data):
+            super().__init__(data)
+            self.url = data
+
+        async def on_task(self):
+            return True
+
+        async def handle(self):
+            handled.append(self.url)
+            return True
+
+    async def scenario():
+        urls = ['http://slow.test/{}'.format(i) for i in range(8)]
+        await manager.new_many('lease', urls)
+        await manager.serve()
+        await wait_until(lambda: len(handled) == 8, timeout=3)
+        await asyncio.sleep(1.2)  # 等到定期放回租约到期的任务之后
+        await manager.shutdown()
+
+        # 等待时间超过可见时间的任务没有被放回后重复执行
+        assert sorted(handled) == sorted(urls)
+
+    run(scenario())
+
+
+def test_dedup_skips_duplicates():
+    manager = Manager(MemoryBroker)
+    manager.handle('dedup', worker=1, dedup=MemoryFilter())(BasicTask)
+
+    async def scenario():
+        assert await manager.new('dedup', {'url': 'a', 'page': 1})
+        assert not await manager.new('dedup', {'page': 1, 'url': 'a'})
+        assert await manager.new_many('dedup', [{'url': 'a', 'page': 1}, {'url': 'b'}, {'url': 'b'}]) == 1
+
+        # 不检查重复时总是添加，并且记录指纹
+        assert await manager.new('dedup', {'url': 'a', 'page': 1}, dedup=False)
+        assert await manager.new_many('dedup', [{'url': 'c'}, {'url': 'c'}], dedup=False) == 2
+        assert not await manager.new('dedup', {'url': 'c'})
+        await manager.close()
+
+    run(scenario())
+
+
+def test_worker_must_be_positive():
+    with pytest.raises(ValueError):
+        Manager(MemoryBroker).handle('invalid', worker=0)
+
+
+def test_failed_connection_is_not_cached():
+    manager = Manager(RedisBroker, args=('localhost', 1, 0))  # 没有数据库监听的端口
+    manager.handle('offline')(BasicTask)
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(OSError):
+                await manager.init_broker('offline')
+        assert manager.pools == {} and manager.broker_inits == {}
+        await manager.close()
+
+    run(scenario())
+
+
+class Entry(Item):
+    root = '//li'
+
+    title = Field('./text()')
+
+
+def test_stream_task_extracts_item_from_tree():
+    manager = Manager(MemoryBroker)
+    records = []
+
+    @manager.handle('stream')
+    class Stream(Task):
+        stream = True
+        chunk_size = 4
+        item = Entry
+
+        def __init__(self, data):
+            super().__init__(data)
+            self.url = data
+
+        async def handle(self):
+            records.extend(self.records)
+            return True
+
+    async def page(request):
+        return web.Response(text='<ul><li>a</li><li>b</li></ul>', content_type='text/html')
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/', page)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            await manager.new('stream', 'http://127.0.0.1:{}/'.format(port))
+            await manager.serve()
+            await wait_until(lambda: records)
+            await manager.shutdown()
+        finally:
+            await runner.cleanup()
+
+        assert records == [{'title': 'a'}, {'title': 'b'}]
+
+    run(scenario())
+
+
+def test_session_does_not_share_cookies():
+    manager = Manager(MemoryBroker)
+    seen = []
+
+    @manager.handle('cookie', worker=1)
+    class Cookie(Task):
+        def __init__(self, data):
+            super().__init__(data)
+            self.url = data
+
+        async def handle(self):
+            return True
+
+    async def page(request):
+        seen.append(request.cookies.get('session'))
+        response = web.Response(text='ok')
+        response.set_cookie('session', 'secret')
+        return response
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/', page)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            await manager.new_many('cookie', ['http://localhost:{}/'.format(port)] * 2)  # 默认的 CookieJar 不保存 IP 地址的 Cookie，所以用域名
+            await manager.serve()
+            await wait_until(lambda: len(seen) == 2)
+            await manager.shutdown()
+        finally:
+            await runner.cleanup()
+
+        # 第一个任务收到的 Cookie 没有被第二个任务带上
+        assert seen == [None, None]
+
+    run(scenario())
+
+
+def test_stream_tag_cannot_be_extracted():
+    class Elements(Task):
+        stream = True
+        stream_tag = 'li'
+        item = Entry
+
+    with pytest.raises(ValueError):
+        Manager(MemoryBroker).handle('elements')(Elements)
@@ -0,0 +1,134 @@
+"""
+记录处理管道的测试
+"""
+import asyncio
+import json
+
+from gearpy import Manager, MemoryBroker
+from gearpy.dedup import MemoryFilter
+from gearpy.pipeline import CallableSink, JsonLinesSink, Pipeline
+from gearpy.retry import RetryPolicy
+from gearpy.task import Task
+
+from conftest import run
+
+
+class FlakySink(CallableSink):
+    """
+    前 failures 次写入失败
+    """
+
+    def __init__(self, failures: int=0):
+        self.batches = []
+        self.failures = failures
+        super().__init__(self.__write)
+
+    def __write(self, items):
+        if self.failures:
+            self.failures -= 1
+            raise IOError('sink is down')
+        self.batches.append(list(items))
+
+
+def test_batches_by_size_and_time():
+    async def scenario():
+        sink = FlakySink()
+        pipeline = Pipeline(sink, batch_size=2, flush_interval=0.2)
+        await pipeline.put_many(range(5))
+        await asyncio.sleep(0.05)
+        assert sink.batches == [[0, 1], [2, 3]]  # 凑够一批马上写入
+
+        await asyncio.sleep(0.25)
+        assert sink.batches == [[0, 1], [2, 3], [4]]  # 不满一批的记录等待 flush_interval 后写入
+
+        await pipeline.close()
+        assert pipeline.written == 5
+
+    run(scenario())
+
+
+def test_full_queue_blocks_put():
+    async def scenario():
+        release = asyncio.Event()
+        written = []
+
+        async def slow_write(items):
+            await release.wait()
+            written.extend(items)
+
+        pipeline = Pipeline(CallableSink(slow_write), batch_size=1, max_queue=2)
+        producer = asyncio.ensure_future(pipeline.put_many(range(5)))
+        await asyncio.sleep(0.05)
+        assert not producer.done()  # 写入跟不上时放入记录的任务等待
+
+        release.set()
+        await asyncio.wait_for(producer, 1)
+        await pipeline.close()
+        assert written == [0, 1, 2, 3, 4]
+
+    run(scenario())
+
+
+def test_dedup_drops_duplicates():
+    async def scenario():
+        sink = FlakySink()
+        pipeline = Pipeline(sink, batch_size=10, flush_interval=0.01, dedup=MemoryFilter())
+        await pipeline.put_many([{'id': 1}, {'id': 2}, {'id': 1}])
+        await pipeline.close()
+
+        assert [item for batch in sink.batches for item in batch] == [{'id': 1}, {'id': 2}]
+        assert pipeline.duplicated == 1
+
+    run(scenario())
+
+
+def test_retry_then_drop():
+    async def scenario():
+        sink = FlakySink(failures=2)
+        retry = RetryPolicy(max_attempts=3, backoff=0.01, jitter=0)
+        pipeline = Pipeline(sink, flush_interval=0.01, retry=retry)
+        await pipeline.put_many(['a', 'b'])
+        await pipeline.close()
+        assert sink.batches == [['a', 'b']] and pipeline.written == 2
+
+        # 没有重试策略时，失败的批次被丢弃
+        sink = FlakySink(failures=1)
+        pipeline = Pipeline(sink, flush_interval=0.01)
+        await pipeline.put('c')
+        await pipeline.close()
+        assert sink.batches == [] and pipeline.dropped == 1
+
+    run(scenario())
+
+
+def test_manager_close_flushes_pipeline(tmp_path):
+    path = str(tmp_path / 'items.jsonl')
+    pipeline = Pipeline(JsonLinesSink(path), batch_size=100, flush_interval=0.05)
+    manager = Manager(MemoryBroker)
+    done = []
+
+    @manager.handle('emit', pipeline=pipeline)
+    class Emit(Task):
+
+        async def on_task(self):
+            return True
+
+        async def handle(self):
+            self.emit({'page': self.data})
+            return True
+
+        async def success(self):
+            done.append(self.data)
+
+    async def scenario():
+        await manager.new_many('emit', [1, 2, 3])
+        await manager.serve()
+        while len(done) < 3:
+            await asyncio.sleep(0.01)
+        await manager.shutdown()
+
+    run(scenario())
+
+    with open(path) as f:
+        assert sorted(json.loads(line)['page'] for line in f) == [1, 2, 3]
+    assert not pipeline.started
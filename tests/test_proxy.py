@@ -0,0 +1,113 @@
+"""
+代理池的测试
+"""
+import asyncio
+import time
+
+import pytest
+
+from gearpy.proxy import ProxyPool
+
+from conftest import run
+
+PROXY = 'http://127.0.0.1:8000'
+
+
+async def fail(pool, times: int):
+    for _ in range(times):
+        pool.feedback(await pool.get(), success=False)
+
+
+def test_get_prefers_higher_score():
+    async def scenario():
+        pool = ProxyPool()
+        pool.add('127.0.0.1', 8000, 0)
+        pool.add('127.0.0.1', 8001, 0)
+
+        # 延迟低、成功率高的代理得分更高
+        pool.feedback(await pool.get(), success=True, latency=1)
+        pool.feedback(await pool.get(), success=True, latency=0.1)
+        fast = 'http://127.0.0.1:8001'
+        assert ProxyPool.score(pool.stats(fast)) > ProxyPool.score(pool.stats(PROXY))
+        assert await pool.get() == fast
+
+    run(scenario())
+
+
+def test_quarantine_and_release():
+    async def scenario():
+        pool = ProxyPool(max_failures=2, cooldown=0.2)
+        pool.add('127.0.0.1', 8000, 0)
+
+        await fail(pool, 2)
+        assert pool.stats(PROXY)['quarantines'] == 1
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(pool.get(), 0.05)
+
+        # 隔离结束后 get 被唤醒，再失败一次就重新隔离
+        start = time.time()
+        assert await asyncio.wait_for(pool.get(), 1) == PROXY
+        assert time.time() - start >= 0.1
+        assert pool.stats(PROXY)['consecutive_failures'] == 1
+
+    run(scenario())
+
+
+def test_cooldown_doubles_and_proxy_is_removed():
+    async def scenario():
+        pool = ProxyPool(max_failures=1, cooldown=0.1, max_quarantines=2)
+        pool.add('127.0.0.1', 8000, 0)
+
+        await fail(pool, 1)
+        first = pool.stats(PROXY)['cooldown_until'] - time.time()
+        assert 0 < first <= 0.1
+
+        await fail(pool, 1)  # 等到解除隔离后再失败
+        second = pool.stats(PROXY)['cooldown_until'] - time.time()
+        assert 0.1 < second <= 0.2
+
+        await fail(pool, 1)
+        assert pool.stats(PROXY) is None and len(pool) == 0
+
+    run(scenario())
+
+
+def test_success_resets_quarantines():
+    async def scenario():
+        pool = ProxyPool(max_failures=1, cooldown=0.05)
+        pool.add('127.0.0.1', 8000, 0)
+
+        await fail(pool, 1)
+        pool.feedback(await pool.get(), success=True, latency=0.1)
+        assert pool.stats(PROXY)['quarantines'] == 0
+        assert pool.stats(PROXY)['consecutive_failures'] == 0
+
+    run(scenario())
+
+
+def test_release_keeps_stats():
+    async def scenario():
+        pool = ProxyPool()
+        pool.add('127.0.0.1', 8000, 0)
+        pool.feedback(await pool.get(), success=True, latency=0.5)
+        before = dict(pool.stats(PROXY))
+
+        proxy = await pool.get()
+        assert pool.stats(PROXY)['in_use'] == 1
+        pool.release(proxy)
+        assert pool.stats(PROXY) == before
+
+    run(scenario())
+
+
+def test_get_wakes_on_add():
+    async def scenario():
+        pool = ProxyPool()
+        waiter = asyncio.ensure_future(pool.get())
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+
+        pool.add('127.0.0.1', 8000, 0)
+        assert await asyncio.wait_for(waiter, 1) == PROXY
+
+    run(scenario())
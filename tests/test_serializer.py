@@ -0,0 +1,27 @@
+"""
+任务内容序列化的测试
+"""
+import json
+
+import pytest
+
+from gearpy.serializer import Envelope, encode, get_serializer, unpack
+
+
+@pytest.mark.parametrize('name', ['json', 'msgpack', 'orjson'])
+def test_round_trip(name):
+    try:
+        serializer = get_serializer(name)
+    except ImportError as e:
+        pytest.skip(str(e))
+
+    data = encode({'url': 'a', 'page': [1, 2]}, serializer, attempts=3, priority=2)
+    assert unpack(data) == Envelope({'url': 'a', 'page': [1, 2]}, 3, 2)
+
+
+def test_legacy_json_without_header():
+    assert unpack(json.dumps({'url': 'a'}).encode()) == Envelope({'url': 'a'}, 0, 0)
+
+
+def test_attempts_are_capped():
+    assert unpack(encode('a', get_serializer(), attempts=10 ** 6)).attempts == 0xFFFF
@@ -0,0 +1,91 @@
+"""
+多进程运行的测试
+"""
+import os
+import signal
+import socket
+import time
+import urllib.request
+
+import pytest
+
+from gearpy import Manager, MemoryBroker, RedisBroker
+from gearpy.metrics import PrometheusSink
+from gearpy.supervisor import Supervisor
+from gearpy.task import BasicTask
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+
+
+def wait_exit(pid, timeout: float=10) -> int:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        finished, status = os.waitpid(pid, os.WNOHANG)
+        if finished:
+            return status
+        time.sleep(0.05)
+
+    os.kill(pid, 9)
+    os.waitpid(pid, 0)
+    raise AssertionError('worker did not exit')
+
+
+def test_worker_exits_when_listener_fails():
+    manager = Manager(RedisBroker, args=('localhost', 1, 0))  # 没有数据库监听的端口
+    manager.handle('offline')(BasicTask)
+    supervisor = Supervisor(manager, workers=1)
+
+    # 连不上数据库时工作进程以非零退出码退出，监督进程才会重新启动它
+    status = wait_exit(supervisor._Supervisor__fork(supervisor._Supervisor__run_worker))
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 1
+
+
+def free_ports(count: int) -> int:
+    """
+    找到连续 count 个空闲端口，返回第一个
+    """
+    while True:
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            base = probe.getsockname()[1]
+        if base + count > 65535:
+            continue
+        try:
+            for port in range(base, base + count):
+                with socket.socket() as probe:
+                    probe.bind(('127.0.0.1', port))
+        except OSError:
+            continue
+        return base
+
+
+def scrape(port: int, timeout: float=10) -> str:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(port), timeout=1) as response:
+                return response.read().decode()
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def test_each_worker_serves_metrics_on_its_own_port():
+    port = free_ports(2)
+    manager = Manager(MemoryBroker, metrics=PrometheusSink(port=port))
+    manager.handle('idle')(BasicTask)
+    supervisor = Supervisor(manager, workers=2)
+
+    # 工作进程监听 port + 序号，不会因为端口被占用而不断重新启动
+    pids = [supervisor._Supervisor__fork(supervisor._Supervisor__run_worker, slot) for slot in range(2)]
+    try:
+        for slot in range(2):
+            scrape(port + slot)
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+
+    for pid in pids:
+        status = wait_exit(pid)
+        assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
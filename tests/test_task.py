@@ -0,0 +1,68 @@
+"""
+HTTP 请求任务的测试，使用本地的 HTTP 服务
+"""
+import codecs
+
+import aiohttp
+from aiohttp import web
+
+from gearpy.cache import HttpCache
+from gearpy.task import Task, decode_text, detect_encoding
+
+from conftest import run
+
+PAGE = '<html><head>{}</head><body><p>豆瓣评论</p></body></html>'
+
+
+class Page(Task):
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.url = data
+
+
+def test_detect_encoding():
+    assert detect_encoding(PAGE.format('').encode('utf-8')) == 'utf-8'
+    assert detect_encoding(PAGE.format('<meta charset="gbk">').encode('gbk')) == 'gbk'
+    assert detect_encoding(PAGE.format('<meta http-equiv="Content-Type" content="text/html; charset=GB2312">')
+                           .encode('gb2312')) == 'gb2312'
+    assert detect_encoding(b'<?xml version="1.0" encoding="big5"?><a/>') == 'big5'
+    assert detect_encoding(PAGE.format('<meta charset="unknown">').encode('gbk')) == 'gb18030'  # 不认识的声明
+    assert detect_encoding(PAGE.format('').encode('gbk')) == 'gb18030'  # 没有声明，也不是 UTF-8
+    assert decode_text(codecs.BOM_UTF8 + '豆瓣'.encode('utf-8')) == '豆瓣'
+
+
+def test_undeclared_charset_is_detected(tmp_path):
+    pages = {
+        '/meta': PAGE.format('<meta charset="gbk">').encode('gbk'),
+        '/plain': PAGE.format('').encode('gbk'),
+    }
+
+    async def page(request):
+        return web.Response(body=pages[request.path], content_type='text/html')  # 响应头中没有 charset
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/{name}', page)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        url = 'http://127.0.0.1:{}'.format(site._server.sockets[0].getsockname()[1])
+        cache = HttpCache(str(tmp_path))
+        try:
+            async with aiohttp.ClientSession() as session:
+                for path in pages:
+                    task = Page(url + path)
+                    task.session = session
+                    task.http_cache = cache
+                    assert await task.on_task()
+                    assert '豆瓣评论' in task.text
+                    assert task.tree.xpath('//p/text()') == ['豆瓣评论']
+        finally:
+            await runner.cleanup()
+
+        # 检测到的编码保存在缓存中
+        assert (await cache.get('GET', url + '/plain')).encoding == 'gb18030'
+
+    run(scenario())